@@ -20,12 +20,13 @@
     
 '''
 
-import re
 from copy import deepcopy
 import numpy as np
 from scipy import linalg
 import sys
 from random import uniform, shuffle
+from pyvolve import Genetics
+MOLECULES = Genetics()
 
 
 
@@ -50,7 +51,7 @@ class dNdS_from_MutSel():
             self.codon_freqs_dict = {}
             for c in range(len(self.codons)):
                 self.codon_freqs_dict[self.codons[c]] = codon_frequencies[c]
-        assert(abs(1. - np.sum(self.codon_freqs_dict.values())) < self.ZERO), "\n\nProvided codon frequencies must sum to 1."
+        assert(abs(1. - np.sum(list(self.codon_freqs_dict.values()))) < self.ZERO), "\n\nProvided codon frequencies must sum to 1."
         
         
         # Mutation setup        
@@ -100,75 +101,37 @@ class dNdS_from_MutSel():
     def compute_quantity(self, type):
         '''
             Compute either dN or dS (type is 'nonsyn' or 'syn', respectively).
+            All single-nucleotide codon changes are evaluated at once, using the codon pair tables in pyvolve's Genetics class.
         '''
-        numer = 0.
-        denom = 0.
-
-        for codon in self.codon_freqs_dict:
-            rate = 0.
-            sites = 0.
-            rate, sites = self.calc_paths(codon, type)
-            numer += rate
-            denom += sites
+        freqs = np.array( [self.codon_freqs_dict.get(codon, 0.) for codon in self.codons] )
+        mu = np.zeros([4,4])
+        for key in self.mu_dict:
+            mu[MOLECULES.nucleotides.index(key[0]), MOLECULES.nucleotides.index(key[1])] = self.mu_dict[key]
         
-        assert( denom > self.ZERO ), "\n\nProvided frequencies indicate no evolution is 'possible'."
-        return numer/denom
-
-
-
-
-     
-    def calc_paths(self, source, type):
-        ''' 
-            Compute a term in the quantity numerator for a given source codon.
-        '''
-        rate = 0.
-        sites = 0.
-        source_freq = self.codon_freqs_dict[source]
-        for target in self.codons:
-            diff = self.get_nuc_diff(source, target) # only consider single nucleotide differences since are calculating instantaneous.
-            if (type == 'nonsyn' and self.codon_dict[source] != self.codon_dict[target]) or (type == 'syn' and self.codon_dict[source] == self.codon_dict[target]):
-                if len(diff) == 2:
-                    rate  += self.calc_subst_prob( source_freq, self.codon_freqs_dict[target], self.mu_dict[diff], self.mu_dict[diff[1]+diff[0]] )
-                    sites += self.mu_dict[diff]
-        rate  *= source_freq
-        sites *= source_freq
-        return rate, sites
-
-
-
-    def get_nuc_diff(self, source, target):
-        '''
-            Determine nucleotide difference between two codons.
-        '''
-        diff = ''
-        for i in range(3):
-            if source[i] != target[i]: 
-                diff += source[i]+target[i]
-        return diff
-
- 
-    
-    def calc_subst_prob(self, pi, pj, mu_ij, mu_ji):
-        '''
-            Compute the substitution probability between two codons, as in Halpern and Bruno 1998.
-        '''
-        if abs(pi) <= self.ZERO or abs(pj) <= self.ZERO:
-            fixation_rate = 0.
+        if type == 'syn':
+            paths = MOLECULES.codon_syn & (MOLECULES.codon_n_diff == 1)
         else:
-            p_mu = (mu_ji*pj)/(mu_ij*pi)
+            paths = ~MOLECULES.codon_syn & (MOLECULES.codon_n_diff == 1)
+        source, target = np.nonzero(paths)
+        mu_ij = mu[ MOLECULES.codon_source_nuc[source, target], MOLECULES.codon_target_nuc[source, target] ]
+        mu_ji = mu[ MOLECULES.codon_target_nuc[source, target], MOLECULES.codon_source_nuc[source, target] ]
+        pi = freqs[source]
+        pj = freqs[target]
         
-            # If p_mu == 1, L'Hopitals gives fixation rate of 1 (substitution probability is the forward mutation rate) 
-            if abs(1. - p_mu) <= self.ZERO:
-                fixation_rate = 1. 
-            else:
-                fixation_rate =  (np.log(p_mu))/(1. - (1./p_mu))
-        return fixation_rate * mu_ij            
-
-
-
-
-
+        fixation_rate = np.zeros(len(source))
+        nonzero = (np.abs(pi) > self.ZERO) & (np.abs(pj) > self.ZERO)
+        p_mu = np.ones(len(source))
+        p_mu[nonzero] = (mu_ji[nonzero] * pj[nonzero]) / (mu_ij[nonzero] * pi[nonzero])
+        # If p_mu == 1, L'Hopitals gives fixation rate of 1 (substitution probability is the forward mutation rate) 
+        neutral = nonzero & (np.abs(1. - p_mu) <= self.ZERO)
+        selected = nonzero & ~neutral
+        fixation_rate[neutral] = 1.
+        fixation_rate[selected] = np.log(p_mu[selected]) / (1. - (1./p_mu[selected]))
+        
+        numer = np.sum( pi * fixation_rate * mu_ij )
+        denom = np.sum( pi * mu_ij )
+        assert( denom > self.ZERO ), "\n\nProvided frequencies indicate no evolution is 'possible'."
+        return numer/denom
 
 
 
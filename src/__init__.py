@@ -23,6 +23,7 @@ The package consists of the following Python modules:
 
 * evolver
 
+The empirical_matrices module is loaded only when one of its names (e.g. ``pyvolve.wag_matrix``) is first accessed, so ``from pyvolve import *`` no longer exports the empirical matrices and frequencies. Access them as attributes of ``pyvolve`` or import them from ``pyvolve.empirical_matrices``.
 
 """
 __version__ = '0.9.0'
@@ -34,6 +35,20 @@ from .partition import *
 from .state_freqs import *
 from .matrix_builder import *
 from .parameters_sanity import *
-from .empirical_matrices import *
+
+
+def __getattr__(name):
+    '''
+        Return the attribute *name* of the empirical_matrices module (e.g. pyvolve.wag_matrix), or that module itself.
+        Its large literal matrices take a significant share of import time, so the module is only loaded on first access, rather than through a star import. As a consequence, ``from pyvolve import *`` does not export its names.
+    '''
+    if not name.startswith("__"):
+        import importlib
+        empirical_matrices = importlib.import_module(".empirical_matrices", __name__)
+        if name == "empirical_matrices":
+            return empirical_matrices
+        if hasattr(empirical_matrices, name):
+            return getattr(empirical_matrices, name)
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
 
 
@@ -10,26 +10,234 @@
 The module will evolve sequences along a phylogeny.
 '''
 
+import os
+import re
+import json
+import heapq
 import itertools
-from copy import deepcopy
+import collections
+import threading
 import numpy as np
-from scipy import linalg
-import random as rn
 from .model import *
 from .newick import *
 from .genetics import *
 from .partition import *
 ZERO      = 1e-8
 MOLECULES = Genetics()
+WRITE_BUFFER_SIZE = 2**20 # Size, in bytes, of the output buffer used by the native alignment writers
+FASTA_LINE_WIDTH  = 60    # Number of characters per line of sequence in FASTA files, as written by Biopython
+NATIVE_SEQFMTS    = ["fasta", "phylip-relaxed", "nexus"] # Formats written without Biopython
+TRANSITION_CHUNK  = 256   # Number of consecutive nodes (in preorder) whose transition matrices are computed together, and cached, during traversal
         
         
-class Site():
+
+def _states_to_seq_dict(statedict, code):
+    '''
+        Return dictionary with key:value pairs of ID:sequence string, from a dictionary whose values are lists containing one numpy array of integer states per partition.
+        Argument *code* is the list of states (e.g. nucleotides) which integer states index.
+    '''
+    lut = _code_lookup(code)
+    new_dict = {}
+    for entry in statedict:
+        new_dict[entry] = _states_to_seq(statedict[entry], lut)
+    return new_dict
+
+
+
+def _code_lookup(code):
+    '''
+        Return a numpy lookup table which maps each integer state to the bytes of its state in *code* (e.g. 0 to b"A" for nucleotides).
+        When all states have the same length, as nucleotides, amino acids, and codons do, the table has a fixed-width bytes dtype, so that a whole array of states is converted to bytes with one indexing operation.
+    '''
+    encoded = [state.encode() for state in code]
+    if len( set(len(state) for state in encoded) ) == 1:
+        return np.array(encoded)
+    else:
+        return np.array(encoded, dtype = object)
+        
+        
+        
+def _states_to_bytes(states, lut):
+    '''
+        Return the sequence, as bytes, for a list containing one numpy array of integer states per partition.
+        Argument *lut* is the lookup table created by _code_lookup().
+    '''
+    states = np.concatenate(states)
+    if lut.dtype == object:
+        return b"".join( lut[states] )
+    else:
+        return lut[states].tobytes()
+
+
+
+def _states_to_seq(states, lut):
+    '''
+        Return the sequence string for a list containing one numpy array of integer states per partition.
+        Argument *lut* is the lookup table created by _code_lookup().
+    '''
+    return _states_to_bytes(states, lut).decode()
+
+
+
+def _write_fasta(handle, records, lut):
+    '''
+        Write (name, states) tuples from the iterable *records* to the binary file *handle* in FASTA format, wrapping sequences every FASTA_LINE_WIDTH characters.
+    '''
+    for (name, states) in records:
+        seq = _states_to_bytes(states, lut)
+        lines = [ seq[i : i + FASTA_LINE_WIDTH] for i in range(0, len(seq), FASTA_LINE_WIDTH) ]
+        handle.write( b">" + name.encode() + b"\n" + b"\n".join(lines) + b"\n" )
+
+
+
+def _write_phylip_relaxed(handle, records, names, lut):
+    '''
+        Write (name, states) tuples from the iterable *records* to the binary file *handle* in sequential, relaxed PHYLIP format.
+        Argument *names* is the list of all record names, used to write the header and to align sequences.
+    '''
+    for name in names:
+        assert( len(name.split()) == 1 ), "\n\nNames may not contain whitespace in relaxed PHYLIP format. Please rename '" + name + "'."
+    width = max( len(name) for name in names ) + 1
+    header_written = False
+    for (name, states) in records:
+        seq = _states_to_bytes(states, lut)
+        if not header_written:
+            handle.write( (" " + str(len(names)) + " " + str(len(seq)) + "\n").encode() )
+            header_written = True
+        handle.write( name.ljust(width).encode() + seq + b"\n" )
+        
+
+
+def _write_nexus(handle, records, names, lut, datatype):
+    '''
+        Write (name, states) tuples from the iterable *records* to the binary file *handle* as a NEXUS data block.
+        Argument *names* is the list of all record names, used to write the header and to align sequences. Argument *datatype* is the content of the NEXUS format command's datatype field (e.g. dna).
+    '''
+    quoted_names = {}
+    for name in names:
+        if re.match("^[A-Za-z0-9_.|-]+$", name):
+            quoted_names[name] = name
+        else:
+            quoted_names[name] = "'" + name.replace("'", "''") + "'"
+    width = max( len(name) for name in quoted_names.values() ) + 1
+    header_written = False
+    for (name, states) in records:
+        seq = _states_to_bytes(states, lut)
+        if not header_written:
+            handle.write( ("#NEXUS\nbegin data;\n\tdimensions ntax=" + str(len(names)) + " nchar=" + str(len(seq)) + ";\n\tformat datatype=" + datatype + " missing=? gap=-;\nmatrix\n").encode() )
+            header_written = True
+        handle.write( quoted_names[name].ljust(width).encode() + seq + b"\n" )
+    handle.write(b";\nend;\n")
+
+
+
+def _smallest_int_dtype(num_values):
+    '''
+        Return the smallest signed integer numpy dtype which can hold the values 0, 1, ... num_values - 1.
+        Used to store integer states and rate categories compactly.
+    '''
+    for dtype in [np.int8, np.int16, np.int32]:
+        if num_values - 1 <= np.iinfo(dtype).max:
+            return dtype
+    return np.int64
+    
+
+
+def _json_default(value):
+    '''
+        Convert numpy scalars and arrays (e.g. a scale_tree given as np.float32), which the json module cannot serialize, to the equivalent Python numbers and lists.
+    '''
+    if isinstance(value, (np.generic, np.ndarray)):
+        return value.tolist()
+    raise TypeError("Object of type " + type(value).__name__ + " is not JSON serializable")
+
+
+
+def _node_seed_sequence(root_seed_seq, index):
     '''
-        Defines the Site class, which holds information for each evolved site.
+        Return the numpy SeedSequence of node *index* (in preorder) of the flattened tree, derived from *root_seed_seq*, the SeedSequence of the whole simulation.
+        Node seeds depend only on the node's position in the tree, so that every branch draws from the same random numbers regardless of the order in which branches are evolved. Their spawn key has a fixed size, so that deriving a seed does not depend on the depth of the node.
     '''
-    def __init__(self):
-        self.int_seq      = None # integer sequence at a site
-        self.rate         = None # site rate category
+    return np.random.SeedSequence(root_seed_seq.entropy, spawn_key = root_seed_seq.spawn_key + (index,))
+
+
+
+_WORKER_EVOLVER = None # Evolver instance used by each worker process when simulating replicates or subtrees in parallel
+
+def _init_replicate_worker(tree, partitions, settings):
+    '''
+        Initializer for the worker processes used by ``Evolver.simulate_replicates`` when workers > 1, and by ``Evolver.__call__`` with executor = "process".
+        The tree (a FlatTree) and partitions are received (pickled) only once per worker, and are used to build the worker's own Evolver.
+    '''
+    global _WORKER_EVOLVER
+    _WORKER_EVOLVER = Evolver(tree = tree, partitions = partitions, **settings)
+
+
+
+def _simulate_subtree_task(index, parent_seq, root_seed_seq, scale_tree, branch_counts):
+    '''
+        Evolve the subtree descending from node *index* of the flattened tree in a worker process, starting from the sequence of its parent.
+        Returns the list of state arrays for every node in the subtree, in the order of the flattened tree, the substitution counts accumulated along the way, the dictionary of per-site substitution event counts (empty unless simulating with uniformization), and the dictionary of per-branch substitution counts (empty unless requested with *branch_counts*).
+    '''
+    tree = _WORKER_EVOLVER._tree
+    _WORKER_EVOLVER.scale_tree = scale_tree
+    _WORKER_EVOLVER._rngs = None
+    _WORKER_EVOLVER._node_states = [None] * len(tree)
+    _WORKER_EVOLVER._node_states[ tree.parent[index] ] = parent_seq
+    _WORKER_EVOLVER.substitution_counts = np.zeros_like(_WORKER_EVOLVER.substitution_counts)
+    _WORKER_EVOLVER._event_counts = {}
+    _WORKER_EVOLVER._record_events = _WORKER_EVOLVER.engine == "uniformization"
+    _WORKER_EVOLVER._branch_counts = {}
+    _WORKER_EVOLVER._record_branch_counts = branch_counts
+    _WORKER_EVOLVER._sim_subtree(index, root_seed_seq)
+    return _WORKER_EVOLVER._node_states[index : index + tree.subtree_size[index]], _WORKER_EVOLVER.substitution_counts, _WORKER_EVOLVER._event_counts, _WORKER_EVOLVER._branch_counts
+
+
+
+def _simulate_replicate_batch(start, seeds, run_settings):
+    '''
+        Simulate a batch of replicates, with the given per-replicate seeds, in a worker process.
+        Argument *start* is the index of the first replicate in the batch. Returns a list of SimulatedReplicate objects.
+    '''
+    replicates = list( _WORKER_EVOLVER.simulate_replicates(len(seeds), seeds = seeds, **run_settings) )
+    for rep in replicates:
+        rep.index += start
+    return replicates
+    
+    
+
+
+class SimulatedReplicate(object):
+    '''
+        This class holds a single simulated alignment produced by ``Evolver.simulate_replicates``.
+        
+        Attributes include,
+            1. **index**, the index of this replicate, from 0.
+            2. **seed**, the numpy SeedSequence from which this replicate's random numbers were drawn. Providing this seed to ``Evolver.simulate_replicates`` (with the argument **seeds**) will reproduce this replicate exactly.
+            3. **states**, a dictionary of node name : list of numpy arrays of integer states, one per partition. Includes ancestral nodes only if write_anc = True was given.
+            4. **site_rates**, a list of numpy arrays giving the rate category of each site, one array per partition.
+    '''
+    def __init__(self, index, seed, states, leaf_names, site_rates, code):
+        self.index       = index
+        self.seed        = seed
+        self.states      = states
+        self.site_rates  = site_rates
+        self._leaf_names = leaf_names
+        self._code       = code
+    
+    
+    def get_sequences(self, anc = False):
+        '''
+            Method to return the dictionary of simulated sequences for this replicate.
+            Default anc = False will return the leaf sequences dictionary.
+            If anc == True, then will return the dictionary of sequences for all nodes which were saved, including ancestors when write_anc = True was given to simulate_replicates.
+        '''
+        if anc:
+            return _states_to_seq_dict(self.states, self._code)
+        else:
+            return _states_to_seq_dict( dict( (name, self.states[name]) for name in self._leaf_names ), self._code)
+
+
 
 
 class Evolver(object):
@@ -50,24 +258,52 @@ class Evolver(object):
     def __init__(self, **kwargs):
         '''             
             Required keyword arguments include,
-                1. **tree** is the phylogeny (parsed with the ``newick.read_tree`` function) along which sequences are evolved
+                1. **tree** is the phylogeny (parsed with the ``newick.read_tree`` function) along which sequences are evolved. A FlatTree compiled from this phylogeny may be given instead, which spares compiling it again for every Evolver along the same tree.
                 2. **partitions** (or **partition**) is a list of Partition instances to evolve.
+            
+            Optional keyword arguments include,
+                1. **exponentiation** is the method used to compute transition matrices. The default, "eigen", decomposes each Model's rate matrix once and computes every transition matrix by rescaling eigenvalues, except for nucleotide models of the TN93 family (e.g. JC69, K80, HKY85), whose transition matrices are computed in closed form. Specifying "expm" will instead exponentiate the rate matrix anew for every branch with scipy.linalg.expm. Results are the same up to numerical precision, so this argument is mainly useful for comparing the speed and accuracy of these two approaches.
+                2. **rng** is a numpy.random.Generator from which all random numbers are drawn when calling this Evolver without a seed. Default: None (a new, unpredictably seeded generator is created for each call).
+                3. **engine** is the method used to evolve sites along each branch. The default, "transition", samples each site's new state from the branch's transition matrix P(t). Specifying "uniformization" instead simulates the continuous-time Markov chain itself, by drawing a Poisson number of (possibly virtual) jumps for each site and applying them with the uniformized jump matrix. The cost of uniformization grows with the expected number of substitutions rather than with the number of branches, and it records every substitution: substitution counts then include multiple substitutions at a site, and the number of substitutions at each site along each branch is available from ``.get_event_counts()``. Uniformization cannot be used with batched models.
         '''
                 
         self.partitions = kwargs.get('partitions', None)
         if self.partitions is None:
             self.partitions = kwargs.get('partition', None)
         self.full_tree  = kwargs.get('tree', Node())
+        self.exponentiation = kwargs.get('exponentiation', 'eigen').lower() # Either "eigen" to compute transition matrices from each Model's cached eigendecomposition, or "expm" to exponentiate every matrix directly with scipy.
+        assert(self.exponentiation in ["eigen", "expm"]), "\nValue for keyword argument exponentiation must be either 'eigen' or 'expm'. Default behavior is eigen."
+        self._user_rng = kwargs.get('rng', None) # Generator provided by the user, used when no seed is given to __call__
+        assert(self._user_rng is None or isinstance(self._user_rng, np.random.Generator)), "\nValue for keyword argument rng must be a numpy.random.Generator."
+        self.engine = kwargs.get('engine', 'transition').lower() # Either "transition" to sample sites from transition matrices, or "uniformization" to simulate the substitutions along each branch
+        assert(self.engine in ["transition", "uniformization"]), "\nValue for keyword argument engine must be either 'transition' or 'uniformization'. Default behavior is transition."
         
                 
-        # These dictionaries enable convenient post-processing of the simulated alignment. 
-        self._leaf_sites = {} # Store final tip Site lists only
-        self._evolved_sites = {} # Stores Site lists from all nodes, including internal and tips
+        # These dictionaries enable convenient post-processing of the simulated alignment. Each value is a list containing one numpy array of integer states per partition.
+        self._leaf_states = {} # Store final tip state arrays only
+        self._evolved_states = {} # Stores state arrays from all nodes, including internal and tips
+        self._site_rates = [] # One array of rate categories per partition. Categories are shared by all nodes since they never change along the tree.
+        self._rng  = None # Random number generator used to simulate a single alignment
+        self._rngs = None # List of per-replicate random number generators when simulating replicates. When None, a single alignment is simulated with self._rng.
+        self._jump_cache = {} # Uniformization rate and cumulative jump matrix, keyed by (model, rate category)
+        self._event_counts = {} # When simulating with uniformization, node name : list of arrays (one per partition) of the number of substitutions at each site along the branch leading to the node
+        self._record_events = False # Fill self._event_counts?
+        self._branch_counts = {} # When requested, node name : (flat indices, counts) of the nonzero entries of the substitution count matrix along the branch leading to the node
+        self._record_branch_counts = False # Fill self._branch_counts?
+        self.scale_tree = 1.
         
         # Setup and sanity checks 
         self._root_seq_length = 0
+        self._root_flag = None
         self._setup_partitions()
+        self._set_tree(self.full_tree)
+        self._node_states = [] # During simulation, the state arrays of each node, indexed as in self._tree
         self._code = self.partitions[0]._root_model.code
+        if self.engine == "uniformization":
+            for part in self.partitions:
+                for m in part.models:
+                    assert(not m.is_batched_model()), "\n\nThe uniformization engine cannot be used with batched models."
+        self._state_dtype = _smallest_int_dtype( len(self._code) )
 
         ######### In-house projects #######
         # start root with certain fitness #
@@ -76,20 +312,29 @@ class Evolver(object):
 
         # Record number of each type of change, VERY LAZILY. ASSUME ONLY SINGLE CHANGES #
         self.substitution_counts = np.zeros([len(self._code), len(self._code)]) 
+        self._counts_lock = threading.Lock() # Guards substitution_counts when subtrees are evolved in threads
+
 
 
+    def _count_substitutions(self, parent, child):
+        '''
+            Return the matrix of the number of substitutions of each type (from row state to column state) between the integer state arrays *parent* and *child*.
+        '''
+        n = len(self._code)
+        changed = parent != child
+        return np.bincount( parent[changed].astype(np.intp) * n + child[changed], minlength = n * n ).reshape(n, n)
+        
+
 
     def compare_sequences(self, parent, child):
         """
             Quick function for use by SJS to count and store the number of specific substitution types from a parent to a child, across simulation.
+            Arguments *parent* and *child* are numpy arrays of integer states. Returns the matrix of substitution counts between them.
         """
-        for i in range(len(parent)):
-            parent_intseq = parent[i].int_seq
-            child_intseq  = child[i].int_seq
-            if parent_intseq != child_intseq:
-                # Just make symmetric from the getgo - JK
-                self.substitution_counts[parent_intseq][child_intseq] += 1
-                #self.substitution_counts[child_intseq][parent_intseq] += 1
+        counts = self._count_substitutions(parent, child)
+        with self._counts_lock:
+            self.substitution_counts += counts
+        return counts
                 
                 
                 
@@ -106,17 +351,45 @@ class Evolver(object):
             for p in self.partitions:
                 assert(isinstance(p, Partition)), "\n\nYou must provide either a single Partition object or list of Partition objects to evolver."    
         
-        # Assign root model flag to the full tree and determine length of root sequence
+        # Assign root model flag and determine length of root sequence
         for part in self.partitions:        
-            self.full_tree.model_flag = part.root_model_name
+            self._root_flag = part.root_model_name
             if part.branch_het():
-                assert(self.full_tree.model_flag is not None), "\n\n Your root model name does not correspond to any of the Model objects' names provided to your Partition object(s)."
+                assert(self._root_flag is not None), "\n\n Your root model name does not correspond to any of the Model objects' names provided to your Partition object(s)."
             self._root_seq_length += sum( part.size )
 
         # Final check on size
         assert(self._root_seq_length > 0), "\n\nPartitions have no size!"
     
     
+    
+    def _set_tree(self, tree):
+        '''
+            Use *tree*, either a Node or a FlatTree, as the tree along which sequences are evolved. Node trees are compiled into a FlatTree, stored in self._tree.
+        '''
+        self.full_tree = tree
+        self._tree = tree if isinstance(tree, FlatTree) else FlatTree(tree) # Compiled tree along which sequences are evolved
+        self._flags, self._flag_ids = self._resolve_model_flags()
+    
+    
+    
+    def _resolve_model_flags(self):
+        '''
+            Determine the model flag used along the branch leading to each node of self._tree: the root uses the root model flag, and every other node uses its own flag, or else that of its parent.
+            Returns the list of distinct model flags and a numpy array giving the index in this list of each node's flag.
+        '''
+        flags = list(self._tree.flags)
+        if self._root_flag not in flags:
+            flags.append(self._root_flag)
+        flag_ids = self._tree.model_flag.copy()
+        flag_ids[0] = flags.index(self._root_flag)
+        if None in flags:
+            parent = self._tree.parent
+            for i in np.flatnonzero( flag_ids[1:] == flags.index(None) ) + 1:
+                flag_ids[i] = flag_ids[ parent[i] ] # parents precede their children, so their flags are already resolved
+        return flags, flag_ids
+    
+    
                 
             
     def __call__(self, **kwargs):
@@ -124,14 +397,18 @@ class Evolver(object):
             Simulate sequences, perform any necessary post-processing, and save sequences and/or other info to appropriate files.
  
             Optional keyword arguments:
-                1. **seqfile** is a custom name for the output simulated alignment. Provide None or False to suppress file creation.
-                2. **seqfmt**  is the format for seqfile (either fasta, nexus, phylip, phylip-relaxed, stockholm, etc. Anything that Biopython can accept!!) Default is FASTA.
+                1. **seqfile** is a custom name for the output simulated alignment. Provide None or False to suppress file creation. Default: simulated_alignment.fasta, or simulated_alignment.npz when seqfmt is "npz".
+                2. **seqfmt**  is the format for seqfile (either fasta, nexus, phylip, phylip-relaxed, stockholm, etc. Anything that Biopython can accept!!) Default is FASTA. FASTA, relaxed PHYLIP, and NEXUS files are written natively, and all other formats with Biopython. Specify "npz" to save a binary numpy archive instead, described in the ``_write_npz`` method.
                 3. **ratefile** is a custom name for the "site_rates.txt" file. Provide None or False to suppress file creation.
                 4. **infofile** is a custom name for the "site_rates_info.txt" file. Provide None or False to suppress file creation.
                 5. **write_anc** is a boolean argument (True or False) for whether ancestral sequences should be output along with the tip sequences. Default is False.
                 6. **scale_tree** is a float argument for scaling the entire tree by a certain factor. Note that this argument can alternatively be used in the newick module (with `read_tree`) function, but it is included here for ease in replicates (e.g. lots of sims along same tree w/ varied branch lengths). Default: 1.
                 7. **countfile** is a file to which ****a very naive matrix**** of substitution counts can be saved. Default: None (ie not exported)
-                8. **seed**, a float to set your own random seed 
+                8. **seed**, an integer to set your own random seed. All random numbers for this simulation are drawn from numpy.random.default_rng(seed), so calls with the same seed give identical results. Note that this seed does not cover random numbers drawn before the simulation, namely the assignment of sites to rate categories by a Partition and frequencies from RandomFrequencies, which use their own **rng** arguments. Default: None (use the **rng** given to Evolver, if any, or else an unpredictable seed).
+                9. **workers**, the number of threads or processes over which independent subtrees are evolved concurrently. When provided, each branch draws from its own random number stream, determined by its position in the tree, so that results for a given seed are identical for any number of workers (but differ from results obtained with workers = None). Default: None (evolve the tree in a single traversal).
+                10. **executor**, either "thread" or "process", the kind of pool over which subtrees are spread when workers > 1. Threads share memory with no copying overhead, but only run concurrently while numpy works on long arrays: they help when partitions hold many thousands of sites, and give no speedup for short sequences, where evolving each branch holds the global interpreter lock. Processes sidestep the global interpreter lock but must pickle each subtree's sequences, and are the better choice for large trees of short sequences. Default: "thread".
+                11. **low_memory** is a boolean argument (True or False) for whether sequences should be written to seqfile as soon as they are evolved rather than kept in memory. Each ancestral sequence is discarded once all of its children have been evolved, so memory use grows with the depth of the tree rather than its number of nodes. Sequences are not kept after simulation, and hence are not available from the .get_sequences() method. Results are identical to those obtained with workers = 1, and workers > 1 is not supported. Note that only sequential formats (e.g. fasta) are written without first gathering all sequences. Default: False.
+                12. **branch_counts** is a boolean argument (True or False) for whether the substitution counts along each branch should be recorded, in addition to their sum over the tree (the substitution_counts attribute). Per-branch counts are available from the .get_branch_counts() method. Default: False.
                                                 
             Examples:
                 .. code-block:: python
@@ -148,37 +425,64 @@ class Evolver(object):
                    >>> # Custom sequence file name and format, and suppress rate information
                    >>> evolve(seqfile = "my_seqs.phy", seqfmt = "phylip", ratefile = None, infofile = None)
       
+                   >>> # Evolve subtrees of a large tree concurrently over 16 processes
+                   >>> evolve(seed = 1, workers = 16, executor = "process")
+      
+                   >>> # Stream the tips of a very large tree directly to file
+                   >>> evolve(seqfile = "big_tree.fasta", low_memory = True)
+      
         '''
         # Input arguments
-        self.seqfile    = kwargs.get('seqfile', 'simulated_alignment.fasta')
         self.seqfmt     = kwargs.get('seqfmt', 'fasta').lower()
+        self.seqfile    = kwargs.get('seqfile', 'simulated_alignment.npz' if self.seqfmt == 'npz' else 'simulated_alignment.fasta')
         self.write_anc  = kwargs.get('write_anc', False)
         self.ratefile   = kwargs.get('ratefile', 'site_rates.txt')
         self.infofile   = kwargs.get('infofile', 'site_rates_info.txt')
         self.scale_tree = kwargs.get('scale_tree', 1.)
         self.countfile  = kwargs.get('countfile', None)
-        self.seed       = kwargs.get('seed', None)   ## No sanity checks. 
+        self.seed       = kwargs.get('seed', None)
+        workers         = kwargs.get('workers', None)
+        executor        = kwargs.get('executor', 'thread').lower()
+        low_memory      = kwargs.get('low_memory', False)
+        branch_counts   = kwargs.get('branch_counts', False)
+        assert(workers is None or (type(workers) is int and workers > 0)), "\n\nThe argument workers must be a positive integer."
+        assert(not low_memory or workers is None or workers == 1), "\n\nThe argument low_memory cannot be used with more than one worker."
+        assert(executor in ["thread", "process"]), "\nValue for keyword argument executor must be either 'thread' or 'process'. Default behavior is thread."
         
 
         #### SET SEED ANEW ####
         if self.seed is not None:
             try:
-                self.seed = float(self.seed)
+                assert(float(self.seed) == int(self.seed))
+                self.seed = int(self.seed)
             except:
-                raise AssertionError("[ERROR]\n Seed must be numeric.")
-            np.random.seed(self.seed)
+                raise AssertionError("[ERROR]\n Seed must be an integer.")
+            self._rng = np.random.default_rng(self.seed)
+        elif self._user_rng is not None:
+            self._rng = self._user_rng
         else:
-            np.random.seed(None)
+            self._rng = np.random.default_rng()
             
-        # Simulate recursively
-        self._sim_subtree(self.full_tree)
-
-        # Shuffle sequences?
-        self._shuffle_sites()
+        # Simulate recursively, and shuffle sequences as needed
+        self._event_counts = {}
+        self._record_events = self.engine == "uniformization" and not low_memory
+        self._branch_counts = {}
+        self._record_branch_counts = branch_counts
+        if low_memory:
+            # Sequences are written as they are evolved, and are not kept
+            self.leaf_seqs = {}
+            self.evolved_seqs = {}
+            records = self._stream_sequences()
+            if self.seqfile:
+                self._write_sequences(records, self._streamed_names())
+            else:
+                collections.deque(records, maxlen = 0)
+        else:
+            self._simulate(rngs = None, workers = workers, executor = executor)
 
-        # Convert Site dictionaries to sequence dictionaries
-        self.leaf_seqs = self._convert_site_to_seq_dict(self._leaf_sites)
-        self.evolved_seqs = self._convert_site_to_seq_dict(self._evolved_sites)
+            # Convert state array dictionaries to sequence dictionaries
+            self.leaf_seqs = _states_to_seq_dict(self._leaf_states, self._code)
+            self.evolved_seqs = _states_to_seq_dict(self._evolved_states, self._code)
 
         # Save rate info, as needed       
         if self.ratefile:
@@ -192,108 +496,441 @@ class Evolver(object):
         
         
         # Save sequences, as needed
-        if self.seqfile:
+        if self.seqfile and not low_memory:
             if self.write_anc:
-                self._write_sequences(self.evolved_seqs)
+                self._write_sequences(self._evolved_states.items(), list(self._evolved_states.keys()))
             else:
-                self._write_sequences(self.leaf_seqs)
-    #########################################################################################                      
-                        
-                        
-                        
-                        
-                        
-    ######################## FUNCTIONS TO PROCESS SIMULATED SEQUENCES #######################              
-    def _convert_site_to_seq_dict(self, seqdict):
+                self._write_sequences(self._leaf_states.items(), list(self._leaf_states.keys()))
+
+
+
+    def simulate_replicates(self, n, **kwargs):
+        '''
+            Simulate *n* replicate alignments along the same tree and partitions. 
+            Transition matrices are computed only once, and replicates are evolved together, in batches, by stacking their sequences along an extra array axis. Each replicate draws from its own random number generator, seeded with its own numpy SeedSequence, so that any replicate can be reproduced on its own regardless of how replicates are batched.
+            
+            This method is a generator, which yields a ``SimulatedReplicate`` object for each replicate in order. No files are written.
+            
+            Required positional arguments include,
+                1. **n**, the number of replicates to simulate.
+                
+            Optional keyword arguments include,
+                1. **seed**, an integer master seed from which the per-replicate seeds are derived, with numpy.random.SeedSequence(seed).spawn(n). Default: None (unpredictable seeds).
+                2. **seeds**, a list of *n* per-replicate seeds (integers or numpy SeedSequence objects), for instance the seed attribute of previously simulated replicates. If provided, the **seed** argument is ignored.
+                3. **batch_size**, the number of replicates evolved together. Larger batches are faster but use proportionally more memory. Default: n, or, when using several workers, enough batches to give each worker about four.
+                4. **write_anc**, whether ancestral sequences should be saved in each replicate along with the tip sequences. Default: False.
+                5. **scale_tree**, a float for scaling the entire tree by a certain factor. Default: 1.
+                6. **workers**, the number of processes over which batches of replicates are spread, using a ProcessPoolExecutor. Each worker receives the tree and partitions only once. Because every replicate has its own seed, results are identical for any number of workers. Default: None (simulate in this process).
+                7. **trees**, an iterable of trees (Node or FlatTree objects), such as the generator returned by ``newick.read_trees``, along which replicates are evolved instead of this Evolver's tree, one tree per replicate. Trees are consumed lazily, and must provide at least *n* trees. Replicates along different trees cannot be evolved together, so each batch then holds a single replicate, unless workers > 1, in which case each worker receives the trees of its batches. A given replicate is identical to the replicate simulated with the same seed along its tree alone. Default: None (use this Evolver's tree for every replicate).
+            
+            Examples:
+                .. code-block:: python
+                   
+                   >>> evolve = Evolver(tree = my_tree, partitions = my_partition)
+                   >>> for replicate in evolve.simulate_replicates(50, seed = 1):
+                   >>>     sequences = replicate.get_sequences()
+                   
+                   >>> # Spread 1000 replicates over 16 processes
+                   >>> for replicate in evolve.simulate_replicates(1000, seed = 1, workers = 16):
+                   >>>     sequences = replicate.get_sequences()
+                   
+                   >>> # Simulate one replicate along each tree of a posterior sample of 1000 trees
+                   >>> for replicate in evolve.simulate_replicates(1000, seed = 1, trees = read_trees(file = "posterior.trees")):
+                   >>>     sequences = replicate.get_sequences()
         '''
-            Return dictionary with key:value pairs of ID:sequence string from the self._leaf_sites or self._evolved_sites dictionaries.
+        seed       = kwargs.get('seed', None)
+        seeds      = kwargs.get('seeds', None)
+        workers    = kwargs.get('workers', None)
+        write_anc  = kwargs.get('write_anc', False)
+        trees      = kwargs.get('trees', None)
+        self.scale_tree = kwargs.get('scale_tree', 1.)
+        if workers is None or workers == 1:
+            batch_size = kwargs.get('batch_size', n)
+            if trees is not None:
+                batch_size = 1
+        else:
+            batch_size = kwargs.get('batch_size', max(1, int(np.ceil(n / (4. * workers)))))
+
+        assert(type(n) is int and n > 0), "\n\nThe number of replicates must be a positive integer."
+        assert(type(batch_size) is int and batch_size > 0), "\n\nThe argument batch_size must be a positive integer."
+        assert(workers is None or (type(workers) is int and workers > 0)), "\n\nThe argument workers must be a positive integer."
+        if seeds is None:
+            seeds = np.random.SeedSequence(seed).spawn(n)
+        assert(len(seeds) == n), "\n\nThe number of provided seeds must equal the number of replicates."
+        
+        if trees is not None:
+            trees = iter(trees)
+        
+        if workers is not None and workers > 1:
+            for rep in self._simulate_replicates_parallel(seeds, batch_size, workers, {"write_anc": write_anc, "scale_tree": self.scale_tree}, trees):
+                yield rep
+            return
+        
+        self._event_counts = {}
+        self._record_events = False
+        self._branch_counts = {}
+        self._record_branch_counts = False
+        own_tree = self.full_tree
+        try:
+            for start in range(0, n, batch_size):
+                batch_seeds = seeds[start : start + batch_size]
+                if trees is not None:
+                    tree = next(trees, None)
+                    assert(tree is not None), "\n\nFewer trees than replicates were provided."
+                    self._set_tree(tree)
+                self._simulate( rngs = [np.random.default_rng(s) for s in batch_seeds] )
+                
+                # Split the batch into individual replicates
+                if write_anc:
+                    records = list(self._evolved_states.keys())
+                else:
+                    records = list(self._leaf_states.keys())
+                for r in range(len(batch_seeds)):
+                    states = dict( (record, [part_states[r] for part_states in self._evolved_states[record]]) for record in records )
+                    site_rates = [ rates[r] if rates.ndim == 2 else rates for rates in self._site_rates ]
+                    yield SimulatedReplicate(start + r, batch_seeds[r], states, list(self._leaf_states.keys()), site_rates, self._code)
+        finally:
+            self._rngs = None
+            if trees is not None:
+                self._set_tree(own_tree)
+
+
+
+    def _simulate_replicates_parallel(self, seeds, batch_size, workers, run_settings, trees = None):
         '''
-        new_dict = {}
-        for entry in seqdict:
-            merged_entry = list( itertools.chain.from_iterable( seqdict[entry] ) )
-            sequence = self._site_to_sequence( merged_entry )
-            new_dict[entry] = sequence
-        return new_dict
+            Spread batches of replicates over a pool of worker processes, and yield the resulting SimulatedReplicate objects in order.
+            At most two batches per worker are in flight at once, so that results do not accumulate in memory faster than they are consumed.
+            If an iterator of *trees* is given, each batch is sent along with its trees, compiled into FlatTree objects, one per replicate.
+        '''
+        from concurrent.futures import ProcessPoolExecutor
+        settings = {"exponentiation": self.exponentiation, "select_root_type": self.select_root_type, "engine": self.engine}
+        starts = collections.deque( range(0, len(seeds), batch_size) )
+        pending = collections.deque()
+        with ProcessPoolExecutor(max_workers = workers, initializer = _init_replicate_worker, initargs = (self._tree, self.partitions, settings)) as pool:
+            while starts or pending:
+                while starts and len(pending) < 2 * workers:
+                    start = starts.popleft()
+                    batch_seeds = seeds[start : start + batch_size]
+                    batch_settings = run_settings
+                    if trees is not None:
+                        batch_trees = [ tree if isinstance(tree, FlatTree) else FlatTree(tree) for tree in itertools.islice(trees, len(batch_seeds)) ]
+                        assert(len(batch_trees) == len(batch_seeds)), "\n\nFewer trees than replicates were provided."
+                        batch_settings = dict(run_settings, trees = batch_trees)
+                    pending.append( pool.submit(_simulate_replicate_batch, start, batch_seeds, batch_settings) )
+                for rep in pending.popleft().result():
+                    yield rep
+
 
 
-    def _site_to_sequence(self, site):
+    def _simulate(self, rngs = None, workers = None, executor = "thread"):
         '''
-            Convert a single Site() object or list of Site() objects into a sequence string.
-            Argument *site* is either a Site() object or a list of them.
+            Evolve sequences along the full tree and shuffle sites as needed.
+            Argument *rngs* is either None, to simulate a single alignment with self._rng, or a list of random number generators, one per replicate, to simulate replicates together. In the latter case, every state array has a leading replicate axis.
+            Arguments *workers* and *executor* are described in __call__, and apply only to the simulation of a single alignment.
         '''
-        if type(site) is list:
-            sequence = ''
-            for s in site:
-                sequence += self._code[s.int_seq]
+        self._rngs = rngs
+        self._node_states = [None] * len(self._tree)
+        if workers is None or rngs is not None:
+            self._sim_subtree(0)
         else:
-            sequence = self._code[site.int_seq]
-        return sequence
+            root_seed_seq = np.random.SeedSequence( int(self._rng.integers(2**63)) )
+            if workers == 1:
+                self._sim_subtree(0, root_seed_seq = root_seed_seq)
+            else:
+                self._sim_subtrees_parallel(root_seed_seq, workers, executor)
+        self._collect_states()
+        self._shuffle_sites()
+
+
+
+    def _collect_states(self):
+        '''
+            Fill the self._evolved_states and self._leaf_states dictionaries, in preorder, from the state arrays of each node in self._node_states, which are then released.
+        '''
+        names = self._tree.names
+        self._evolved_states = dict( zip(names, self._node_states) )
+        self._leaf_states = dict( (names[i], self._node_states[i]) for i in np.flatnonzero(self._tree.leaf) )
+        self._node_states = []
+
+
+
+    def _sim_subtree(self, index, root_seed_seq = None):
+        '''
+            Simulate sequences along the subtree descending from (and including) node *index* of the flattened tree, and store the state arrays of each node in self._node_states.
+            The subtree occupies a contiguous block of the flattened tree, whose nodes are visited in order, so that each parent is evolved before its children. When *index* is the root, the root sequence is generated. Otherwise, the parent of node *index* must already have been evolved.
+            
+            Optional positional arguments include,
+                1. **root_seed_seq** is the numpy SeedSequence of the whole simulation. If provided, the branch leading to each node draws from its own random number generator, seeded with that node's SeedSequence from _node_seed_sequence(). Default of None draws all numbers from self._rng.
+        '''
+        parent = self._tree.parent
+        end = index + self._tree.subtree_size[index]
+        for i in range(index, end):
+            if (i - index) % TRANSITION_CHUNK == 0:
+                cache = self._precompute_transition_matrices(i, min(i + TRANSITION_CHUNK, end))
+            if parent[i] < 0:
+                self._node_states[i] = self._generate_root_seq() # a list of integer state arrays, one per partition.
+            else:
+                rng = None
+                if root_seed_seq is not None:
+                    rng = np.random.default_rng( _node_seed_sequence(root_seed_seq, i) )
+                self._node_states[i] = self._evolve_branch(i, rng, cache)
+
+
+
+    def _sim_subtrees_parallel(self, root_seed_seq, workers, executor):
+        '''
+            Evolve sequences along the full tree, spreading independent subtrees over a pool of threads or processes.
+            Branches near the root are evolved first in this process, always splitting the largest remaining subtree, until no subtree holds more than 1/(4*workers) of the tree. The remaining subtrees, which no longer depend on one another, are then evolved concurrently, largest first.
+            Each branch draws from a random number generator seeded with its node's own SeedSequence, exactly as in _sim_subtree, so that results do not depend on how subtrees are scheduled.
+            Threads only overlap inside numpy calls which release the global interpreter lock, so the thread executor speeds up simulations of long partitions only; the process executor also parallelizes the per-branch Python work.
+        '''
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+        sizes = self._tree.subtree_size
+        target = max(1., len(self._tree) / (4. * workers))
+        
+        # Split the tree into a frontier of subtrees (a heap of (-size, node index) pairs)
+        self._node_states[0] = self._generate_root_seq()
+        frontier = [ (-sizes[child], child) for child in self._tree.children(0) ]
+        heapq.heapify(frontier)
+        while frontier and -frontier[0][0] > target:
+            node = heapq.heappop(frontier)[1]
+            self._node_states[node] = self._evolve_branch(node, np.random.default_rng( _node_seed_sequence(root_seed_seq, node) ))
+            for child in self._tree.children(node):
+                heapq.heappush(frontier, (-sizes[child], child))
+        frontier = [ node for (size, node) in sorted(frontier) ]
+        
+        if executor == "thread":
+            with ThreadPoolExecutor(max_workers = workers) as pool:
+                tasks = [ pool.submit(self._sim_subtree, node, root_seed_seq) for node in frontier ]
+                for task in tasks:
+                    task.result()
+        else:
+            settings = {"exponentiation": self.exponentiation, "select_root_type": self.select_root_type, "engine": self.engine}
+            with ProcessPoolExecutor(max_workers = workers, initializer = _init_replicate_worker, initargs = (self._tree, self.partitions, settings)) as pool:
+                tasks = [ pool.submit(_simulate_subtree_task, node, self._node_states[ self._tree.parent[node] ], root_seed_seq, self.scale_tree, self._record_branch_counts) for node in frontier ]
+                for node, task in zip(frontier, tasks):
+                    states, counts, events, branch_counts = task.result()
+                    self._node_states[node : node + sizes[node]] = states
+                    self.substitution_counts += counts
+                    self._event_counts.update(events)
+                    self._branch_counts.update(branch_counts)
+
+
+
+    def _stream_sequences(self):
+        '''
+            Set up a low_memory simulation: generate the root sequence and draw the permutations used to shuffle sites, in the same order as _simulate(workers = 1) does.
+            Return a generator of (name, state arrays) tuples, described in _stream_tree(), which evolves the rest of the tree as it is consumed.
+        '''
+        self._rngs = None
+        self._leaf_states = {}
+        self._evolved_states = {}
+        self._node_states = [None] * len(self._tree)
+        root_seed_seq = np.random.SeedSequence( int(self._rng.integers(2**63)) )
+        self._node_states[0] = self._generate_root_seq()
+        permutations = self._draw_site_permutations()
+        return self._stream_tree(root_seed_seq, permutations)
+
 
 
+    def _streamed_names(self):
+        '''
+            Return the names of the nodes yielded by _stream_tree(), in the order they are yielded: leaves only, or all nodes if self.write_anc, in preorder.
+        '''
+        return [ self._tree.names[i] for i in range(len(self._tree)) if self.write_anc or self._tree.leaf[i] ]
+
 
 
+    def _stream_tree(self, root_seed_seq, permutations):
+        '''
+            Generator which evolves sequences along the full tree, starting from the root sequence, and yields a (name, list of state arrays) tuple for each leaf, and for each internal node if self.write_anc, as soon as it has been evolved.
+            The nodes of the flattened tree are visited in order (preorder). A node's state arrays are released as soon as its last child has been evolved, so only nodes with children still to be evolved hold a sequence.
+            Each branch draws from its own random number stream as in _sim_subtree, and sequences are shuffled with the provided *permutations*, so that results are identical to _simulate(workers = 1).
+        '''
+        tree = self._tree
+        for i in range( len(tree) ):
+            if i % TRANSITION_CHUNK == 0:
+                cache = self._precompute_transition_matrices(i, min(i + TRANSITION_CHUNK, len(tree)))
+            p = tree.parent[i]
+            if p >= 0:
+                self._node_states[i] = self._evolve_branch(i, np.random.default_rng( _node_seed_sequence(root_seed_seq, i) ), cache)
+                if i + tree.subtree_size[i] == p + tree.subtree_size[p]: # last child of its parent
+                    self._node_states[p] = None
+            
+            if tree.leaf[i] or self.write_anc:
+                shuffled = [ self._node_states[i][q] if permutations[q] is None else self._node_states[i][q][permutations[q]] for q in range(len(permutations)) ]
+                yield tree.names[i], shuffled
+            
+            if tree.leaf[i]:
+                self._node_states[i] = None
+    #########################################################################################                      
+                        
+                        
+                        
+                        
+                        
+    ######################## FUNCTIONS TO PROCESS SIMULATED SEQUENCES #######################              
     def _shuffle_sites(self):
         ''' 
             Shuffle evolved sequences within partitions, if specified.
-            In particular, we shuffle sequences in the self._evolved_sites dictionary, and then we copy over to the self._leaf_sites dictionary.            
+            In particular, we apply a single permutation per partition to the state arrays in the self._evolved_states dictionary and to the partition's rate categories, and then we copy over to the self._leaf_states dictionary.            
+            When simulating replicates, each replicate is shuffled with its own permutation, so the partition's rate categories gain a leading replicate axis.
         ''' 
-        start = 0
         for part_index in range( len(self.partitions) ):            
             part = self.partitions[part_index]
             if part._shuffle:
-                size = sum( part.size )
-                part_pos = np.arange( size ) + start
-                np.random.shuffle(part_pos)     
-                for record in self._evolved_sites:
-                    temp = []
-                    for pp in part_pos:
-                        temp.append( self._evolved_sites[record][part_index][pp] )
-                    self._evolved_sites[record][part_index][start:start + size] = temp
-
-        # Apply shuffling to self._leaf_sites
-        for record in self._leaf_sites:
-            self._leaf_sites[record] = self._evolved_sites[record]
+                size = sum(part.size)
+                if self._rngs is None:
+                    part_pos = self._rng.permutation( size )
+                    for record in self._evolved_states:
+                        self._evolved_states[record][part_index] = self._evolved_states[record][part_index][part_pos]
+                    for record in self._event_counts:
+                        self._event_counts[record][part_index] = self._event_counts[record][part_index][part_pos]
+                else:
+                    part_pos = np.array( [rng.permutation(size) for rng in self._rngs] )
+                    for record in self._evolved_states:
+                        self._evolved_states[record][part_index] = np.take_along_axis(self._evolved_states[record][part_index], part_pos, axis = 1)
+                self._site_rates[part_index] = self._site_rates[part_index][part_pos]
+
+        # Apply shuffling to self._leaf_states
+        for record in self._leaf_states:
+            self._leaf_states[record] = self._evolved_states[record]
+
+
+
+    def _draw_site_permutations(self):
+        '''
+            Draw the permutation used to shuffle each partition, in the same way as _shuffle_sites() does when simulating a single alignment, and apply it to the partition's rate categories.
+            Return a list containing, for each partition, either its permutation or None if the partition is not shuffled.
+        '''
+        permutations = []
+        for part_index in range( len(self.partitions) ):
+            part = self.partitions[part_index]
+            if part._shuffle:
+                part_pos = self._rng.permutation( sum(part.size) )
+                self._site_rates[part_index] = self._site_rates[part_index][part_pos]
+                permutations.append(part_pos)
+            else:
+                permutations.append(None)
+        return permutations
 
                
                     
 
 
-    def _write_sequences(self, seqdict):
+    def _write_sequences(self, records, names):
         ''' 
             Write resulting sequences to a file in specified format.
+            Argument *records* is an iterable of (name, list of state arrays) tuples, and *names* is the list of their names, in order. Records are converted lazily, so that sequences are written as records are produced.
+            FASTA, relaxed PHYLIP, and NEXUS files are written directly from the state arrays, with a lookup table from states to bytes. All other formats are written with Biopython.
         '''
+        if self.seqfmt == "npz":
+            self._write_npz(records, names)
+            return
+        
+        lut = _code_lookup(self._code)
+        if self.seqfmt in NATIVE_SEQFMTS:
+            with open(self.seqfile, 'wb', WRITE_BUFFER_SIZE) as handle:
+                if self.seqfmt == "fasta":
+                    _write_fasta(handle, records, lut)
+                elif self.seqfmt == "phylip-relaxed":
+                    _write_phylip_relaxed(handle, records, names, lut)
+                else:
+                    _write_nexus(handle, records, names, lut, self._nexus_datatype())
+            return
+        
         from Bio.Seq import Seq
         from Bio.SeqRecord import SeqRecord
-        from Bio.Alphabet import generic_alphabet
         from Bio import SeqIO
 
-        alignment = [] 
-        for entry in seqdict:
-            seq_object = SeqRecord( Seq( seqdict[entry] , generic_alphabet ), id = entry, description = "")
-            alignment.append(seq_object)
+        alignment = ( SeqRecord( Seq( _states_to_seq(states, lut) ), id = entry, description = "") for (entry, states) in records )
         try:
             SeqIO.write(alignment, self.seqfile, self.seqfmt)
-        except:
+        except ValueError:
             raise TypeError("\n Output file format is unknown. Consult with Biopython manual to see which I/O formats are accepted.\n NOTE: If you are attempting to save as phylip and are receiving this error, try seqfmt = 'phylip-relaxed' instead.")
 
 
 
+    def _write_npz(self, records, names):
+        '''
+            Write sequences to seqfile as an uncompressed numpy .npz archive, which can be loaded without any text parsing using ``numpy.load``. Because numpy cannot memory-map arrays stored in an archive, the alignment matrix is also saved on its own as a .npy file, named as seqfile with its extension replaced by .npy, which ``numpy.load(..., mmap_mode = "r")`` maps without reading it into memory.
+            Arguments *records* and *names* are as in _write_sequences(). The archive contains the arrays,
+                1. **alignment**, an unsigned integer (uint8, for all built-in codes) matrix of shape (number of sequences, number of sites). Entries index the **code** array, and codons count as single sites.
+                2. **names**, the name of each sequence (row of alignment).
+                3. **code**, the states (e.g. nucleotides) which alignment entries index.
+                4. **partition** and **rate_category**, the partition index and rate category of each site, indexed from *1*, as in the ratefile.
+                5. **metadata**, a JSON string with the seed, scale_tree, exponentiation, and select_root_type settings of this simulation, and the name, rate probabilities, and rate factors (or dN and dS values, for codon models) of each partition's models, as in the infofile.
+            
+            Examples:
+                .. code-block:: python
+                   
+                   >>> evolve(seqfile = "simulated_alignment.npz", seqfmt = "npz")
+                   >>> data = np.load("simulated_alignment.npz")
+                   >>> alignment, names = data["alignment"], data["names"]
+                   >>> metadata = json.loads( str(data["metadata"]) )
+                   >>> alignment = np.load("simulated_alignment.npy", mmap_mode = "r")
+        '''
+        alignment = np.empty( (len(names), self._root_seq_length), dtype = np.uint8 if len(self._code) <= 256 else np.uint16 )
+        for (i, (name, states)) in enumerate(records):
+            assert(name == names[i]), "\n\nSequences were not provided in the expected order. Please report this error."
+            alignment[i] = np.concatenate(states)
+        
+        partition = np.concatenate( [ np.full(len(self._site_rates[p]), p + 1, dtype = np.uint16) for p in range(len(self._site_rates)) ] )
+        rate_category = np.concatenate(self._site_rates).astype(np.uint16) + 1
+        metadata = {"seed": self.seed, "scale_tree": self.scale_tree, "exponentiation": self.exponentiation, "select_root_type": self.select_root_type, "partitions": []}
+        for part in self.partitions:
+            models = []
+            for m in part.models:
+                model_info = {"model_name": m.name, "rate_probs": np.asarray(part._root_model.rate_probs).tolist(), "rate_factors": np.asarray(m.rate_factors).tolist()}
+                if m.model_type.lower() in ["mg", "gy"]:
+                    model_info["beta"]  = np.atleast_1d(m.params['beta']).tolist()
+                    model_info["alpha"] = np.atleast_1d(m.params['alpha']).tolist()
+                models.append(model_info)
+            metadata["partitions"].append(models)
+        
+        with open(self.seqfile, 'wb') as handle:
+            np.savez(handle, alignment = alignment, names = np.array(names), code = np.array(self._code), partition = partition, rate_category = rate_category, metadata = np.array(json.dumps(metadata, default = _json_default)))
+        np.save(self._npy_alignment_file(), alignment)
+
+
+
+    def _npy_alignment_file(self):
+        '''
+            Return the name of the .npy file to which _write_npz() saves the alignment matrix on its own: seqfile with its extension replaced by .npy (or with .npy appended, if seqfile already ends with .npy).
+        '''
+        stem, extension = os.path.splitext(self.seqfile)
+        return self.seqfile + ".npy" if extension == ".npy" else stem + ".npy"
+
+
+
+    def _nexus_datatype(self):
+        '''
+            Return the NEXUS datatype for this Evolver's code: dna for nucleotides and codons, protein for amino acids, and standard (with its symbols listed) for any other code of single-character states.
+        '''
+        if self._code in [MOLECULES.nucleotides, MOLECULES.codons]:
+            return "dna"
+        elif self._code == MOLECULES.amino_acids:
+            return "protein"
+        else:
+            assert( all(len(state) == 1 for state in self._code) ), "\n\nNEXUS output requires single-character states. Please choose another sequence format."
+            return 'standard symbols="' + "".join(self._code) + '"'
+
+
+
     def _write_ratefile(self):
         '''
             Write ratefile, a tab-delimited file containing site-specific rate information. Considers leaf sequences only.
             Writes -   Site_Index    Partition_Index     Rate_Category
             All indexing is from *1*.
         '''
-        refseq = list(self._leaf_sites.values())[0]
         with open(self.ratefile, 'w') as ratef:
             ratef.write("Site_Index\tPartition_Index\tRate_Category")
             site_index = 1
-            for p in range(len(refseq)):
-                part = refseq[p]
-                for i in range(len(part)):
-                    w = "\n" + str(site_index) + "\t" + str(p +  1) + "\t" + str(part[i].rate + 1)
-                    ratef.write(w)
-                    site_index += 1
+            for p in range(len(self._site_rates)):
+                rates = self._site_rates[p]
+                lines = [ "\n" + str(site_index + i) + "\t" + str(p + 1) + "\t" + str(rates[i] + 1) for i in range(len(rates)) ]
+                ratef.write( "".join(lines) )
+                site_index += len(rates)
         
 
     def _write_infofile(self):
@@ -324,8 +961,8 @@ class Evolver(object):
     def get_sequences(self, anc = False):
         '''
             Method to return the dictionary of simulated sequences.
-            Default anc = False will return the leaf_sites dictionary.
-            If anc == True, then will return the evolved_sites dictionary.
+            Default anc = False will return the leaf sequences dictionary.
+            If anc == True, then will return the dictionary of sequences for all nodes, including ancestors.
         '''
         if anc:
             return self.evolved_seqs
@@ -336,23 +973,113 @@ class Evolver(object):
 
         
         
+    def get_event_counts(self):
+        '''
+            Method to return the dictionary of node name : numpy array of the number of substitutions at each site along the branch leading to that node, including multiple substitutions at a site. Sites are ordered as in the simulated sequences, with partitions concatenated.
+            Event counts are only recorded when this Evolver was created with engine = "uniformization", and are not kept when simulating with low_memory = True. The root, which has no branch, is not included.
+        '''
+        assert(self.engine == "uniformization"), "\n\nEvent counts are only recorded when simulating with engine = 'uniformization'."
+        return dict( (name, np.concatenate(self._event_counts[name])) for name in self._evolved_states if name in self._event_counts )
+        
+        
+        
+        
+    def get_branch_counts(self, sparse = False):
+        '''
+            Method to return the substitution counts along each branch, when simulated with branch_counts = True.
+            Returns a list of node names, in preorder, and the substitution counts along the branch leading to each of these nodes. By default, counts are a numpy array of shape (number of branches, number of states, number of states), whose [b, i, j] entry is the number of substitutions from state i to state j along branch b. States are ordered as in the genetic code of the simulation (e.g. "ACGT" for nucleotides).
+            
+            Optional keyword arguments include, 
+                1. **sparse** is a boolean argument (True or False) for whether counts should be returned as a scipy.sparse.csr_matrix of shape (number of branches, number of states squared) instead, with from state i and to state j in column i * number of states + j. Useful for codon models on large trees. Default: False.
+        '''
+        assert(self._record_branch_counts), "\n\nBranch substitution counts are only recorded when simulating with branch_counts = True."
+        names = [ name for name in self._tree.names if name in self._branch_counts ]
+        n = len(self._code)
+        columns = [ self._branch_counts[name][0] for name in names ]
+        values  = [ self._branch_counts[name][1] for name in names ]
+        rows    = np.repeat( np.arange(len(names)), [len(c) for c in columns] )
+        columns = np.concatenate(columns + [np.zeros(0, dtype = np.intp)])
+        values  = np.concatenate(values + [np.zeros(0, dtype = np.int64)])
+        if sparse:
+            from scipy.sparse import csr_matrix
+            return names, csr_matrix( (values, (rows, columns)), shape = (len(names), n * n) )
+        dense = np.zeros([len(names), n * n], dtype = np.int64)
+        dense[rows, columns] = values
+        return names, dense.reshape(len(names), n, n)
+        
+        
+        
+        
     ######################### FUNCTIONS INVOLVED IN SEQUENCE EVOLUTION ############################
 
 
-    def _exponentiate_matrix(self, Q, t):
+    def _rate_matrix(self, model, rate_class):
         '''
-            Perform exponentiation on instantaneous matrix to produce transition matrix, from a given instantaneous matrix Q and a given branch length t.
+            Return the instantaneous rate matrix for a given Model's rate category.
+        '''
+        # This is done differently depending if codon (dN/dS) model or not. This is the rate het in the partition.
+        if model.is_hetcodon_model():
+            return model.matrix[rate_class]
+        else:
+            return model.matrix * model.rate_factors[rate_class] # note that rate_factors = [1.] if no site heterogeneity, so matrix unchanged
+
+
+
+    def _exponentiate_matrix(self, model, rate_class, t):
+        '''
+            Produce the transition matrix for a given Model's rate category along a branch of length t. If t is an array of branch lengths, an array of transition matrices with shape t.shape + Q.shape is produced instead.
+            By default, the transition matrix is computed from the Model's cached eigendecomposition. If Evolver was given exponentiation = "expm", the instantaneous matrix Q is instead exponentiated directly.
             Assert that all rows sum to 1.
             Return P
         '''
-        P = linalg.expm( np.multiply(Q, float(t) ) )
-        assert( np.allclose( np.sum(P, axis = 1), np.ones(len(self._code))) ), "Rows in transition matrix do not each sum to 1."
+        t = np.asarray(t, dtype = float)
+        if self.exponentiation == "eigen":
+            P = model.transition_matrix(t, rate_class)
+        else:
+            from scipy import linalg
+            P = linalg.expm( np.multiply.outer(t, self._rate_matrix(model, rate_class)) )
+        assert( np.allclose( np.sum(P, axis = -1), 1.) ), "Rows in transition matrix do not each sum to 1."
         return P
                         
     
     
     
     
+    def _precompute_transition_matrices(self, start, stop):
+        '''
+            Compute the cumulative transition matrices (see _cumulative_rows()) for the branches leading to nodes *start* to *stop* - 1 of the flattened tree, and return them in a dictionary keyed by (model id, rate category, scaled branch length), which is given to _evolve_branch().
+            The distinct scaled branch lengths along which each Model's rate category is used are gathered first, so that all of their transition matrices are computed in a single batched call to _exponentiate_matrix().
+            Traversals call this for consecutive chunks of TRANSITION_CHUNK nodes as they reach them, and drop each chunk's matrices once its branches are evolved, so that the number of matrices held does not grow with the size of the tree.
+            Batched models are skipped, as only the transition matrix rows they need are computed during traversal. Nothing is computed when simulating with uniformization, which does not use transition matrices.
+        '''
+        cache = {}
+        if self.engine == "uniformization":
+            return cache
+        times = collections.OrderedDict() # (model, rate category) : ordered dictionary of scaled branch lengths, used as an ordered set
+        evolving = (self._tree.parent[start:stop] >= 0) & (self._tree.branch_length[start:stop] > ZERO) # branches of length 0 are not evolved
+        scaled = self.scale_tree * self._tree.branch_length[start:stop]
+        flag_ids = self._flag_ids[start:stop]
+        for f in range( len(self._flags) ):
+            flag_times = scaled[ evolving & (flag_ids == f) ].tolist()
+            if len(flag_times) == 0:
+                continue
+            for part in self.partitions:
+                model = self._obtain_model(part, self._flags[f])
+                if model.is_batched_model():
+                    continue
+                for i in range( model.num_classes() ):
+                    times.setdefault( (model, i), collections.OrderedDict() ).update( dict.fromkeys(flag_times) )
+        
+        for (model, i), model_times in times.items():
+            model_times = list(model_times)
+            cumulative = self._cumulative_rows( self._exponentiate_matrix(model, i, np.array(model_times)) )
+            for j in range( len(model_times) ):
+                cache[ (id(model), i, model_times[j]) ] = cumulative[j]
+        return cache
+
+
+
+
     def _obtain_model(self, part, flag):
         '''
             Obtain the appropriate Model object for evolution along a particular branch.
@@ -372,13 +1099,30 @@ class Evolver(object):
     
     
     
-    def _generate_prob_from_unif(self, prob_array):
+    def _draw_uniform(self, shape, rng = None):
+        '''
+            Return an array of uniform random numbers in [0, 1) with the given shape.
+            When simulating replicates, the leading axis indexes replicates and each replicate's numbers are drawn from its own random number generator.
+            Optional argument *rng* is the random number generator to draw from when simulating a single alignment. Default: self._rng.
+        '''
+        if self._rngs is None:
+            if rng is None:
+                rng = self._rng
+            return rng.random(shape)
+        else:
+            return np.stack( [rng.random(shape[1:]) for rng in self._rngs] )
+        
+        
+
+    def _generate_prob_from_unif(self, prob_array, r = None):
         ''' 
             Sample a sequence (nuc,aa,or codon), and return an integer for the sequence chosen from a uniform distribution.
             Arugment *prob_array* is any list and/or numpy array of probabilities which sum to 1.
+            Optional argument *r* is the uniform random number to use. If not provided, one is drawn.
         '''
         assert ( abs(np.sum(prob_array) - 1.) < ZERO), "Probabilities do not sum to 1. Cannot generate a new sequence."
-        r = rn.uniform(0,1)
+        if r is None:
+            r = self._rng.random()
         i = 0
         sum = prob_array[i]
         while sum < r:
@@ -387,27 +1131,100 @@ class Evolver(object):
         return i     
 
 
+
+    def _generate_root_states(self, state_freqs, r):
+        '''
+            Sample a root state from the frequencies *state_freqs* for every entry of the array of uniform random numbers *r*, and return them as an integer numpy array with the shape of *r*.
+            The cumulative frequencies are computed once, and all states are drawn with a single searchsorted, which gives the same states as _generate_prob_from_unif() applied site by site.
+            
+            NOTE: The select_root_type attribute is for the sitewise_dnds_mutsel project and was created on 4/30/15.
+        '''
+        state_freqs = np.asarray(state_freqs)
+        if self.select_root_type == "min":
+            return np.full( r.shape, np.argmin(state_freqs) )
+        elif self.select_root_type == "max":
+            return np.full( r.shape, np.argmax(state_freqs) )
+        else:
+            assert ( abs(np.sum(state_freqs) - 1.) < ZERO), "Probabilities do not sum to 1. Cannot generate a new sequence."
+            cumulative = np.cumsum(state_freqs)
+            return np.minimum( np.searchsorted(cumulative, r, side = 'left'), len(state_freqs) - 1 )
+
+
+
+    def _generate_batched_root_seq(self, state_freqs, r):
+        '''
+            Sample a root state for every site of a batched model at once, and return them as an integer numpy array with the shape of *r*.
+            Argument *state_freqs* is the model's 2D array of state frequencies, with one row per site, and *r* is an array of uniform random numbers whose last axis has one entry per site. Each site is sampled as in _generate_prob_from_unif(), unless select_root_type is "min" or "max".
+        '''
+        state_freqs = np.asarray(state_freqs)
+        if self.select_root_type == "min":
+            return np.broadcast_to( np.argmin(state_freqs, axis = 1), r.shape )
+        elif self.select_root_type == "max":
+            return np.broadcast_to( np.argmax(state_freqs, axis = 1), r.shape )
+        else:
+            assert ( np.all(np.abs(np.sum(state_freqs, axis = 1) - 1.) < ZERO) ), "Probabilities do not sum to 1. Cannot generate a new sequence."
+            return self._sample_from_rows( state_freqs, r )
+
+
+
+    def _sample_from_rows(self, rows, r):
+        '''
+            Sample one state from each probability distribution along the last axis of *rows*, using the uniform random numbers in *r* (which has the shape of rows without its last axis).
+            Return the sampled states as an integer numpy array with the shape of *r*.
+        '''
+        cumulative = np.cumsum(rows, axis = -1)
+        return np.minimum( np.sum(cumulative < r[..., np.newaxis], axis = -1), rows.shape[-1] - 1 )
+
+
+
+    def _cumulative_rows(self, P_matrix):
+        '''
+            Precompute the cumulative sum of each row of a transition matrix, for use with _sample_from_cumulative().
+            Row *i* is offset by *i*, so that the flattened array is sorted and holds the cumulative distribution of child states for every parent state.
+            Return the offset cumulative matrix. A stack of transition matrices gives a stack of offset cumulative matrices.
+        '''
+        size = P_matrix.shape[-1]
+        cumulative = np.cumsum(P_matrix, axis = -1)
+        cumulative[..., -1] = 1. # guard against rounding error in the final entry of each row
+        cumulative += np.arange(size)[:, np.newaxis]
+        return cumulative
+        
+        
+        
+    def _sample_from_cumulative(self, cumulative, states, rng = None):
+        '''
+            Sample a child state for every parent state in *states* using one batched uniform draw, and return the child states as an integer numpy array of the same shape.
+            Argument *cumulative* is the offset cumulative transition matrix created by _cumulative_rows(). Each uniform draw is shifted by its parent state so that a single searchsorted lands in the parent's row, which gives the same distribution as _generate_prob_from_unif() applied site by site.
+            Optional argument *rng* is passed to _draw_uniform().
+        '''
+        states = np.asarray(states, dtype = np.intp)
+        return self._search_cumulative(cumulative, states, self._draw_uniform(states.shape, rng))
+
+
+
+    def _search_cumulative(self, cumulative, states, r):
+        '''
+            Return the child state for every parent state in the integer array *states*, given the offset cumulative matrix *cumulative* created by _cumulative_rows() and an array *r* of uniform random numbers with the same shape as *states*.
+        '''
+        size = cumulative.shape[0]
+        flat_index = np.searchsorted(cumulative.ravel(), r + states, side = 'left')
+        return np.minimum( np.maximum(flat_index - states * size, 0), size - 1 )
+
+
     def _assign_root_seq_from_MRCA(self, raw_MRCA):
         '''
-            Assign a root sequence from provided MRCA. This function converts a provided MRCA into a list of Site objects.
+            Assign a root sequence from provided MRCA. This function converts a provided MRCA into a numpy array of integer states.
         '''
-        MRCA_sites = []
+        MRCA_states = []
         step = len(self._code[0])
         for i in range(0, len(raw_MRCA), step):
-
-            # Initialize a Site object
-            new_site = Site()
-            new_site.rate = 0
-            
-            # Convert to int_seq and append to MRCA_sites
             try:
-                new_site.int_seq = self._code.index( raw_MRCA[i:i+step] )
+                MRCA_states.append( self._code.index( raw_MRCA[i:i+step] ) )
             except:
                 raise ValueError("\n\nProvided root sequence does not have the same code (alphabet) as model. Remove all noncanonical and/or wrong letters from provided root sequences. Further, if you are specifying codons, ensure that the length of your root sequence is divisible by 3.")
-            MRCA_sites.append(new_site)
         
-        assert( len(MRCA_sites)*step == len(raw_MRCA)), "\n\nRoot sequence improperly converted."
-        return MRCA_sites
+        assert( len(MRCA_states)*step == len(raw_MRCA)), "\n\nRoot sequence improperly converted."
+        return np.array(MRCA_states, dtype = self._state_dtype)
             
         
         
@@ -418,113 +1235,165 @@ class Evolver(object):
     def _generate_root_seq(self):
         ''' 
             Generate a root sequence based on the stationary frequencies.
-            Return a complete root sequence list of Site objects.
+            Return a complete root sequence, as a list containing a numpy array of integer states for each partition. The rate category of each site is assigned to self._site_rates.
             
             NOTE: The select_root_type attribute is for the sitewise_dnds_mutsel project and was created on 4/30/15.
         '''
         
-        root_sequence = [] # This will contain a list for each partition's sequence (which is itself a list of Site() objects)
+        root_sequence = [] # This will contain an array of integer states for each partition's sequence
+        self._site_rates = []
 
         for part in self.partitions:
         
-            part_root = [] # reset to empty list
-        
             # Is there a root sequence?
             if part.MRCA is not None:
                 part_root = self._assign_root_seq_from_MRCA(part.MRCA)
+                part_rates = np.zeros(len(part_root), dtype = np.int8)
             
             # No root sequence provided. Must generate one.
             else:            
             
                 # Grab model info for this partition to get frequency vector for root simulation
-                root_model = self._obtain_model(part, self.full_tree.model_flag)
-
-                # Generate root_sequence and assign the Site a rate class
-                for i in range( root_model.num_classes() ):
-                    for j in range( part.size[i] ):
-                        new_site = Site()
-                        new_site.rate = i
-                        ########### SECTION EDITED FOR sitewise_dnds_mutsel PROJECT ############
-                        if self.select_root_type == "min":
-                            new_site.int_seq = np.argmin(root_model.params['state_freqs'])
-                        
-                        elif self.select_root_type == "max":
-                            new_site.int_seq = np.argmax(root_model.params['state_freqs'])
-                        
-                        elif self.select_root_type == "random": 
-                            new_site.int_seq = self._generate_prob_from_unif( root_model.params['state_freqs'] )
-                        #########################################################################
-                        part_root.append( new_site )
-                        del new_site
+                root_model = self._obtain_model(part, self._flags[ self._flag_ids[0] ])
+                num_classes = root_model.num_classes()
+                part_root  = np.empty(sum(part.size), dtype = self._state_dtype)
+                part_rates = np.repeat( np.arange(num_classes), part.size ).astype( _smallest_int_dtype(num_classes) )
+                if self._rngs is not None:
+                    part_root = np.empty( (len(self._rngs), sum(part.size)), dtype = self._state_dtype)
+                r = self._draw_uniform(part_root.shape)
+
+                # Batched models have one row of frequencies per site, so all sites are sampled at once
+                if root_model.is_batched_model():
+                    part_root[...] = self._generate_batched_root_seq(root_model.params['state_freqs'], r)
+                
+                # Generate root_sequence. All rate classes share the root frequencies, so every site is sampled at once.
+                else:
+                    part_root[...] = self._generate_root_states( root_model.params['state_freqs'], r )
             
-            assert( len(part_root) == sum(part.size) ), "\n\nRoot sequence improperly generated for a partition, evolution cannot happen."
+            if self._rngs is not None and part_root.ndim == 1:
+                part_root = np.tile(part_root, (len(self._rngs), 1))
+            assert( part_root.shape[-1] == sum(part.size) ), "\n\nRoot sequence improperly generated for a partition, evolution cannot happen."
             root_sequence.append(part_root)
+            self._site_rates.append(part_rates)
         return root_sequence
 
         
         
-    def _sim_subtree(self, current_node, parent_node = None):
+    def _check_parent_branch(self, index):
         ''' 
-            Function to traverse a Node (tree) object recursively and simulate sequences.
-            Required positional arguments include,
-                1. **current_node** is the node (either internal node or leaf) TO WHICH we evolving
-                2. **parent_node** is the node we are evolving FROM. Default of None is only called when the root sequence is not yet made.
-        '''
-        
-        # We are at the base and must generate root sequence
-        if (parent_node == None and current_node.root is True):
-            current_node.seq = self._generate_root_seq() # the .seq attribute is actually a list of Site() objects.
-        else:
-            assert(current_node.root is False), "\n\n Error: Non-root node interpreted as root."
-            current_node.seq = self._evolve_branch(current_node, parent_node) 
-        self._evolved_sites[current_node.name] = current_node.seq
-
-            
-        # We are at an internal node. Keep evolving
-        if len(current_node.children)>0:
-            for child_node in current_node.children:
-                self._sim_subtree(child_node, current_node)
-                
-        # We are at a leaf. Save the final sequence
-        else: 
-            self._leaf_sites[current_node.name] = current_node.seq
-
-        
-            
-            
-    def _check_parent_branch(self, parent_node, current_node):
-        ''' 
-            Function ensures that, for a given node we'd like to evolve to, an appropriate branch length exists. 
-            If the branch length is acceptable, an evolutionary model is then assigned to the node if one has yet been assigned.
+            Function ensures that, for a given node we'd like to evolve to, a parent sequence and an appropriate branch length exist. 
             
             Required positional arguments include,
-                1. **parent_node** is node FROM which we evolve
-                2. **current_node** is the node (either internal node or leaf) TO WHICH we evolve
+                1. **index** is the index, in the flattened tree, of the node (either internal node or leaf) TO WHICH we evolve
         '''
-        assert (parent_node.seq != None), "\n\nThere is no parent sequence from which to evolve!"
-        assert (current_node.branch_length >= 0.), "\n\n Your tree has a negative branch length. I'm going to quit now."
-        if current_node.model_flag is None:
-            current_node.model_flag = parent_node.model_flag
+        assert (self._tree.parent[index] >= 0), "\n\n Error: Non-root node interpreted as root."
+        assert (self._node_states[ self._tree.parent[index] ] is not None), "\n\nThere is no parent sequence from which to evolve!"
+        assert (self._tree.branch_length[index] >= 0.), "\n\n Your tree has a negative branch length. I'm going to quit now."
             
             
             
             
             
-    def _evolve_branch(self, current_node, parent_node):
+    def _jump_matrix(self, model, rate_class):
+        '''
+            Return the uniformization rate of a given Model's rate category, i.e. the largest total rate of leaving any state, and the offset cumulative rows (see _cumulative_rows()) of its jump matrix, I + Q/rate.
+            These are computed only once per Evolver for a given model and rate category.
+        '''
+        key = (id(model), rate_class)
+        if key not in self._jump_cache:
+            Q = self._rate_matrix(model, rate_class)
+            rate = np.max( -1. * np.diag(Q) )
+            if rate <= ZERO:
+                rate = 0.
+                jump = np.eye(len(Q))
+            else:
+                jump = np.maximum( np.eye(len(Q)) + Q / rate, 0. )
+            self._jump_cache[key] = (rate, self._cumulative_rows(jump))
+        return self._jump_cache[key]
+
+
+
+    def _uniformize_sites(self, model, rate_class, states, t, rng = None):
+        '''
+            Evolve the integer array *states* along a branch of length *t* under a given Model's rate category with uniformization, and return the new states and the number of substitutions at each site, as two arrays with the shape of *states*, as well as the matrix of substitution counts (see _count_substitutions()).
+            When simulating replicates, each replicate (along the leading axis of *states*) is evolved with its own random number generator. Otherwise, numbers are drawn from *rng*, or from self._rng if it is None.
+        '''
+        if self._rngs is not None:
+            results = [ self._uniformize(model, rate_class, states[r], t, self._rngs[r]) for r in range(len(self._rngs)) ]
+            return np.stack([ result[0] for result in results ]), np.stack([ result[1] for result in results ]), np.sum([ result[2] for result in results ], axis = 0)
+        if rng is None:
+            rng = self._rng
+        return self._uniformize(model, rate_class, states, t, rng)
+
+
+
+    def _uniformize(self, model, rate_class, states, t, rng):
+        '''
+            Evolve a one-dimensional integer array of *states* with uniformization, as described in _uniformize_sites(), drawing random numbers from the generator *rng*.
+            The number of jumps at each site is Poisson-distributed, with mean equal to the uniformization rate times *t*. Each jump moves a site according to the jump matrix, whose diagonal holds the probability of a virtual jump which leaves the state unchanged. At every step, all sites with jumps remaining are moved at once, and each real substitution is added to the returned matrix of substitution counts.
+        '''
+        rate, jumps = self._jump_matrix(model, rate_class)
+        new_states = np.array(states, dtype = np.intp)
+        events = np.zeros(len(new_states), dtype = np.int32)
+        counts = np.zeros([len(self._code), len(self._code)], dtype = np.int64)
+        num_jumps = rng.poisson(rate * t, size = len(new_states))
+        active = np.flatnonzero(num_jumps)
+        while len(active) > 0:
+            old = new_states[active]
+            new = self._search_cumulative(jumps, old, rng.random(len(active)))
+            counts += self._count_substitutions(old, new)
+            events[active[new != old]] += 1
+            new_states[active] = new
+            num_jumps[active] -= 1
+            active = active[num_jumps[active] > 0]
+        return new_states, events, counts
+
+
+
+    def _evolve_batched_sites(self, model, parent_seq, t, rng = None):
+        '''
+            Evolve the sites of a partition with a batched model, in which each site has its own rate matrix, along a branch of length *t*.
+            For every site, only the row of its transition matrix corresponding to the site's parent state is computed, either from the Model's cached eigendecomposition or (if this Evolver was given exponentiation = "expm") by exponentiating every site's matrix with scipy.linalg.expm.
+            Optional argument *rng* is passed to _draw_uniform().
+            Return the new states as an integer numpy array with the shape of *parent_seq*.
+        '''
+        states = np.asarray(parent_seq, dtype = np.intp)
+        if self.exponentiation == "eigen":
+            rows = model.transition_rows(t, states)
+        else:
+            from scipy import linalg
+            P = linalg.expm( model.matrix * t )
+            rows = P[np.arange(len(P)), states]
+        assert( np.allclose( np.sum(rows, axis = -1), 1.) ), "Rows in transition matrix do not each sum to 1."
+        return self._sample_from_rows(rows, self._draw_uniform(states.shape, rng))
+
+
+
+    def _evolve_branch(self, index, rng = None, cache = None):
         ''' 
-            Function to evolve a given sequence during tree traversal.
+            Function to evolve a given sequence during tree traversal. Returns the new list of state arrays, one per partition.
             
             Required positional arguments include, 
-                1. **current_node** is the node (either internal node or leaf) we are evolving TO
-                2. **parent_node** is the node we are evolving FROM.
+                1. **index** is the index, in the flattened tree, of the node (either internal node or leaf) we are evolving TO. We evolve FROM its parent, whose state arrays are in self._node_states.
+            
+            Optional positional arguments include,
+                1. **rng** is the random number generator for this branch. Default of None draws from self._rng.
+                2. **cache** is a dictionary of cumulative transition matrices, as returned by _precompute_transition_matrices(). Matrices missing from it are computed for this branch only. Default: None.
         '''
 
-        # Ensure parent sequence exists and branch length is acceptable. Return the model flag to use here.
-        self._check_parent_branch(parent_node, current_node)
+        # Ensure parent sequence exists and branch length is acceptable, and obtain the model flag to use here.
+        self._check_parent_branch(index)
+        parent_seq = self._node_states[ self._tree.parent[index] ]
+        branch_length = self._tree.branch_length[index]
+        model_flag = self._flags[ self._flag_ids[index] ]
+        name = self._tree.names[index]
  
-        # Evolve only if branch length is greater than 0 (1e-8). 
-        if current_node.branch_length <= ZERO:
-            new_seq = deepcopy(parent_node.seq)
+        # Evolve only if branch length is greater than 0 (1e-8). State arrays are never modified in place, so they may be shared with the parent.
+        events = [] # Number of substitutions at each site, per partition, when simulating with uniformization
+        counts = np.zeros([len(self._code), len(self._code)], dtype = np.int64) # Substitution counts along this branch, over all partitions
+        if branch_length <= ZERO:
+            new_seq = list(parent_seq)
+            events = [ np.zeros(part_seq.shape, dtype = np.int32) for part_seq in parent_seq ]
         
         else:
             new_seq = []            
@@ -532,36 +1401,49 @@ class Evolver(object):
             for p in range( len(self.partitions) ):
                 # Obtain current model for this partition at this branch
                 part = self.partitions[p]
-                current_model = self._obtain_model(part, current_node.model_flag)
-                index = 0
-                part_new_seq = []  # will temporarily store this partition's new sequence
-                
+                current_model = self._obtain_model(part, model_flag)
+                start = 0
+                part_parent_seq = parent_seq[p]
+                part_new_seq = np.empty_like(part_parent_seq)  # will store this partition's new sequence
+                part_events = np.zeros(part_parent_seq.shape, dtype = np.int32)
                 
                 
-                for i in range( current_model.num_classes() ):
-                    # Grab instantaneous rate matrix, which is done differently depending if codon (dN/dS) model or not. This is the rate het in the partition.
-                    Q_matrix = None
-                    if current_model.is_hetcodon_model():
-                        Q_matrix = current_model.matrix[i]
-                    else:
-                        Q_matrix = current_model.matrix * current_model.rate_factors[i] # note that rate_factors = [1.] if no site heterogeneity, so matrix unchanged
-                    assert( Q_matrix is not None ), "\n\nCouldn't retrieve instantaneous rate matrix."
+                # Batched models have one matrix per site. Only the rows of each site's transition matrix for the parent states are computed, so these are not cached.
+                if current_model.is_batched_model():
+                    part_new_seq[...] = self._evolve_batched_sites(current_model, part_parent_seq, self.scale_tree * float(branch_length), rng)
                     
-                    # Generate transition matrix
-                    P_matrix = self._exponentiate_matrix(Q_matrix, self.scale_tree * float(current_node.branch_length))
-                
-                    # Evolve branch
-                    part_parent_seq = parent_node.seq[p][index : index + part.size[i]]
-                    for j in range( part.size[i] ):
-                        new_site = deepcopy( part_parent_seq[j] )
-                        new_site.int_seq = self._generate_prob_from_unif( P_matrix[ new_site.int_seq ] )
-                        part_new_seq.append( new_site )
-                        index += 1
+                else:
+                    for i in range( current_model.num_classes() ):
+                        t = self.scale_tree * float(branch_length)
+                        sites = slice(start, start + part.size[i]) # Sites are stored contiguously by rate class, along the last axis.
+                        
+                        if self.engine == "uniformization":
+                            part_new_seq[..., sites], part_events[..., sites], class_counts = self._uniformize_sites(current_model, i, part_parent_seq[..., sites], t, rng)
+                            counts += class_counts
+                        
+                        else:
+                            # Obtain the cumulative rows of the transition matrix for this rate class, used to sample all sites in this rate class at once. These are usually precomputed for a chunk of branches. Missing ones are computed as a batch of one, which gives exactly the same matrix as a larger batch.
+                            key = (id(current_model), i, t)
+                            if cache is not None and key in cache:
+                                cumulative = cache[key]
+                            else:
+                                cumulative = self._cumulative_rows( self._exponentiate_matrix(current_model, i, np.array([t])) )[0]
+                            part_new_seq[..., sites] = self._sample_from_cumulative(cumulative, part_parent_seq[..., sites], rng)
+                        start += part.size[i]
                 new_seq.append( part_new_seq )
+                events.append( part_events )
         
-                #### In-house project, substitution counts ####  
-                self.compare_sequences(part_parent_seq, part_new_seq)
+                #### In-house project, substitution counts. Uniformization already counted each substitution as it happened. ####  
+                if self.engine != "uniformization":
+                    counts += self._count_substitutions(part_parent_seq, part_new_seq)
         
+        with self._counts_lock:
+            self.substitution_counts += counts
+        if self._record_events:
+            self._event_counts[name] = events
+        if self._record_branch_counts:
+            nonzero = np.flatnonzero(counts)
+            self._branch_counts[name] = (nonzero, counts.ravel()[nonzero])
         return new_seq
 
         
@@ -10,11 +10,24 @@
     This module contains various genetic definitions and mappings used throughout pyvolve.
 '''
 
+import numpy as np
+
 
 class Genetics():
     '''
         Molecular alphabet objects.
+        
+        In addition to lists of states, Genetics objects provide read-only numpy tables relating all pairs of codons, indexed as [source codon index, target codon index], with codons indexed alphabetically (as in the codons attribute):
+            1. **codon_n_diff**, the number of nucleotide differences between the two codons
+            2. **codon_diff_position**, the position (0, 1, or 2) at which codons differing by a single nucleotide differ, and -1 for all other pairs
+            3. **codon_source_nuc** and **codon_target_nuc**, the indices (in the nucleotides attribute) of the source and target nucleotides of codons differing by a single nucleotide, and -1 for all other pairs
+            4. **codon_syn**, True if both codons code for the same amino acid
+            5. **codon_ti**, True if the codons differ by a single nucleotide transition
+            6. **codon_num_ti**, the number of nucleotide differences between the two codons which are transitions
+        Also provided are **codon_amino_acids**, the index (in the amino_acids attribute) of the amino acid coded by each codon, and the dictionary **codon_indices** of codon : codon index.
+        These tables are built only once per process, upon first use, and are shared by all Genetics objects.
     '''
+    _pair_tables = {} # Tables computed by pair_tables(), shared by all instances and keyed by the tuple of states
     
     def __init__(self):
         '''
@@ -28,6 +41,73 @@ class Genetics():
         self.codon_dict   = {"AAA":"K", "AAC":"N", "AAG":"K", "AAT":"N", "ACA":"T", "ACC":"T", "ACG":"T", "ACT":"T", "AGA":"R", "AGC":"S", "AGG":"R", "AGT":"S", "ATA":"I", "ATC":"I", "ATG":"M", "ATT":"I", "CAA":"Q", "CAC":"H", "CAG":"Q", "CAT":"H", "CCA":"P", "CCC":"P", "CCG":"P", "CCT":"P", "CGA":"R", "CGC":"R", "CGG":"R", "CGT":"R", "CTA":"L", "CTC":"L", "CTG":"L", "CTT":"L", "GAA":"E", "GAC":"D", "GAG":"E", "GAT":"D", "GCA":"A", "GCC":"A", "GCG":"A", "GCT":"A", "GGA":"G", "GGC":"G", "GGG":"G", "GGT":"G", "GTA":"V", "GTC":"V", "GTG":"V", "GTT":"V", "TAC":"Y", "TAT":"Y", "TCA":"S", "TCC":"S", "TCG":"S", "TCT":"S", "TGC":"C", "TGG":"W", "TGT":"C", "TTA":"L", "TTC":"F", "TTG":"L", "TTT":"F"}
         self.codons       = ["AAA", "AAC", "AAG", "AAT", "ACA", "ACC", "ACG", "ACT", "AGA", "AGC", "AGG", "AGT", "ATA", "ATC", "ATG", "ATT", "CAA", "CAC", "CAG", "CAT", "CCA", "CCC", "CCG", "CCT", "CGA", "CGC", "CGG", "CGT", "CTA", "CTC", "CTG", "CTT", "GAA", "GAC", "GAG", "GAT", "GCA", "GCC", "GCG", "GCT", "GGA", "GGC", "GGG", "GGT", "GTA", "GTC", "GTG", "GTT", "TAC", "TAT", "TCA", "TCC", "TCG", "TCT", "TGC", "TGG", "TGT", "TTA", "TTC", "TTG", "TTT"]
         self.stop_codons  = ["TAA", "TAG", "TGA"]     
+        self.codon_indices = dict( (self.codons[i], i) for i in range(len(self.codons)) )
+        
+        
+        
+    def pair_tables(self, states):
+        '''
+            Return a dictionary of read-only numpy tables relating all pairs of states, indexed as [source, target], for a list of states which are nucleotides or codons.
+            The dictionary has keys "n_diff", "diff_position", "source_nuc", "target_nuc", "ti", and "num_ti", which are described for codons in the class documentation. If states are codons, it also has the key "syn". 
+            Tables are computed only once per list of states, and cached for all Genetics objects.
+        '''
+        key = tuple(states)
+        if key not in Genetics._pair_tables:
+            size = len(states)
+            nucs = np.array( [ [self.nucleotides.index(nuc) for nuc in state] for state in states ] )
+            diff = nucs[:, np.newaxis, :] != nucs[np.newaxis, :, :]
+            n_diff = np.sum(diff, axis = 2)
+            single = n_diff == 1
+            position = np.argmax(diff, axis = 2)
+            same_class = (nucs[:, np.newaxis, :] % 2) == (nucs[np.newaxis, :, :] % 2) # Purines (A, G) have even indices, and pyrimidines (C, T) odd
+            num_ti = np.sum(diff & same_class, axis = 2)
+            tables = {"n_diff":        n_diff.astype(np.int8),
+                      "diff_position": np.where(single, position, -1).astype(np.int8),
+                      "source_nuc":    np.where(single, nucs[np.arange(size)[:, np.newaxis], position], -1).astype(np.int8),
+                      "target_nuc":    np.where(single, nucs[np.arange(size)[np.newaxis, :], position], -1).astype(np.int8),
+                      "ti":            single & (num_ti == 1),
+                      "num_ti":        num_ti.astype(np.int8)}
+            if key == tuple(self.codons):
+                amino_acids = np.array( [self.amino_acids.index(self.codon_dict[codon]) for codon in self.codons], dtype = np.int8 )
+                tables["syn"] = amino_acids[:, np.newaxis] == amino_acids[np.newaxis, :]
+                tables["amino_acids"] = amino_acids
+            for table in tables.values():
+                table.setflags(write = False)
+            Genetics._pair_tables[key] = tables
+        return Genetics._pair_tables[key]
+    
+    
+    @property
+    def codon_n_diff(self):
+        return self.pair_tables(self.codons)["n_diff"]
+    
+    @property
+    def codon_diff_position(self):
+        return self.pair_tables(self.codons)["diff_position"]
+        
+    @property
+    def codon_source_nuc(self):
+        return self.pair_tables(self.codons)["source_nuc"]
+    
+    @property
+    def codon_target_nuc(self):
+        return self.pair_tables(self.codons)["target_nuc"]
+
+    @property
+    def codon_syn(self):
+        return self.pair_tables(self.codons)["syn"]
+    
+    @property
+    def codon_ti(self):
+        return self.pair_tables(self.codons)["ti"]
+    
+    @property
+    def codon_num_ti(self):
+        return self.pair_tables(self.codons)["num_ti"]
+    
+    @property
+    def codon_amino_acids(self):
+        return self.pair_tables(self.codons)["amino_acids"]
 
     
 
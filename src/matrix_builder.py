@@ -16,12 +16,28 @@
 
 
 import numpy as np
-from scipy import linalg
+import threading
+from collections import OrderedDict
 from copy import deepcopy
 from .genetics import *
 from .state_freqs import *
 ZERO      = 1e-8
 MOLECULES = Genetics()
+SCALING_CACHE_SIZE = 256 # Maximum number of matrix scaling factors kept by MatrixBuilder, shared by all models in a process
+
+
+
+def _scaling_key(value):
+    '''
+        Convert a (possibly nested) dictionary of matrix scaling parameters into a hashable key. Lists and arrays are keyed by their shape and contents.
+    '''
+    if isinstance(value, dict):
+        return tuple( (key, _scaling_key(value[key])) for key in sorted(value) )
+    elif isinstance(value, (list, tuple, np.ndarray)):
+        array = np.asarray(value, dtype = float)
+        return (array.shape, array.tobytes())
+    else:
+        return value
 
 
 class MatrixBuilder(object):
@@ -40,7 +56,10 @@ class MatrixBuilder(object):
             5. *MutSel_Matrix* 
                 - Mutation-selection model (Halpern and Bruno 1998), extended for either codon or nucleotides
         
+        Scaling factors computed from a separate scaling matrix (for average or neutral scaling) depend only on the parameters returned by _build_scaling_params(). They are therefore cached, keyed by these parameters, so that models sharing them (e.g. many mutation-selection models with the same mutation rates) build the scaling matrix only once. The SCALING_CACHE_SIZE most recently used factors are kept.
     '''
+    _scaling_factors = OrderedDict() # Cached scaling factors, shared by all instances and ordered from least to most recently used
+    _scaling_lock    = threading.Lock()
     
     def __init__(self, model_type, parameters):
         '''
@@ -54,22 +73,47 @@ class MatrixBuilder(object):
 
     def _build_matrix( self, parameters = None):
         ''' 
-            Generate an instantaneous rate matrix.
+            Generate an instantaneous rate matrix, or a stack of matrices (with one matrix along the leading axis per site) for batched models.
         '''    
         if parameters is None:
             parameters = self.params
-        matrix = np.zeros( [self._size, self._size] ) # For nucleotides, self._size = 4; amino acids, self._size = 20; codons, self._size = 61.
+        matrix = np.array( self._calc_instantaneous_matrix(parameters), dtype = float ) # For nucleotides, self._size = 4; amino acids, self._size = 20; codons, self._size = 61.
+            
+        # Fill in the diagonal positions so rows sum to 0, but ensure they don't become -0
+        diagonal = -1. * np.sum(matrix, axis = -1)
+        diagonal[diagonal == 0.] = 0.
+        matrix[..., np.arange(self._size), np.arange(self._size)] = diagonal
+        assert ( np.all(np.abs(np.sum(matrix, axis = -1)) < ZERO) ), "\n\nRow in instantaneous matrix does not sum to 0."
+        return matrix
+
+
+
+    def _calc_instantaneous_matrix(self, parameters):
+        '''
+            Return a matrix of the substitution probabilities between all states. Diagonal entries are replaced by _build_matrix().
+            Child classes compute this matrix with array operations, but this parent class function falls back to calling _calc_instantaneous_prob() for each entry.
+        '''
+        matrix = np.zeros( [self._size, self._size] )
         for s in range(self._size):
             for t in range(self._size):
-                # Non-diagonal
-                rate = self._calc_instantaneous_prob( s, t, parameters )                
-                matrix[s][t] = rate
-                
-            # Fill in the diagonal position so the row sums to 0, but ensure it doesn't became -0
-            matrix[s][s]= -1. * np.sum( matrix[s] )
-            if matrix[s][s] == -0.:
-                matrix[s][s] = 0.
-            assert ( abs(np.sum(matrix[s])) < ZERO ), "\n\nRow in instantaneous matrix does not sum to 0."
+                matrix[s][t] = self._calc_instantaneous_prob( s, t, parameters )
+        return matrix
+
+
+
+    def _mu_matrix(self, mu, symmetric):
+        '''
+            Return a 4x4 numpy array of nucleotide mutation rates from the dictionary *mu*, with 0 along the diagonal.
+            If *symmetric* is True, the rate between two nucleotides is read from their alphabetically sorted key (e.g. "AC" for both A->C and C->A). Otherwise, rates are directional (e.g. "CA" for C->A).
+        '''
+        matrix = np.zeros([4, 4])
+        for i in range(4):
+            for j in range(4):
+                if i != j:
+                    pair = MOLECULES.nucleotides[i] + MOLECULES.nucleotides[j]
+                    if symmetric:
+                        pair = "".join(sorted(pair))
+                    matrix[i][j] = mu[pair]
         return matrix
 
 
@@ -93,8 +137,18 @@ class MatrixBuilder(object):
         if self.scale_matrix == "persite":
             factor = self._scaling_factor_from_matrix(self.params["state_freqs"], self.inst_matrix)
         else:
-            frequencies, matrix = self._build_scaling_matrix()
-            factor = self._scaling_factor_from_matrix(frequencies, matrix)
+            key = (type(self).__name__, self.model_type, self.scale_matrix, _scaling_key(self._build_scaling_params()))
+            with MatrixBuilder._scaling_lock:
+                factor = MatrixBuilder._scaling_factors.get(key)
+                if factor is not None:
+                    MatrixBuilder._scaling_factors.move_to_end(key)
+            if factor is None:
+                frequencies, matrix = self._build_scaling_matrix()
+                factor = self._scaling_factor_from_matrix(frequencies, matrix)
+                with MatrixBuilder._scaling_lock:
+                    MatrixBuilder._scaling_factors[key] = factor
+                    while len(MatrixBuilder._scaling_factors) > SCALING_CACHE_SIZE:
+                        MatrixBuilder._scaling_factors.popitem(last = False)
         
         return factor            
 
@@ -165,12 +219,7 @@ class MatrixBuilder(object):
             Arguments arguments "source" and "target" are codon indices (0-60, alphabetical).
         '''
         
-        source_codon = MOLECULES.codons[source]
-        target_codon = MOLECULES.codons[target]
-        if ( MOLECULES.codon_dict[source_codon] == MOLECULES.codon_dict[target_codon] ):
-            return True
-        else:
-            return False           
+        return bool( MOLECULES.codon_syn[source, target] )
     
     
     
@@ -232,6 +281,14 @@ class AminoAcid_Matrix(MatrixBuilder):
 
 
 
+    def _calc_instantaneous_matrix(self, parameters):
+        ''' 
+            Returns the matrix of substitution probabilities between all amino acids, as in _calc_instantaneous_prob.
+        '''
+        return np.array(self.emp_matrix, dtype = float) * np.array(parameters['state_freqs'], dtype = float)[np.newaxis, :]
+
+
+
 
 
 
@@ -265,6 +322,14 @@ class Nucleotide_Matrix(MatrixBuilder):
 
 
 
+    def _calc_instantaneous_matrix(self, parameters):
+        ''' 
+            Returns the matrix of substitution probabilities between all nucleotides, as in _calc_instantaneous_prob.
+        '''
+        return self._mu_matrix(parameters['mu'], symmetric = True) * np.array(parameters['state_freqs'], dtype = float)[np.newaxis, :]
+
+
+
 
 
 
@@ -333,11 +398,29 @@ class MechCodon_Matrix(MatrixBuilder):
                 return self._calc_prob(target, nuc_diff[1], nuc_pair, parameters['beta'])
 
 
+
+    def _calc_instantaneous_matrix(self, parameters):
+        ''' 
+            Returns the matrix of substitution probabilities between all codons, as in _calc_instantaneous_prob.
+        ''' 
+        tables = MOLECULES.pair_tables(self._code)
+        single = tables["n_diff"] == 1
+        matrix = self._mu_matrix(self.params['mu'], symmetric = True)[tables["source_nuc"], tables["target_nuc"]]
+        matrix *= np.where(tables["syn"], parameters['alpha'], parameters['beta'])
+        if self.model_type == 'gy':
+            matrix *= np.array(self.params['state_freqs'], dtype = float)[np.newaxis, :]
+        else:
+            matrix *= np.array(self.params["nuc_freqs"], dtype = float)[tables["target_nuc"]]
+        return np.where(single, matrix, 0.)
+
+
     def _build_scaling_params(self):
         '''
-            Build scaling parameters for a dN/dS model.
+            Build scaling parameters for a dN/dS model. MG-style models also include their nucleotide frequencies, on which the scaling matrix depends.
         '''
         new_parameters = {"alpha": 1., "state_freqs": self.params["state_freqs"], "mu": self.params["mu"]} 
+        if self.model_type != 'gy':
+            new_parameters["nuc_freqs"] = self.params["nuc_freqs"]
         if self.scale_matrix == "average":
             try:
                 new_parameters["beta"] = self.params["hetmodel_mean_dnds"]
@@ -361,15 +444,15 @@ class MutSel_Matrix(MatrixBuilder):
     ''' 
         Child class of MatrixBuilder. This class implements functions relevant to constructing mutation-selection balance model instantaneous matrices, according to the HalpernBruno 1998 model.
         Here, this model is extended such that it can be used for either nucleotide or codon. This class will automatically detect which one you want based on the provided state frequencies or fitness values.
-
+        When state frequencies or fitness values are given as a 2D array with one row per site, a stack of matrices (one per site) is built at once. All sites share the same neutral scaling factor, since it depends only on mutation rates.
     '''
 
     def __init__(self, *args):
         super(MutSel_Matrix, self).__init__(*args)
         try:
-            self._size = len(self.params["state_freqs"])
+            self._size = np.shape(self.params["state_freqs"])[-1]
         except:
-            self._size = len(self.params["fitness"])
+            self._size = np.shape(self.params["fitness"])[-1]
         self.scale_matrix = "neutral"
         if self._size == 4:
             self._code = MOLECULES.nucleotides
@@ -445,15 +528,44 @@ class MutSel_Matrix(MatrixBuilder):
           
             return fixation_rate * parameters['mu'][nuc_diff]
             
+
+
+    def _calc_instantaneous_matrix(self, parameters):
+        ''' 
+            Returns the matrix of substitution probabilities between all codons or nucleotides, as in _calc_instantaneous_prob.
+            If state frequencies or fitness values are a 2D array, returns a stack of matrices with one matrix per row.
+        '''
+        tables = MOLECULES.pair_tables(self._code)
+        single = tables["n_diff"] == 1
+        mu = self._mu_matrix(parameters['mu'], symmetric = False)
+        mu_ij = mu[tables["source_nuc"], tables["target_nuc"]]
+        
+        with np.errstate(divide = 'ignore', invalid = 'ignore', over = 'ignore'):
+            if self.params["calc_by_freqs"]:
+                pi = np.array(parameters['state_freqs'], dtype = float)
+                pi_i = pi[..., :, np.newaxis]
+                pi_j = pi[..., np.newaxis, :]
+                mu_ji = mu[tables["target_nuc"], tables["source_nuc"]]
+                pi_mu = (mu_ji*pi_j)/(mu_ij*pi_i)
+                fixation_rate = np.where( np.abs(1. - pi_mu) <= ZERO, 1., np.log(pi_mu)/(1. - 1./pi_mu) )
+                fixation_rate = np.where( (np.abs(pi_i) <= ZERO) | (np.abs(pi_j) <= ZERO), 0., fixation_rate )
+            else:
+                fitness = np.array(parameters['fitness'], dtype = float)
+                sij = fitness[..., np.newaxis, :] - fitness[..., :, np.newaxis]
+                fixation_rate = np.where( np.abs(sij) <= ZERO, 1., sij/(1. - np.exp(-1.*sij)) )
+        
+        return np.where(single, fixation_rate * mu_ij, 0.)
+            
  
  
     def _build_scaling_params(self):
         '''
             Build scaling parameters for a mutation-selection model. Note that only neutral scaling is allowed.
+            Whether the model is built from state frequencies or fitness values is also included, since the scaling matrix depends on it.
         '''
         assert(self.scale_matrix == "neutral"), "\n\nCan only construct a mutation-selection model scaling factor under 'neutral' scaling."
 
-        new_parameters = {"mu": self.params["mu"]}         
+        new_parameters = {"mu": self.params["mu"], "calc_by_freqs": self.params["calc_by_freqs"]}         
         new_parameters["state_freqs"] = np.repeat(1./self._size, self._size)
         new_parameters["fitness"] = np.ones(self._size)
             
@@ -527,6 +639,22 @@ class ECM_Matrix(MatrixBuilder):
 
 
 
+    def _calc_instantaneous_matrix(self, parameters):
+        ''' 
+            Returns the matrix of substitution probabilities between all codons, as in _calc_instantaneous_prob.
+        '''  
+        tables = MOLECULES.pair_tables(self._code)
+        if self.restricted:
+            allowed = tables["n_diff"] == 1
+        else:
+            allowed = tables["n_diff"] > 0
+        kappa_param = float(self.params['k_ti'])**tables["num_ti"] * float(self.params['k_tv'])**(tables["n_diff"] - tables["num_ti"])
+        matrix = np.array(self.emp_matrix, dtype = float) * np.array(parameters['state_freqs'], dtype = float)[np.newaxis, :] * kappa_param
+        matrix *= np.where(tables["syn"], parameters['alpha'], parameters['beta'])
+        return np.where(allowed, matrix, 0.)
+
+
+
 
 
 
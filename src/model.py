@@ -16,10 +16,189 @@ from copy import deepcopy
 from .matrix_builder import *
 from .genetics import *
 from .parameters_sanity import *
-from scipy.stats import gamma
-from scipy.special import gammainc
 ZERO      = 1e-8
 MOLECULES = Genetics()
+MAX_EIGENVECTOR_CONDITION = 1e8 # Eigenvector matrices with a larger condition number are treated as defective
+
+
+
+class MatrixDecomposition():
+    '''
+        This class holds the eigendecomposition of an instantaneous rate matrix, Q, such that the transition matrix P(t) = exp(Qt) can be computed for any time t by simply rescaling the eigenvalues.
+        Reversible matrices are symmetrized with their stationary frequencies and decomposed with a symmetric eigensolver, which is both faster and more accurate. All other matrices use a general eigendecomposition.
+        If the matrix is defective (its eigenvectors are numerically linearly dependent), no decomposition is stored and P(t) is instead computed with scipy.linalg.expm.
+        A stack of matrices (with one matrix per site along the leading axis, as used by batched models) may also be decomposed, in which case all matrices are decomposed at once and are treated as reversible (or defective) only if all of them are.
+    '''
+    
+    def __init__(self, matrix, state_freqs = None):
+        '''
+            Requires a single positional argument, **matrix**, the instantaneous rate matrix (or stack of matrices) to decompose.
+            A second positional argument, **state_freqs**, gives the stationary frequencies of the matrix (or one row of frequencies per matrix in a stack). These are used to detect reversibility, and the general eigendecomposition is used when they are not provided.
+        '''
+        self.matrix      = np.array(matrix, dtype = float)
+        self.reversible  = False
+        self.defective   = False
+        self.eigenvalues = None
+        self._left       = None # Eigenvectors, such that Q = self._left * diag(self.eigenvalues) * self._right
+        self._right      = None 
+        
+        if state_freqs is not None and self._is_reversible(np.array(state_freqs, dtype = float)):
+            self._decompose_symmetric(np.array(state_freqs, dtype = float))
+        else:
+            self._decompose_general()
+
+
+
+    def _is_reversible(self, state_freqs):
+        '''
+            Return True if the matrix satisfies detailed balance with the given stationary frequencies (all of which must be non-zero), and False otherwise.
+        '''
+        if np.any(state_freqs <= ZERO):
+            return False
+        flux = state_freqs[..., :, np.newaxis] * self.matrix
+        return np.allclose(flux, np.swapaxes(flux, -1, -2), rtol = 1e-6, atol = 1e-12)
+
+
+
+    def _decompose_symmetric(self, state_freqs):
+        '''
+            Decompose a reversible matrix through its symmetric counterpart, S = D^(1/2) Q D^(-1/2), where D is the diagonal matrix of stationary frequencies.
+        '''
+        sqrt_freqs = np.sqrt(state_freqs)
+        symmetric = self.matrix * sqrt_freqs[..., :, np.newaxis] / sqrt_freqs[..., np.newaxis, :]
+        symmetric = 0.5 * (symmetric + np.swapaxes(symmetric, -1, -2)) # remove rounding asymmetry
+        if symmetric.ndim == 2:
+            from scipy import linalg
+            (w, v) = linalg.eigh(symmetric)
+        else:
+            (w, v) = np.linalg.eigh(symmetric) # scipy's solver only accepts a single matrix
+        self.eigenvalues = w
+        self._left  = v / sqrt_freqs[..., :, np.newaxis]
+        self._right = np.swapaxes(v, -1, -2) * sqrt_freqs[..., np.newaxis, :]
+        self.reversible = True
+
+
+
+    def _decompose_general(self):
+        '''
+            Decompose a matrix with a general (possibly complex) eigendecomposition, flagging the matrix as defective if its eigenvectors cannot be reliably inverted.
+        '''
+        if self.matrix.ndim == 2:
+            from scipy import linalg
+            (w, v) = linalg.eig(self.matrix)
+        else:
+            (w, v) = np.linalg.eig(self.matrix) # scipy's solver only accepts a single matrix
+        if not np.all(np.isfinite(v)) or np.max(np.linalg.cond(v)) > MAX_EIGENVECTOR_CONDITION:
+            self.defective = True
+        else:
+            self.eigenvalues = w
+            self._left  = v
+            self._right = np.linalg.inv(v)
+
+
+
+    def exponentiate(self, t):
+        '''
+            Return the transition matrix P(t) = exp(Qt). 
+            Argument **t** may be a single time, giving a single matrix, or an array of times, giving an array of matrices with shape t.shape + Q.shape. For a stack of matrices, Q.shape includes the leading axis of the stack.
+        '''
+        t = np.asarray(t, dtype = float)
+        if self.defective:
+            from scipy import linalg
+            P = np.array([ linalg.expm(self.matrix * time) for time in t.ravel() ])
+            P = P.reshape( t.shape + self.matrix.shape )
+        else:
+            exp_eigenvalues = np.exp( np.multiply.outer(t, self.eigenvalues) )
+            P = np.matmul( self._left * exp_eigenvalues[..., np.newaxis, :], self._right )
+            if not self.reversible:
+                P = P.real
+        # Remove tiny negative probabilities arising from rounding error
+        return np.maximum(P, 0.)
+
+
+
+    def exponentiate_rows(self, t, states):
+        '''
+            For a stack of matrices, return only the rows of the transition matrices P(t) = exp(Qt) which are needed to evolve a sequence with one site per matrix, without computing every full matrix.
+            Argument **t** is a single time, and argument **states** is an integer array of the current state at each site, whose last axis has one entry per matrix in the stack (further leading axes, e.g. for replicates, are allowed).
+            Returns an array with shape states.shape + (number of states,), where the entry for each site is row states[..., site] of P(t) for that site's matrix.
+        '''
+        sites = np.arange(self.matrix.shape[0])
+        if self.defective:
+            return self.exponentiate(t)[sites, states]
+        left = self._left[sites, states] * np.exp(self.eigenvalues * float(t))
+        P = np.einsum('...sk,skj->...sj', left, self._right)
+        if not self.reversible:
+            P = P.real
+        return np.maximum(P, 0.)
+
+
+
+
+class NucleotideTransitions():
+    '''
+        This class computes transition matrices P(t) = exp(Qt) in closed form for nucleotide rate matrices of the TN93 family, which includes JC69, K80, F81, and HKY85. Neither an eigendecomposition nor scipy.linalg.expm is needed.
+        These matrices have entries Q_ij = r_ij * pi_j, where pi are the stationary frequencies, the exchangeabilities r are symmetric, and all four transversions share a single rate. The two transition rates (A<->G and C<->T) may differ.
+        Use the static method from_matrix() to detect whether a given matrix belongs to this family.
+    '''
+    
+    def __init__(self, state_freqs, purine_rate, pyrimidine_rate, transversion_rate):
+        '''
+            Requires four positional arguments, 
+                1. **state_freqs**, the stationary frequencies of A, C, G, and T, all of which must be non-zero
+                2. **purine_rate**, the A<->G exchangeability
+                3. **pyrimidine_rate**, the C<->T exchangeability
+                4. **transversion_rate**, the exchangeability shared by all transversions
+        '''
+        self.state_freqs = np.array(state_freqs, dtype = float)
+        self.reversible  = True
+        self.defective   = False
+        
+        # P(t) is the sum of four constant matrices, each weighted by exp(-rate * t) for one of the rates below (the negated eigenvalues of Q)
+        purine = np.array([True, False, True, False])
+        group_freqs = np.where(purine, np.sum(self.state_freqs[purine]), np.sum(self.state_freqs[~purine])) # Total frequency of the group (purines or pyrimidines) of each nucleotide
+        same_group = purine[:, np.newaxis] == purine[np.newaxis, :]
+        self._rates = np.array([0., 
+                                transversion_rate, 
+                                group_freqs[0] * purine_rate + group_freqs[1] * transversion_rate, 
+                                group_freqs[1] * pyrimidine_rate + group_freqs[0] * transversion_rate])
+        self._basis = np.zeros([4, 4, 4])
+        self._basis[0] = self.state_freqs[np.newaxis, :]
+        self._basis[1] = np.where(same_group, self.state_freqs * (1. - group_freqs) / group_freqs, -1. * self.state_freqs)
+        self._basis[2] = np.where(same_group & purine[np.newaxis, :], np.eye(4) - self.state_freqs / group_freqs, 0.)
+        self._basis[3] = np.where(same_group & ~purine[np.newaxis, :], np.eye(4) - self.state_freqs / group_freqs, 0.)
+        self._basis = self._basis.reshape(4, 16)
+
+
+
+    @staticmethod
+    def from_matrix(matrix, state_freqs):
+        '''
+            Return a NucleotideTransitions object for the 4x4 rate *matrix* with stationary frequencies *state_freqs* if this matrix belongs to the TN93 family, and return None otherwise.
+        '''
+        matrix = np.asarray(matrix, dtype = float)
+        state_freqs = np.asarray(state_freqs, dtype = float)
+        if matrix.shape != (4,4) or np.any(state_freqs <= ZERO):
+            return None
+        rates = matrix / state_freqs[np.newaxis, :]
+        transversions = rates[[0, 0, 1, 2], [1, 3, 2, 3]]
+        if not np.allclose(rates, rates.T, rtol = 1e-10, atol = 0.) or not np.allclose(transversions, transversions[0], rtol = 1e-10, atol = 0.):
+            return None
+        return NucleotideTransitions(state_freqs, rates[0][2], rates[1][3], transversions[0])
+        
+
+
+    def exponentiate(self, t):
+        '''
+            Return the transition matrix P(t) = exp(Qt). 
+            Argument **t** may be a single time, giving a single matrix, or an array of times (e.g. all branch lengths of a tree), giving an array of matrices with shape t.shape + (4, 4).
+        '''
+        t = np.asarray(t, dtype = float)
+        P = np.matmul( np.exp( -1. * np.multiply.outer(t, self._rates) ), self._basis ).reshape( t.shape + (4, 4) )
+        return np.maximum(P, 0.)
+
+
+
 
 class Model():
     ''' 
@@ -88,6 +267,8 @@ class Model():
             If you wish to evolve *custom states* (neither nucleotide, amino acids, nor codons), for instance to evolve characters, also include the key "code" in the parameters dictionary. The associated value should be a list of strings, e.g. ["0", "1", "2"], and the length of this list should be the same as a dimension of the square custom matrix provided. Note that this argument is not required if wish to evolve nucleotides, amino-acids, and/or codons. 
             If you supply equilibrium frequencies for your custom model ("state_freqs" key in parameters dictionary), pyvolve will require a corresponding symmetric matrix, and the final substitution matrix will be calculated from your symmetric matrix and the provided frequencies. If frequencies are not provided, then they will be calculated directly from your provided matrix. In this circumstance, your matrix will be taken at face value.
             
+            Mutation-selection models may also be built for many sites at once, for instance from a set of site-wise fitness profiles: provide the "state_freqs" or "fitness" values in the parameters dictionary as a 2D array with one row per site. This creates a single *batched* Model holding a stack of rate matrices, one per site, and a Partition using it evolves its sites in order, with each site under its own matrix. Batched models do not support rate heterogeneity.
+            
             A second positional argument, **parameters** may additionally be specified. This argument should be a dictionary of parameters pertaining to substitution process. Each individual evolutionary model will have its own parameters. Note that if this argument is not provided, default parameters for your selected model will be assigned. Note that this argument is **required** for mechanistic codon (dN/dS) models, as this rate ratio must be assigned!
             
                             
@@ -118,6 +299,8 @@ class Model():
         self._save_custom_matrix_freqs = kwargs.get('save_custom_frequencies', "custom_matrix_frequencies.txt")
         self.neutral_scaling           = kwargs.get('neutral_scaling', False)
         self.code                      = None
+        self.batched_model             = False # True for mutation-selection models built from one row of state frequencies or fitness values per site
+        self._decompositions           = None # MatrixDecomposition(s) of the rate matrix (or matrices), computed upon first use by .transition_matrix()
         
         # There are lots of these
         self.aa_models    = ['jc69', 'jtt', 'wag', 'lg', 'ab', 'mtmam', 'mtrev24', 'dayhoff', 'hivb', 'hivw', 'gcprev', 'mtmet', 'mtinv', 'mtver']
@@ -136,7 +319,7 @@ class Model():
         if "code" in self.params:
             self.code = self.params["code"]
         else:
-            dim = len(self.params['state_freqs']) 
+            dim = np.shape(self.params['state_freqs'])[-1]
             if dim == 4:
                 self.code = MOLECULES.nucleotides
             elif dim == 20:
@@ -250,10 +433,16 @@ class Model():
         elif self.model_type == 'mutsel':
             self.params = MutSel_Sanity(self.model_type, self.params)()
             self.matrix = MutSel_Matrix(self.model_type, self.params)()
+            self.batched_model = self.matrix.ndim == 3
+            if self.batched_model:
+                assert( len(self.rate_probs) == 1 ), "\n\nBatched mutation-selection models (with one row of state frequencies or fitness values per site) do not support rate heterogeneity."
             
             # Need to construct and add frequencies to the model dictionary if the matrix was built with fitness values
             if not self.params["calc_by_freqs"]:
-                self._calculate_state_freqs_from_matrix()
+                if self.batched_model:
+                    self._calculate_batched_state_freqs_from_matrix()
+                else:
+                    self._calculate_state_freqs_from_matrix()
         
         
         elif self.model_type == 'custom':
@@ -340,6 +529,7 @@ class Model():
         size = self.matrix.shape[0]
         
         # Find maximum eigenvalue, index
+        from scipy import linalg
         (w, v) = linalg.eig(self.matrix, left=True, right=False)
         max_i = np.argmax(w)
         max_w = w[max_i]
@@ -365,6 +555,27 @@ class Model():
 
 
 
+    def _calculate_batched_state_freqs_from_matrix(self):
+        '''
+            Determine the state frequencies of every matrix in the stack of a batched model, which was built using fitness values.
+            Rather than eigendecomposing each matrix, the linear system pi Q = 0 (with the last equation replaced by sum(pi) = 1) is solved for all matrices at once.
+        '''
+        (num_sites, size, size) = self.matrix.shape
+        system = np.swapaxes(self.matrix, -1, -2).copy()
+        system[:, -1, :] = 1.
+        target = np.zeros([num_sites, size, 1])
+        target[:, -1, 0] = 1.
+        eq_freqs = np.linalg.solve(system, target)[..., 0]
+        
+        # Equaling zero gets numerically horrible, so clean.
+        eq_freqs[eq_freqs == 0.] = ZERO
+        assert( np.all(np.abs(1. - np.sum(eq_freqs, axis = 1)) <= ZERO) ), "\n\nState frequencies calculated calculated from matrix do not sum to 1."
+        assert( np.all(eq_freqs > 0.) ), "\n\nState frequencies calculated from matrix are not all positive."
+        assert np.allclose(np.zeros([num_sites, size]), np.einsum('si,sij->sj', eq_freqs, self.matrix)), "State frequencies not properly calculated."
+        self.params["state_freqs"] = eq_freqs
+
+
+
 
 
 
@@ -398,6 +609,8 @@ class Model():
             raise TypeError("\nProvided argument `num_categories` must be an integer.")
 
         #### Note that this code is adapted from gamma.c in PAML ####
+        from scipy.stats import gamma
+        from scipy.special import gammainc
         rv = gamma(self.alpha, scale = 1./self.alpha)
         freqK = np.zeros(self.k_gamma)  ### probs
         rK = np.zeros(self.k_gamma)     ### rates
@@ -478,6 +691,61 @@ class Model():
 
 
 
+    def _decompose_matrices(self):
+        '''
+            Compute and store the eigendecomposition of each rate matrix. Heterogeneous codon models have one matrix per rate category, and all other models have a single matrix.
+            Nucleotide models of the TN93 family (e.g. JC69, K80, HKY85) are not decomposed, as their transition matrices are instead computed in closed form.
+        '''
+        if self.model_type == 'nucleotide':
+            closed_form = NucleotideTransitions.from_matrix(self.matrix, self.params["state_freqs"])
+            if closed_form is not None:
+                self._decompositions = [closed_form]
+                return
+        if self.hetcodon_model:
+            matrices = self.matrix
+        else:
+            matrices = [self.matrix]
+        self._decompositions = [ MatrixDecomposition(m, self.params["state_freqs"]) for m in matrices ]
+
+
+
+    def transition_matrix(self, t, rate_class = 0):
+        '''
+            Return the transition matrix P(t) = exp(Qt) for a given rate category, computed from a cached eigendecomposition of the rate matrix.
+            The decomposition is computed only once, upon the first call to this method.
+            
+            Required positional arguments include,
+                1. **t**, the time (branch length), or an array of times. When an array is given, an array of transition matrices is returned.
+            
+            Optional arguments include,
+                1. **rate_class**, the index of the rate category. For heterogeneous codon models, this selects the matrix for that category. For all other models, *t* is scaled by the category's rate factor. Default: 0.
+            
+            For batched models, the returned transition matrices have a leading axis with one matrix per site.
+        '''
+        if self._decompositions is None:
+            self._decompose_matrices()
+        if self.hetcodon_model:
+            return self._decompositions[rate_class].exponentiate(t)
+        else:
+            return self._decompositions[0].exponentiate( np.multiply(t, self.rate_factors[rate_class]) )
+            
+            
+            
+    def transition_rows(self, t, states):
+        '''
+            For batched models, return the row of each site's transition matrix P(t) = exp(Qt) which corresponds to that site's current state. This avoids computing a full transition matrix per site.
+            
+            Required positional arguments include,
+                1. **t**, the time (branch length).
+                2. **states**, an integer array of current states, whose last axis has one entry per site.
+        '''
+        assert(self.batched_model), "\n\nTransition rows can only be computed for batched models."
+        if self._decompositions is None:
+            self._decompose_matrices()
+        return self._decompositions[0].exponentiate_rows( t * self.rate_factors[0], states )
+
+
+
     def num_classes(self):
         ''' 
             Return the number of rate classes associated with a given model.
@@ -504,6 +772,24 @@ class Model():
         '''
         return self.hetcodon_model
         
+        
+        
+    def is_batched_model(self):
+        '''
+            Return True if the model is a batched model, with one rate matrix per site, and return False otherwise.
+        '''
+        return self.batched_model
+        
+        
+        
+    def num_sites(self):
+        '''
+            Return the number of sites in a batched model, or None if the model is not batched.
+        '''
+        if self.batched_model:
+            return len(self.matrix)
+        return None
+        
  
     # Convenience functions for users to call up parameters easily. #
         
@@ -13,6 +13,9 @@ Read/parse a newick tree.
 import re
 import os
 import warnings 
+import itertools
+import collections
+import numpy as np
 
 
 MODEL_FLAGS = ("_", "#")
@@ -29,9 +32,95 @@ class Node():
         self.branch_length   = None # Branch length leading up to node
         self.model_flag      = None # Flag indicate that this branch evolves according to a distinct model from parent
         self.propagate_model = True # Propagate model flag to the child nodes, default True
-        self.seq             = None # Contains sequence (represented by integers) for a given node. Later, this may instead be a list of Site objects.
         self.root            = False # Is this node the root of the tree?
 
+
+
+class FlatTree():
+
+    '''
+        Defines a FlatTree object, a compiled form of a Node tree whose node attributes are stored in arrays rather than in nested Node objects.
+        Nodes are numbered in preorder (the order in which ``Evolver`` visits them), so that every node comes after its parent, and the subtree descending from node *i* occupies indices *i* to *i* + subtree_size[*i*] - 1.
+        
+        Attributes include,
+            1. **names**, a list of node names
+            2. **parent**, a numpy array giving the index of each node's parent, or -1 for the root
+            3. **child_index**, a numpy array giving the position of each node among its parent's children (0 for the root)
+            4. **subtree_size**, a numpy array giving the number of nodes in the subtree descending from (and including) each node
+            5. **branch_length**, a numpy array of branch lengths, with NaN for the root
+            6. **flags**, a list of the distinct model flags found in the tree, which may include None
+            7. **model_flag**, a numpy array giving the index in **flags** of each node's model flag
+            8. **leaf**, a boolean numpy array which is True for leaves
+        
+        Examples:
+            .. code-block:: python
+            
+               >>> flat = FlatTree( read_tree(tree = "(t4:0.785,(t3:0.380,t2:0.806):0.921);") )
+               >>> flat.names
+               ['root', 't4', 'internalNode1', 't3', 't2']
+               >>> flat.parent
+               array([-1,  0,  0,  2,  2])
+    '''
+    def __init__(self, tree):
+        
+        self.names = []
+        parent      = []
+        child_index = []
+        branch_length = []
+        model_flag  = []
+        num_children = []
+        flag_ids = {}
+        
+        # Number nodes in preorder, with an explicit stack so that trees of any depth may be compiled
+        stack = [(tree, -1, 0)]
+        while stack:
+            node, parent_index, position = stack.pop()
+            index = len(self.names)
+            self.names.append( node.name )
+            parent.append( parent_index )
+            child_index.append( position )
+            branch_length.append( np.nan if node.branch_length is None else node.branch_length )
+            model_flag.append( flag_ids.setdefault(node.model_flag, len(flag_ids)) )
+            num_children.append( len(node.children) )
+            for i in reversed( range(len(node.children)) ):
+                stack.append( (node.children[i], index, i) )
+        
+        self.parent        = np.array(parent, dtype = np.intp)
+        self.child_index   = np.array(child_index, dtype = np.intp)
+        self.branch_length = np.array(branch_length, dtype = float)
+        self.flags         = list(flag_ids)
+        self.model_flag    = np.array(model_flag, dtype = np.intp)
+        self.leaf          = np.array(num_children) == 0
+        
+        # Children follow their parent, so subtree sizes are accumulated from the last node to the first
+        sizes = [1] * len(parent)
+        for i in range(len(parent) - 1, 0, -1):
+            sizes[ parent[i] ] += sizes[i]
+        self.subtree_size = np.array(sizes, dtype = np.intp)
+
+
+
+    def __len__(self):
+        '''
+            Return the number of nodes in the tree.
+        '''
+        return len(self.names)
+
+
+
+    def children(self, index):
+        '''
+            Return a list of the indices of the children of node *index*, in order.
+        '''
+        children = []
+        child = index + 1
+        end = index + int(self.subtree_size[index])
+        while child < end:
+            children.append(child)
+            child += int(self.subtree_size[child])
+        return children
+
+
 def read_tree(**kwargs):
     
     '''
@@ -108,21 +197,125 @@ def read_tree(**kwargs):
     except:
         raise TypeError("\nThe argument 'scale_tree' must be a number (integer or float).")
 
+    return _read_tree_string(tstring, scale_tree)
+
+
+
+def read_trees(**kwargs):
+    '''
+        Parse a file containing many newick phylogenies, such as a sample of trees from a posterior distribution. Each tree must end with a semicolon, and trees are usually given one per line.
+        This function is a generator, which reads the file lazily, one block at a time, and yields each tree in turn as soon as it has been parsed, so that the whole file is never held in memory. Each tree is parsed exactly as by ``read_tree``, including model flags.
+        
+        Required keyword arguments:
+            1. **file**, the name of the file containing newick trees for parsing.
+        
+        Optional keyword arguments:
+            1. **scale_tree** is a float value for scaling all branch lengths by a given multiplier. Default: 1.
+            2. **flat** is a boolean argument (True or False) for whether each tree should be yielded as a FlatTree, ready for use by ``Evolver``, instead of a Node object. Default: False.
+            3. **workers**, the number of processes over which trees are parsed, using a ProcessPoolExecutor. Trees are still yielded in the order of the file. Because Node objects of very deep trees cannot be sent back from workers, flat = True is recommended along with workers. Default: None (parse in this process).
+            4. **chunk_size**, the number of trees sent to a worker at a time when workers > 1. Default: 100.
+        
+        Examples:
+            .. code-block:: python
+               
+               >>> for tree in read_trees(file = "posterior.trees"):
+               >>>     print_tree(tree)
+               
+               >>> # Simulate one replicate along each of the first 1000 trees of a posterior sample
+               >>> trees = read_trees(file = "posterior.trees", flat = True, workers = 4)
+               >>> for replicate in my_evolver.simulate_replicates(1000, trees = trees, seed = 1):
+               >>>     sequences = replicate.get_sequences()
+    '''
+    filename   = kwargs.get('file')
+    scale_tree = kwargs.get('scale_tree', 1.)
+    flat       = kwargs.get('flat', False)
+    workers    = kwargs.get('workers', None)
+    chunk_size = kwargs.get('chunk_size', 100)
+    
+    assert(filename is not None and os.path.exists(filename)), "File does not exist. Check path?"
+    assert(workers is None or (type(workers) is int and workers > 0)), "\n\nThe argument workers must be a positive integer."
+    assert(type(chunk_size) is int and chunk_size > 0), "\n\nThe argument chunk_size must be a positive integer."
+    try:
+        scale_tree = float(scale_tree)
+    except:
+        raise TypeError("\nThe argument 'scale_tree' must be a number (integer or float).")
     
+    with open(filename, 'r') as handle:
+        if workers is None or workers == 1:
+            for tstring in _split_trees(handle):
+                tree = _read_tree_string(tstring, scale_tree)
+                yield FlatTree(tree) if flat else tree
+        else:
+            for tree in _read_trees_parallel(_split_trees(handle), scale_tree, flat, workers, chunk_size):
+                yield tree
+
+
+
+def _read_tree_string(tstring, scale_tree):
+    '''
+        Clean up and parse a single newick tree string, and return its root Node.
+    '''
     # Clean up the string a bit    
     tstring = re.sub(r"\s", "", tstring)
     tstring = re.sub(r":\d+\.*\d*;$", "", tstring) # In case there is a "root bl" at end of string. This mucks up parser.
     tstring = tstring.rstrip(';')
 
-    flags = []
-    internalNode_count = 1
-    (tree, flags, internalNode_count, index) = _parse_tree(tstring, flags, internalNode_count, scale_tree, 0) 
-    nroots = 0
-    pf, nroots = _assign_model_flags_to_nodes(nroots, tree)
+    tree = _parse_tree(tstring, scale_tree) 
+    nroots = _assign_model_flags_to_nodes(tree)
     assert(nroots == 1), "\n\nYour tree has not been properly specified. Please ensure that all internal nodes and leaves have explicit branch lengths (even if the branch lengths are 0)."
     return tree
 
 
+
+def _split_trees(handle, block_size = 1048576):
+    '''
+        Generator which reads an open file *handle* one block of *block_size* characters at a time, and yields each tree string, up to and including its semicolon. Blank text between trees is skipped.
+    '''
+    remainder = ''
+    while True:
+        block = handle.read(block_size)
+        if not block:
+            break
+        tstrings = (remainder + block).split(';')
+        remainder = tstrings.pop()
+        for tstring in tstrings:
+            if tstring.strip():
+                yield tstring + ';'
+    assert(remainder.strip() == ''), "\n\nThe last tree in your file does not end with a semicolon."
+
+
+
+def _read_tree_strings(tstrings, scale_tree, flat):
+    '''
+        Parse a list of newick tree strings in a worker process of _read_trees_parallel(), and return the list of trees.
+    '''
+    trees = [ _read_tree_string(tstring, scale_tree) for tstring in tstrings ]
+    if flat:
+        trees = [ FlatTree(tree) for tree in trees ]
+    return trees
+
+
+
+def _read_trees_parallel(tstrings, scale_tree, flat, workers, chunk_size):
+    '''
+        Parse the tree strings yielded by *tstrings* over a pool of worker processes, in chunks of *chunk_size* trees, and yield the parsed trees in order.
+        At most two chunks per worker are in flight at once, so that neither the file nor the parsed trees accumulate in memory faster than they are consumed.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    pending = collections.deque()
+    with ProcessPoolExecutor(max_workers = workers) as pool:
+        while True:
+            while len(pending) < 2 * workers:
+                chunk = list( itertools.islice(tstrings, chunk_size) )
+                if len(chunk) == 0:
+                    break
+                pending.append( pool.submit(_read_tree_strings, chunk, scale_tree, flat) )
+            if len(pending) == 0:
+                break
+            for tree in pending.popleft().result():
+                yield tree
+
+
 def print_tree(tree, level=0):
     '''
         Prints a Node object in graphical, nested format. 
@@ -165,41 +358,53 @@ def print_tree(tree, level=0):
 
                             
     ''' 
-    indent=''
-    for i in range(level):
-        indent+='\t'
-    printstring = indent + str(tree.name) + " " + str(tree.branch_length) + " " + str(tree.model_flag)
-    print(printstring)
-    if len(tree.children) > 0:
-        for node in tree.children:
-            print_tree(node, level+1)    
+    stack = [(tree, level)]
+    while stack:
+        node, node_level = stack.pop()
+        indent = '\t' * node_level
+        printstring = indent + str(node.name) + " " + str(node.branch_length) + " " + str(node.model_flag)
+        print(printstring)
+        for child in reversed(node.children):
+            stack.append( (child, node_level + 1) )
     
 
 
-def _assign_model_flags_to_nodes(nroots, tree, parent_flag = None):
+def _assign_model_flags_to_nodes(tree):
     '''
         Determine the evolutionary model to be used at each node, while also counting roots parsed to be sure tree is acceptable.
+        Nodes are visited with an explicit stack, so that trees of any depth may be processed. Returns the number of roots.
     '''
-    
-    # Assign model if there was none in the tree    
-    if tree.model_flag is None:
-        tree.model_flag = parent_flag
-        if tree.root is True:
-            nroots += 1
-
-    if len(tree.children) > 0:
-        for node in tree.children:
-            # By default, model will progagate
-            if tree.propagate_model:
-                children_model_flag = tree.model_flag 
-            else:
-                children_model_flag = None
-            parent_flag, nroots = _assign_model_flags_to_nodes(nroots, node, children_model_flag)
-    return parent_flag, nroots
+    nroots = 0
+    stack = [(tree, None)]
+    while stack:
+        node, parent_flag = stack.pop()
+        
+        # Assign model if there was none in the tree    
+        if node.model_flag is None:
+            node.model_flag = parent_flag
+            if node.root is True:
+                nroots += 1
+        
+        # By default, model will progagate
+        if node.propagate_model:
+            children_model_flag = node.model_flag 
+        else:
+            children_model_flag = None
+        for child in node.children:
+            stack.append( (child, children_model_flag) )
+    return nroots
     
     
     
 
+_LEAF_NAME     = re.compile(r"[^,):]*")     # Leaf names run up to the colon preceding their branch length
+_NODE_NAME     = re.compile(r"[A-Za-z][^:_#]*") # Internal node names must start with a letter, and run up to their branch length or model flag
+_BRANCH_LENGTH = re.compile(r"[^,)_#]*")    # Branch lengths run up to the next sister, the end of the subtree, or a model flag
+_MODEL_FLAG    = dict( (symbol, re.compile(re.escape(symbol) + r"(.[^:),%s]*)(%s?)" % (re.escape(symbol), re.escape(symbol)))) for symbol in MODEL_FLAGS ) # Model flags run up to a trailing flag symbol (propagating) or the next node (not propagating)
+_PARSE_ERROR   = "\n\nTree parsing error! Please ensure that your tree is a properly specified newick tree with branch lengths for all nodes and tips. Consult the Pyvolve manual for proper internal node name and model flag specification."
+
+
+
 def _read_model_flag(tstring, index):
     '''
         Read a model flag id while parsing the tree from the function _parse_tree. Flags must come **after** the branch length associated with that node, before the comma.
@@ -207,31 +412,20 @@ def _read_model_flag(tstring, index):
             + Leading and trailing, e.g. #flag# or _flag_ . These flags will automatically propagate to all child branches.
             + Trailing only, e.g. #flag or _flag. These flags will be applied *only* to the given branch.
     '''
-    
     flag_symbol = tstring[index]
     assert(flag_symbol in MODEL_FLAGS), "\nError: Unknown model flag."
-
-    index += 1 # Skip the leading flag symbol
-    end = index
-    prop = True # detected flag is propagated, by default
-    
-    while True:
-        end += 1
-        if end==len(tstring) or tstring[end] == ":" or tstring[end] == ")" or tstring[end] == ",":
-            break
-        if tstring[end] == flag_symbol:
-            end += 1
-            break
-    model_flag = tstring[index:end]
+    match = _MODEL_FLAG[flag_symbol].match(tstring, index)
+    assert(match is not None), _PARSE_ERROR
+    model_flag = match.group(1) + match.group(2)
+    end = match.end()
     
     # Clean model flag and determine if propagating
-    if model_flag.endswith(flag_symbol):
+    prop = model_flag.endswith(flag_symbol)
+    if prop:
         model_flag = model_flag[:-1]
-    else:
-        prop = False
     
     # If we had a propagating model, then increment end to remove the trailing symbol
-    if tstring[end] == flag_symbol:
+    if end < len(tstring) and tstring[end] == flag_symbol:
         assert(prop is True), "\n\nPyvolve can't tell if your model flag is propagating or not. Please consult docs."
         end += 1
     
@@ -239,64 +433,33 @@ def _read_model_flag(tstring, index):
 
      
 
-     
-
-def _read_node_name(tstring, index):
-    '''
-        Read a provided internal node name while parsing the tree from the function _parse_tree.
-        Importantly, internal node names *MAY NOT* contain colons!!
-    '''
-    end = index
-    while True:
-        if end == len(tstring):
-            break
-        if tstring[end] == ":" or tstring[end] in MODEL_FLAGS:
-            break
-        end += 1
-    name = tstring[index:end]
-    return name, end
-
 
-
-     
 def _read_branch_length(tstring, index):
     '''
-        Read a branch length while parsing the tree from the function _parse_tree.
+        Read a branch length, which begins with the colon at *index*, while parsing the tree from the function _parse_tree.
     '''
-    end = index
-    while True:
-        end += 1
-        if end==len(tstring):
-            break
-        if tstring[end]==',' or tstring[end]==')' or tstring[end] in MODEL_FLAGS:
-            break
+    end = _BRANCH_LENGTH.match(tstring, index + 1).end()
     BL = float( tstring[index+1:end] )
     return BL, end
 
 
+
 def _read_leaf(tstring, index):
     '''
-        Read a leaf (taxon name) while parsing the tree from the function _parse_tree.
+        Read a leaf (taxon name, branch length, and model flag, if any) while parsing the tree from the function _parse_tree.
     '''
-    end = index
     node = Node()
-
-    while True:
-        end += 1
-        assert( end<len(tstring) ), "\n\nTree parsing error! Please ensure that your tree is a properly specified newick tree with branch lengths for all nodes and tips. Consult the Pyvolve manual for proper internal node name and model flag specification."
-
-        # Leaf has no branch length -> raise error
-        if tstring[end]==',' or tstring[end]==')':
-            raise AssertionError("\n\nThe leaves on your provided tree do not all have branch lengths. *All* branch lengths must be specified (even if they are 0!).")   
-        
-        # Leaf has branch length    
-        if tstring[end] == ':' :
-            node.name = tstring[index:end]
-            node.branch_length, end = _read_branch_length(tstring, end)            
-            break 
+    end = _LEAF_NAME.match(tstring, index + 1).end()
+    assert( end < len(tstring) ), _PARSE_ERROR
+
+    # Leaf has no branch length -> raise error
+    if tstring[end] != ':':
+        raise AssertionError("\n\nThe leaves on your provided tree do not all have branch lengths. *All* branch lengths must be specified (even if they are 0!).")   
+    node.name = tstring[index:end]
+    node.branch_length, end = _read_branch_length(tstring, end)            
                 
     # Does leaf have an associated model? 
-    if tstring[end] in MODEL_FLAGS:
+    if end < len(tstring) and tstring[end] in MODEL_FLAGS:
         node.model_flag, propagate, flag_symbol, end = _read_model_flag(tstring, end)
         
         # Clean leaf name as needed
@@ -306,81 +469,87 @@ def _read_leaf(tstring, index):
 
 
 
+def _close_node(node, tstring, internalNode_count, scale_tree, index):
+    '''
+        Read the node name, branch length, and model flag (any of which may be absent) following the closing parenthesis of an internal node, while parsing the tree from the function _parse_tree.
+        Argument *index* is the position just after the closing parenthesis. Returns the updated internal node count and the position following the node.
+    '''
+    # Now we have either a node name, model flag, BL. Order MUST BE node name, BL, model flag (if/when multiple).            
+    if index < len(tstring):
+        
+        # Node name
+        name = _NODE_NAME.match(tstring, index)
+        if name is not None:
+            node.name = name.group()
+            index = name.end()
+        ## LABELED ROOT SCENARIO:
+        if index == len(tstring):
+            node.root = True
+            return internalNode_count, index
+                                       
+        # Branch length, with scaling as needed
+        if tstring[index] == ':':
+            node.branch_length, index = _read_branch_length(tstring, index)
+            
+        # Model flag
+        if index < len(tstring) and tstring[index] in MODEL_FLAGS:
+            node.model_flag, node.propagate_model, flag_symbol, index = _read_model_flag(tstring, index)
+    
+    # Assign name to the node, either as internal_code<i> or root (if the branch length is None), if a name was not specified.
+    if node.name is None:
+        # Root, if was unlabeled.
+        if node.branch_length is None:
+            node.root = True
+            node.name = "root"
+        else:
+            # Unnamed internal node
+            node.name = "internalNode" + str(internalNode_count)
+            internalNode_count += 1
+            node.branch_length *= scale_tree # scale *internal* branch length
+    
+    # Check that branch lengths and node names were set up
+    if node.root is False:
+        assert(node.branch_length is not None), "\nYour tree is missing branch length(s). Please ensure that all nodes and tips have a branch length (even if the branch length is 0!)."
+    else:
+        assert(node.branch_length is None), "\nERROR: Your tree root has a branch length."
+    assert(node.name is not None), "\nInternal node name was neither provided nor assigned, which means your tree has not been properly formatted. Please ensure that you have provided a proper newick tree."
+    return internalNode_count, index
+
 
 
-def _parse_tree(tstring, flags, internalNode_count, scale_tree, index):
+def _parse_tree(tstring, scale_tree):
     '''
-        Recursively parse a newick tree string and convert to a Node object. 
-        Uses the functions _read_branch_length(), _read_leaf(), _read_model_flag() during the recursion.
+        Parse a newick tree string in a single pass and convert to a Node object. 
+        Open subtrees are kept on an explicit stack rather than parsed recursively, so that trees of any depth may be read. Internal nodes are numbered in the order in which they are closed.
+        Uses the functions _read_leaf(), _close_node(), _read_branch_length(), and _read_model_flag() to read each node.
     '''
-    assert(tstring[index]=='(')
-    index += 1
-    node = Node()
-    while True:        
+    assert(tstring.startswith('(')), _PARSE_ERROR
+    internalNode_count = 1
+    stack = []
+    index = 0
+    while True:
+        assert( index < len(tstring) ), _PARSE_ERROR
+        char = tstring[index]
         
         # New subtree (node) to parse
-        if tstring[index]=='(':
-            subtree, flags, internalNode_count, index = _parse_tree(tstring, flags, internalNode_count, scale_tree, index)
-            node.children.append( subtree )
+        if char == '(':
+            stack.append( Node() )
+            index += 1
 
         # March to sister
-        elif tstring[index]==',':
+        elif char == ',':
             index += 1            
 
         # End of a subtree (node)
-        elif tstring[index]==')':
-            index += 1
-
-            
-            # Now we have either a node name, model flag, BL. Order MUST BE node name, BL, model flag (if/when multiple).            
-            if index<len(tstring):
-                
-                # Node name
-                if re.match(r"^[A-Za-z]", tstring[index]): # Must start w/ letter
-                    name, index = _read_node_name(tstring, index)
-                    node.name = name
-                ## LABELED ROOT SCENARIO:
-                if index == len(tstring):
-                    node.root = True
-                    break
-                                               
-                # Branch length, with scaling as needed
-                if tstring[index]==':':
-                    BL, index = _read_branch_length(tstring, index)
-                    node.branch_length = BL
-                    
-                # Model flag
-                if tstring[index] in MODEL_FLAGS:
-                    node.model_flag, node.propagate_model, flag_symbol, index = _read_model_flag(tstring, index)
-                    flags.append( node.model_flag )                                    
-            
-            # Assign name to the node, either as internal_code<i> or root (if the branch length is None), if a name was not specified.
-            if node.name is None:
-                # Root, if was unlabeled.
-                if node.branch_length is None:
-                    node.root = True
-                    node.name = "root"
-                else:
-                    # Unnamed internal node
-                    node.name = "internalNode" + str(internalNode_count)
-                    internalNode_count += 1
-                    node.branch_length *= scale_tree # scale *internal* branch length
-            
-            # Check that branch lengths and node names were set up
-            if node.root is False:
-                assert(node.branch_length is not None), "\nYour tree is missing branch length(s). Please ensure that all nodes and tips have a branch length (even if the branch length is 0!)."
-            else:
-                assert(node.branch_length is None), "\nERROR: Your tree root has a branch length."
-            assert(node.name is not None), "\nInternal node name was neither provided nor assigned, which means your tree has not been properly formatted. Please ensure that you have provided a proper newick tree."
-            
-            break
+        elif char == ')':
+            node = stack.pop()
+            internalNode_count, index = _close_node(node, tstring, internalNode_count, scale_tree, index + 1)
+            if not stack:
+                return node
+            stack[-1].children.append( node )
             
         # Terminal leaf
         else:
-            subtree, index = _read_leaf(tstring, index)
-            subtree.branch_length *= scale_tree # scale *leaf* branch length
-            node.children.append( subtree )
-    return node, flags, internalNode_count, index    
-    
-
-            
\ No newline at end of file
+            leaf, index = _read_leaf(tstring, index)
+            leaf.branch_length *= scale_tree # scale *leaf* branch length
+            stack[-1].children.append( leaf )
@@ -16,7 +16,6 @@
 
 
 import numpy as np
-from scipy import linalg
 from copy import deepcopy
 from .genetics import *
 from .state_freqs import *
@@ -74,8 +73,8 @@ class ParametersSanity(object):
         '''
             State frequency sanity checks common to all child classes.
         '''
-        assert( len(self.params['state_freqs']) == self.size ), "\n\nThe value associated with the 'state_freqs' key in the provided parameters dictionary does not contain the correct number of values for your specified model."
-        assert( abs(1. - np.sum(self.params['state_freqs']) <= ZERO) ), "\n\nProvided state frequencies do not sum to 1."
+        assert( np.shape(self.params['state_freqs'])[-1] == self.size ), "\n\nThe value associated with the 'state_freqs' key in the provided parameters dictionary does not contain the correct number of values for your specified model."
+        assert( np.all( np.abs(1. - np.sum(self.params['state_freqs'], axis = -1)) <= ZERO ) ), "\n\nProvided state frequencies do not sum to 1."
 
 
 
@@ -339,6 +338,7 @@ class MutSel_Sanity(ParametersSanity):
             1. state frequencies and/or fitness values
             2. mutation rates
             3. [Optional] population size, N_e. *May only be provided in concert with fitness values, which will then be assumed to be unscaled fitnesses and will be re-computed to scaled fitness values as 2Ne_s*
+        State frequencies or fitness values may be given either as a single vector, or as a 2D array with one row per site for a batched site-wise model.
     '''
 
     def __init__(self, *args, **kwargs):
@@ -360,18 +360,20 @@ class MutSel_Sanity(ParametersSanity):
             Additionally, add these keys to the parameters dictionary:
                 1. "codon_model". Boolean indicating if this is a "codon" (1) or "nucleotide" (0) MutSel model
                 2. "calc_by_freqs". Boolean indicating if calculations will be done using "state_freqs" (1) or "fitness" (0) values
+            Values given as a 2D array (one row per site) are converted to a numpy array of floats.
         '''
         self.params["codon_model"] = None
         self.params["calc_by_freqs"] = None
 
         if 'state_freqs' in self.params:
             self.params["calc_by_freqs"] = True
+            self._sanity_batched_values('state_freqs')
 
-            if len(self.params['state_freqs']) == len(MOLECULES.codons):
+            if np.shape(self.params['state_freqs'])[-1] == len(MOLECULES.codons):
                 self.size = len(MOLECULES.codons)
                 self.params["codon_model"] = True
 
-            elif len(self.params['state_freqs']) == len(MOLECULES.nucleotides):
+            elif np.shape(self.params['state_freqs'])[-1] == len(MOLECULES.nucleotides):
                 self.size = len(MOLECULES.nucleotides)
                 self.params["codon_model"] = False
 
@@ -381,15 +383,16 @@ class MutSel_Sanity(ParametersSanity):
 
         elif 'fitness' in self.params:
             self.params["calc_by_freqs"] = False
+            self._sanity_batched_values('fitness')
 
-            if len(self.params['fitness']) == len(MOLECULES.codons) or len(self.params['fitness']) == len(MOLECULES.amino_acids):
+            if np.shape(self.params['fitness'])[-1] == len(MOLECULES.codons) or np.shape(self.params['fitness'])[-1] == len(MOLECULES.amino_acids):
                 self.params["codon_model"] = True
 
                 # Replace length-20 fitness with length-61 fitness, assuming equal fitness for synonymous codons.
-                if len(self.params['fitness']) == len(MOLECULES.amino_acids):
+                if np.shape(self.params['fitness'])[-1] == len(MOLECULES.amino_acids):
                     self._amino_to_codon_fitness()
 
-            elif len(self.params['fitness']) == len(MOLECULES.nucleotides):
+            elif np.shape(self.params['fitness'])[-1] == len(MOLECULES.nucleotides):
                 self.params["codon_model"] = False
 
             else:
@@ -415,19 +418,20 @@ class MutSel_Sanity(ParametersSanity):
 
 
 
-    def _amino_to_codon_fitness(self):
+    def _sanity_batched_values(self, key):
         '''
-            Convert a vector of amino acid fitness values to codon fitness values, assuming equal fitness among synonymous codons.
+            Check the dimensions of state frequencies or fitness values (given by *key*), which are either a vector or a 2D array with one row per site. 2D arrays are converted to numpy arrays of floats.
         '''
-        d = {}
-        for i in range(20):
-            syn_codons = MOLECULES.genetic_code[i]
-            for syn in syn_codons:
-                d[ syn ] = self.params['fitness'][i]
-
-        codon_fitness = np.zeros(61)
-        count = 0
-        for i in range(61):
-            codon_fitness[i] = d[MOLECULES.codons[i]]
+        dims = np.ndim(self.params[key])
+        assert( dims == 1 or dims == 2 ), "\n\nThe '" + key + "' values for a mutation-selection model must be either a single vector, or a 2D array with one row per site."
+        if dims == 2:
+            assert( len(self.params[key]) > 0 ), "\n\nThe '" + key + "' array for a batched mutation-selection model has no sites."
+            self.params[key] = np.array(self.params[key], dtype = float)
+
+
 
-        self.params['fitness'] = codon_fitness
+    def _amino_to_codon_fitness(self):
+        '''
+            Convert a vector (or 2D array, with one row per site) of amino acid fitness values to codon fitness values, assuming equal fitness among synonymous codons.
+        '''
+        self.params['fitness'] = np.asarray(self.params['fitness'], dtype = float)[..., MOLECULES.codon_amino_acids]
@@ -18,13 +18,14 @@ class Partition():
         '''
             Required keyword arguments:
                 
-                1. **size**, integer giving the root length of this partition (only required when no root sequence is given)
+                1. **size**, integer giving the root length of this partition (only required when no root sequence is given, and not required for batched models, whose size is their number of sites)
                 2. **models** (or **model**), either a single Model object (for cases of branch homogeneity), or a list of Model objects (for cases of branch heterogeneity).
         
             Optional keyword arguments:
             
                 1. **root_sequence**, a string giving the ancestral sequence for this partition. Note that, when provided, the **size** argument is not needed.
                 2. **root_model_name**, the *name attribute* of the model to be used at the root of the phylogeny. Applicable only to cases of *branch heterogeneity*.
+                3. **rng**, a numpy.random.Generator used to assign sites to rate categories. Default: None (a new, unpredictably seeded generator). Sites are assigned when the Partition is defined, before any simulation, so the **seed** given to an Evolver does not reproduce this assignment: with rate heterogeneity, provide a seeded rng here for end-to-end reproducibility.
 
             Examples:
                 .. code-block:: python
@@ -44,6 +45,9 @@ class Partition():
         if self.models is None:
             self.models        = kwargs.get('model', None)
         self.root_model_name   = kwargs.get('root_model_name', None)  # NAME of Model beginning evolution at root of tree. Used under *branch heterogeneity*, and should be None or False if process is temporally homogeneous. If there is branch heterogeneity, this string *MUST* correspond to one of the Model() object's names.
+        self._rng              = kwargs.get('rng', None) # numpy Generator used to divvy sites among rate categories
+        if self._rng is None:
+            self._rng          = np.random.default_rng()
         self._shuffle          = False # Shuffle sites after evolving?
         self._root_model       = None  # The actual root model object.
 
@@ -58,6 +62,11 @@ class Partition():
         '''
             Sanity checks and setup for the size and MRCA, if provided.
         '''
+        num_sites = self._root_model.num_sites()
+        if num_sites is not None:
+            if self.size is None:
+                self.size = num_sites
+            assert(self.size == num_sites), "\n\nThe size of a Partition with a batched model must equal the model's number of sites."
         assert(self.size is not None or self.MRCA is not None), "\n\nWhen defining a Partition object, you must specify either a root sequence or a partition size."
         
         if self.MRCA is not None:
@@ -66,6 +75,7 @@ class Partition():
                 print("\n\nWARNING: You provided both a size and a root sequence for your Partition. The size argument will be ignored.")
             code_step = len(self._root_model.code[0])
             self.size = [int(len(self.MRCA) / code_step)]
+            assert(num_sites is None or self.size[0] == num_sites), "\n\nThe root sequence of a Partition with a batched model must have one state per site of the model."
         
             # Remove site-rate heterogeneity if MRCA was provided
             for model in self.models:
@@ -100,6 +110,10 @@ class Partition():
             self._root_model = self.models[0] 
         assert(self._root_model != None), "\n Root model not properly assigned in your partition. Make sure that you specified a root model name if you have branch heterogeneity! Do so with the argument root_model_name."
 
+        # Batched models have one matrix per site, so all models must be batched with the same number of sites.
+        for m in self.models:
+            assert(m.num_sites() == self._root_model.num_sites()), "\n\nAll models in a Partition must either be batched models with the same number of sites, or not batched."
+
         # Ensure branch-site is ok - number of rate categories has to be the same across branches.
         if self.site_het():
             self._shuffle = True
@@ -117,8 +131,7 @@ class Partition():
             If no rate heterogeneity, will simply be a list of length 1 containing full size.
         '''
         nc = self._root_model.num_classes()
-        rate_occurrences = np.random.choice(nc, int(self.size), p = self._root_model.rate_probs)          
-        new_size = np.bincount(rate_occurrences, minlength = nc)
+        new_size = self._rng.multinomial(int(self.size), self._root_model.rate_probs)
         assert( sum(new_size) ==  self.size ), "\n\nImproperly divvied up rate heterogeneity."
         assert( len(new_size) == nc), "\n\nPartition size does not correspond to the number of rate categories. Please report this error."
         self.size = list(new_size)
@@ -16,8 +16,6 @@ import re
 import sys
 import time
 import numpy as np
-import random as rn
-from Bio import SeqIO, AlignIO
 from .genetics import *
 ZERO      = 1e-8
 MOLECULES = Genetics()
@@ -259,6 +257,7 @@ class RandomFrequencies(StateFrequencies):
             Optional arguments include, 
         
             1. **restrict**, a list (in which each element is a string) specifying which states should have non-zero frequencies. Default: all.
+            2. **rng**, a numpy.random.Generator from which frequencies are drawn. Default: None (a new, unpredictably seeded generator). Frequencies are drawn independently of any simulation, so the **seed** given to an Evolver does not reproduce them: provide a seeded rng here for end-to-end reproducibility.
         
         Examples:
             .. code-block:: python
@@ -276,6 +275,9 @@ class RandomFrequencies(StateFrequencies):
 
  
         super(RandomFrequencies, self).__init__(by,**kwargs)
+        self._rng = kwargs.get('rng', None)
+        if self._rng is None:
+            self._rng = np.random.default_rng()
         self._partial_restrict = self._restrict[:-1] # all but last
         
       
@@ -293,9 +295,9 @@ class RandomFrequencies(StateFrequencies):
             sum = 0.
             self._byFreqs = np.zeros(self._size)
             for entry in self._partial_restrict:
-                freq = rn.uniform(min,max)
+                freq = self._rng.uniform(min,max)
                 while (sum + freq > 1):
-                    freq = rn.uniform(min,max)
+                    freq = self._rng.uniform(min,max)
                     if time.time() > abort_after_time:
                         restart_search = True 
                         break
@@ -372,9 +374,138 @@ class CustomFrequencies(StateFrequencies):
 
 
 
+def _conversion_matrix(by, type):
+    '''
+        Return the matrix which converts frequencies of the alphabet *by* to frequencies of the alphabet *type* (each being "nucleotide", "amino_acid", or "codon") by right-multiplication, applying to a whole array of frequencies the same conversions as StateFrequencies.
+        Amino acid frequencies are split equally among synonymous codons, and codon frequencies are converted to nucleotides by counting each nucleotide in the codon.
+    '''
+    if by == 'amino_acid' and type == 'nucleotide':
+        return np.dot( _conversion_matrix('amino_acid', 'codon'), _conversion_matrix('codon', 'nucleotide') )
+    if by == 'amino_acid':
+        conversion = np.zeros((20, 61))
+        for a in range(20):
+            syn = MOLECULES.genetic_code[a]
+            for codon in syn:
+                conversion[a][ MOLECULES.codons.index(codon) ] = 1./len(syn)
+    elif type == 'amino_acid':
+        conversion = np.zeros((61, 20))
+        for a in range(20):
+            for codon in MOLECULES.genetic_code[a]:
+                conversion[ MOLECULES.codons.index(codon) ][a] = 1.
+    else:
+        conversion = np.zeros((61, 4))
+        for i in range(61):
+            for n in range(4):
+                conversion[i][n] = MOLECULES.codons[i].count(MOLECULES.nucleotides[n]) / 3.
+    return conversion
+
+
+
+def _state_lookup(by):
+    '''
+        Return the lookup tables used by _stream_states() to convert sequence bytes to state indices for the alphabet *by* ("nucleotide", "amino_acid", or "codon").
+        The first table has 256 entries and maps each byte to the index of its state. Bytes which are not states (gaps, ambiguities, lowercase letters) map to the alphabet size, and whitespace maps to one beyond it so that it can be dropped.
+        For codons, the first table maps bytes to nucleotide indices, and the second maps each triplet of nucleotide indices (in base 5, i.e. 25*first + 5*second + third) to its codon index. Stop codons and triplets with a non-nucleotide map to 61. The second table is None for other alphabets.
+    '''
+    if by == 'codon':
+        code = MOLECULES.nucleotides
+    elif by == 'amino_acid':
+        code = MOLECULES.amino_acids
+    else:
+        code = MOLECULES.nucleotides
+    lut = np.full(256, len(code), dtype = np.intp)
+    lut[ np.frombuffer(b" \t\r\n\v\f", dtype = np.uint8) ] = len(code) + 1
+    for i in range(len(code)):
+        lut[ ord(code[i]) ] = i
+    
+    triplets = None
+    if by == 'codon':
+        triplets = np.full(125, len(MOLECULES.codons), dtype = np.intp)
+        for i in range(len(MOLECULES.codons)):
+            nucs = [MOLECULES.nucleotides.index(nuc) for nuc in MOLECULES.codons[i]]
+            triplets[ 25*nucs[0] + 5*nucs[1] + nucs[2] ] = i
+    return lut, triplets
+
+
+
+def _sequence_pieces(seqfile, format, block_size):
+    '''
+        Yield None at the start of each sequence in *seqfile*, followed by the bytes of that sequence in one or more pieces (which may still contain line breaks).
+        FASTA files are read directly in blocks of *block_size* bytes. Other formats are parsed with Biopython one record at a time.
+    '''
+    if format == 'fasta':
+        with open(seqfile, 'rb') as handle:
+            in_header = False
+            while True:
+                block = handle.read(block_size)
+                if not block:
+                    break
+                view = memoryview(block)
+                start = 0
+                while start < len(block):
+                    if in_header:
+                        end = block.find(b"\n", start)
+                        if end < 0:
+                            break
+                        in_header = False
+                    else:
+                        end = block.find(b">", start)
+                        if end < 0:
+                            yield view[start:]
+                            break
+                        if end > start:
+                            yield view[start:end]
+                        yield None
+                        in_header = True
+                    start = end + 1
+    else:
+        from Bio import SeqIO
+        for entry in SeqIO.parse(seqfile, format):
+            yield None
+            yield str(entry.seq).encode()
+
+
+
+def _stream_states(seqfile, format, by, block_size = 1048576):
+    '''
+        Stream the sequences in *seqfile*, yielding a tuple (record, position, states) for each chunk of a sequence, where
+            1. **record** is the index of the sequence in the file
+            2. **position** is the index, within its sequence, of the chunk's first state (counted in codons when *by* is "codon")
+            3. **states** is a numpy array of state indices, in which characters that are not states of the alphabet (gaps, ambiguities...) take the value of the alphabet size
+        
+        Only one block (FASTA) or record (other formats) is held at a time, so memory use does not depend on the size of the file. Codons are built from reshaped triplets of nucleotides, carrying an incomplete triplet over to the next chunk of its sequence.
+    '''
+    lut, triplets = _state_lookup(by)
+    skip = len(MOLECULES.amino_acids if by == 'amino_acid' else MOLECULES.nucleotides) + 1
+    carry = np.empty(0, dtype = np.intp)
+    record = -1
+    position = 0
+    for piece in _sequence_pieces(seqfile, format, block_size):
+        if piece is None:
+            record += 1
+            position = 0
+            carry = carry[:0]
+            continue
+        if record < 0:
+            continue
+        states = lut[ np.frombuffer(piece, dtype = np.uint8) ]
+        states = states[ states != skip ]
+        if triplets is not None:
+            states = np.concatenate((carry, states))
+            complete = len(states) - len(states) % 3
+            carry = states[complete:]
+            states = states[:complete].reshape(-1, 3)
+            states = triplets[ 25*states[:,0] + 5*states[:,1] + states[:,2] ]
+        if len(states):
+            yield record, position, states
+            position += len(states)
+
+
+
 class ReadFrequencies(StateFrequencies):
     ''' 
         This class may be used to compute frequencies directly from a specified sequence file. Frequencies may be computed globally (using entire file), or based on specific columns (i.e. site-specific frequencies), provided the file contains a sequence alignment.
+        The file is streamed rather than loaded, so that memory use does not depend on its size. FASTA files are read directly in blocks, and other formats one record at a time with Biopython.
 
         Required positional include, 
             1. **by**. See parent class StateFrequencies for details.
@@ -413,8 +544,7 @@ class ReadFrequencies(StateFrequencies):
         self.seqfile          = kwargs.get('file', None)
         self.format           = kwargs.get('format', 'fasta').lower()   # Biopython requires that this flag is lowercase.
         self.which_columns    = kwargs.get('columns', None)
-        self._seqs            = []                                      # Sequence records obtained from sequence file
-        self._make_seq_list()
+        self._check_seqfile()
 
     
     def _sanity_which_columns(self):
@@ -423,71 +553,138 @@ class ReadFrequencies(StateFrequencies):
                 1. Should be a list
                 2. Should not include columns outside of the length of the alignment [1,alnlen]
                 3. Should be converted to a numpy array
+            That all sequences share the alignment length is checked when they are read, in _generate_byFreqs().
         '''
-        try:    
-            AlignIO.read(self.seqfile, self.format)
-        except:
-            raise TypeError("\n\nYour sequence file does not appear to be an *alignment.* If you would like to get frequencies from specific columns only, it must be an alignment!") 
         assert( type(self.which_columns) is list), "\n\nArgument *columns* must be a list of integers giving the column(s) (indexed from 1!) which should be considered for frequency calculations."
-        self.which_columns = np.array(self.which_columns) - 1
-        if self._by == 'codon':
-            which_check = self._alnlen / 3
-        else:
-            which_check = self._alnlen
-        assert( (self.which_columns >= 0).all() and (self.which_columns <= which_check).all() ), "\n\nYour column indices specified in *which_columns* do not play well with alignment! Remember that column indexing starts at *1*, and you cannot specify columns that don't exist."
+        self.which_columns = np.array(self.which_columns, dtype = np.intp) - 1
+        assert( (self.which_columns >= 0).all() and (self.which_columns < self._numcol).all() ), "\n\nYour column indices specified in *which_columns* do not play well with alignment! Remember that column indexing starts at *1*, and you cannot specify columns that don't exist."
         
         
         
         
-    def _make_seq_list(self):
+    def _check_seqfile(self):
         ''' 
-            Read in sequence file and set up variables used in frequency calculations.
-            Additionally performs some sanity checks on sequence file, sequences themselves, and the which_columns argument (if specified).
+            Check the sequence file and set up variables used in frequency calculations.
+            Only the first sequence is read here, to perform sanity checks on its length and on the which_columns argument (if specified). The file itself is streamed by _generate_byFreqs().
          '''
          
         assert(self.seqfile is not None), "\n\n You must provide a sequence/alignment file with the argument file=<my_file_name> to use the ReadFrequencies class."
         assert(os.path.exists(self.seqfile)), "\n\n Your input file does not exist! Check the path?"
+        self._alnlen = None # This will only come into play if we're collecting columns.
         try:
-            raw = list(SeqIO.parse(self.seqfile, self.format))
+            # Count every character of the first sequence, whatever the alphabet, by streaming it as nucleotides.
+            for record, position, states in _stream_states(self.seqfile, self.format, 'nucleotide'):
+                if record > 0:
+                    break
+                self._alnlen = position + len(states)
         except:
             raise TypeError("\n\nYour sequence file could not be parsed. Note that if your sequence file is not in FASTA format, you must specify its format with the argument *format*.")  
-        self._numseq = len(raw)
-        self._alnlen = len(raw[0]) # This will only come into play if we're collecting columns.
+        assert(self._alnlen is not None), "\n\nYour sequence file could not be parsed. Note that if your sequence file is not in FASTA format, you must specify its format with the argument *format*."
+        self._numcol = self._alnlen
         if self._by == 'codon':
              assert( self._alnlen%3 == 0), "\n\nThe length of your sequence alignment is not a multiple of three, so you don't seem to actually have codons."
+             self._numcol = self._alnlen // 3
         if self.which_columns is not None:
             self._sanity_which_columns()
-        for entry in raw:
-            self._seqs.append(str(entry.seq))  
 
     
     
+    def _read_states(self, aligned):
+        '''
+            Stream the states of the sequence file with _stream_states(), yielding (record, position, states) for each chunk.
+            When *aligned* is True, every sequence must have as many columns as the first, and a TypeError is raised otherwise.
+        '''
+        not_aligned = "\n\nYour sequence file does not appear to be an *alignment.* If you would like to get frequencies from specific columns only, it must be an alignment!"
+        record, length = 0, self._numcol
+        try:
+            for chunk in _stream_states(self.seqfile, self.format, self._by):
+                if aligned:
+                    if chunk[0] != record:
+                        if length != self._numcol:
+                            raise TypeError(not_aligned)
+                        record = chunk[0]
+                    length = chunk[1] + len(chunk[2])
+                    if length > self._numcol:
+                        raise TypeError(not_aligned)
+                yield chunk
+        except TypeError:
+            raise
+        except:
+            raise TypeError("\n\nYour sequence file could not be parsed. Note that if your sequence file is not in FASTA format, you must specify its format with the argument *format*.")  
+        if aligned and length != self._numcol:
+            raise TypeError(not_aligned)
+    
+    
+    
     def _generate_byFreqs(self):
         ''' 
-            Compute self._byFreqs
+            Compute self._byFreqs by streaming the sequence file and counting states with np.bincount.
+            Characters which are not in the alphabet (gaps, ambiguities...) are not counted.
         ''' 
         
-        total_characters = 0.
-        for row in self._seqs: 
-            if self.which_columns is not None:   
-                for col in self.which_columns:
-                    if self._by == "codon": 
-                        char = row[col*3 : col*3 + 3]
-                    else:
-                        char = row[col]
-                    if char in self._code:
-                        total_characters += 1.
-                        self._byFreqs[ self._code.index(char) ] += 1          
-            else:
-                for i in range(len(row)):
-                    if self._by == "codon":
-                        char = row[i*3 : i*3+3]
-                    else:
-                        char = row[i]
-                    if char in self._code:
-                        total_characters += 1.
-                        self._byFreqs[ self._code.index(char) ] += 1     
-        self._byFreqs = np.divide(self._byFreqs, total_characters)
+        counts = np.zeros(self._size + 1)
+        for record, position, states in self._read_states(aligned = self.which_columns is not None):
+            if self.which_columns is not None:
+                in_chunk = (self.which_columns >= position) & (self.which_columns < position + len(states))
+                states = states[ self.which_columns[in_chunk] - position ]
+            counts += np.bincount(states, minlength = self._size + 1)
+        self._byFreqs = np.divide(counts[:-1], np.sum(counts[:-1]))
+
+
+
+    def compute_site_frequencies(self, **kwargs):
+        '''
+            Calculate and return a 2D array of site-specific state frequencies, with one row per alignment column, reading the alignment only once. The file must be an alignment.
+            The rows follow the **columns** given when defining this object, or all columns of the alignment otherwise. The returned array can be used directly as the "state_freqs" of a batched mutation-selection model, with one site per row.
+            
+            Optional keyword arguments include,
+            
+                1. **type** ( = "nucleotide", "amino_acid", or "codon") represents the type of final frequencies to return, as in compute_frequencies(). If not specified, the alphabet of returned frequencies will be that specified with the **by** keyword. Note that mutation-selection models require nucleotide or codon frequencies.
+                2. **pseudocount**, a count added to every state of every column before frequencies are computed. Default: 0. Columns without any counted state (e.g. only gaps) are given equal frequencies.
+                3. **savefile** is a file name to which final frequencies may be saved, with one row per column.
+  
+            Examples:
+                .. code-block:: python 
+                
+                   >>> # Build a batched mutation-selection model with one site per codon column of an alignment
+                   >>> f = ReadFrequencies("codon", file = "my_codon_alignment.fasta")
+                   >>> site_freqs = f.compute_site_frequencies(pseudocount = 0.5)
+                   >>> my_model = Model("mutsel", {"state_freqs": site_freqs})
+        '''
+        type = kwargs.get('type', self._by)
+        assert(type =='amino_acid' or type == 'codon' or type == 'nucleotide'), "Can only calculate codon, amino acid, or nucleotide frequencies."
+        if type == 'amino_acid' or type == 'codon':
+            assert(self._by == 'amino_acid' or self._by == 'codon'), "\n\nIncompatible *type* argument! If you would like to obtain amino acid or codon frequencies, the provided alphabet when defining this frequency object must be either 'codon' or 'amino_acid', NOT 'nucleotide'."
+        pseudocount = kwargs.get('pseudocount', 0.)
+        assert(pseudocount >= 0.), "\n\nThe *pseudocount* must be non-negative."
+        savefile = kwargs.get('savefile', None)
+        
+        # Counts are a bincount of flattened (column, state) indices. Indices are buffered until there are about as many as counts, so that each bincount costs no more than the chunks it covers.
+        width = self._size + 1
+        counts = np.zeros(self._numcol * width)
+        buffered, nbuffered = [], 0
+        for record, position, states in self._read_states(aligned = True):
+            buffered.append( (np.arange(position, position + len(states)) * width) + states )
+            nbuffered += len(states)
+            if nbuffered >= len(counts):
+                counts += np.bincount(np.concatenate(buffered), minlength = len(counts))
+                buffered, nbuffered = [], 0
+        if buffered:
+            counts += np.bincount(np.concatenate(buffered), minlength = len(counts))
+        counts = counts.reshape(-1, width)[:, :-1] + pseudocount
+        if self.which_columns is not None:
+            counts = counts[self.which_columns]
+        
+        totals = np.sum(counts, axis = 1)
+        counts[totals == 0.] = 1.
+        totals[totals == 0.] = self._size
+        site_freqs = counts / totals[:, np.newaxis]
+        if type != self._by:
+            site_freqs = np.dot(site_freqs, _conversion_matrix(self._by, type))
+        
+        if savefile is not None:
+            np.savetxt(savefile, site_freqs, fmt='%.5e')
+        return site_freqs
 
 
 
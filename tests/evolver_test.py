@@ -11,7 +11,9 @@
 '''
 
 import unittest
+import json
 import os
+from Bio import AlignIO
 from pyvolve import *
 ZERO=1e-8
 DECIMAL=8
@@ -522,6 +524,711 @@ class evolver_setcode(unittest.TestCase):
         self.assertTrue(evolve._code == self.g.amino_acids, msg = "Amino acids not properly assigned as code for an AA model.")
 
 
+class evolver_vectorized_branch_tests(unittest.TestCase):
+    '''
+        Tests for the vectorized sampling of child states along a branch.
+    '''
+
+    def setUp(self):
+        ''' 
+            Evolver and transition matrix set-up.
+        '''
+        tree = read_tree( tree = "(((t2:0.36,t1:0.45):0.001,t3:0.77):0.44,(t5:0.77,t4:0.41):0.89);" ) 
+        self.evolve = Evolver(partitions = Partition(models = Model("nucleotide"), size = 5), tree = tree)
+        self.P = np.array([ [0.7, 0.1, 0.0, 0.2], [0.25, 0.25, 0.25, 0.25], [0.0, 0.0, 1.0, 0.0], [0.05, 0.15, 0.3, 0.5] ])
+
+    
+    def test_evolver_cumulative_rows(self):
+        '''
+            Cumulative rows are offset by their parent state and end exactly at the next integer.
+        '''
+        cumulative = self.evolve._cumulative_rows(self.P)
+        np.testing.assert_array_almost_equal(cumulative[0], [0.7, 0.8, 0.8, 1.0], decimal = DECIMAL, err_msg = "First cumulative row improperly computed.")
+        np.testing.assert_array_almost_equal(cumulative[:, -1], [1., 2., 3., 4.], decimal = DECIMAL, err_msg = "Cumulative rows do not end at the next integer.")
+        self.assertTrue( np.all(np.diff(cumulative.ravel()) >= 0.), msg = "Flattened cumulative rows are not sorted.")
+
+
+    def test_evolver_sample_from_cumulative_distribution(self):
+        '''
+            Child states drawn in a single batch follow the rows of the transition matrix.
+        '''
+        self.evolve._rng = np.random.default_rng(12)
+        cumulative = self.evolve._cumulative_rows(self.P)
+        n = 50000
+        for parent in range(4):
+            child = self.evolve._sample_from_cumulative(cumulative, np.repeat(parent, n))
+            freqs = np.bincount(child, minlength = 4) / float(n)
+            np.testing.assert_allclose(freqs, self.P[parent], atol = 0.01, err_msg = "Vectorized sampling does not reproduce the transition probabilities.")
+            self.assertFalse( np.any(self.P[parent][child] == 0.), msg = "Vectorized sampling drew a state with zero probability.")
+        
+
+    def test_evolver_sample_from_cumulative_mixed_parents(self):
+        '''
+            Mixed parent states are each sampled from their own row.
+        '''
+        self.evolve._rng = np.random.default_rng(12)
+        cumulative = self.evolve._cumulative_rows(self.P)
+        parents = np.tile([2, 0, 2, 3], 1000)
+        child = self.evolve._sample_from_cumulative(cumulative, parents)
+        self.assertTrue( child.shape == parents.shape, msg = "Vectorized sampling returned the wrong shape.")
+        self.assertTrue( np.all(child[parents == 2] == 2), msg = "Absorbing state was not preserved by vectorized sampling.")
+        self.assertTrue( np.all(child[parents == 0] != 2), msg = "Vectorized sampling drew a state with zero probability.")
+
+
+class evolver_array_storage_tests(unittest.TestCase):
+    '''
+        Tests for the compact integer array representation of evolved sequences.
+    '''
+
+    def setUp(self):
+        ''' 
+            Tree and partition set-up, with gamma heterogeneity and invariant sites.
+        '''
+        self.tree = read_tree( tree = "(((t2:0.36,t1:0.45):0.001,t3:0.77):0.44,(t5:0.77,t4:0.41):0.89);" ) 
+        m = Model("nucleotide", alpha = 0.5, num_categories = 3, pinv = 0.3)
+        self.part = Partition(models = m, size = 200)
+
+
+    def test_evolver_array_storage_dtype(self):
+        '''
+            States and rate categories are stored as one small integer array per partition.
+        '''
+        evolve = Evolver(partitions = self.part, tree = self.tree)
+        evolve(ratefile = False, infofile=False, seqfile=False)
+        for record in evolve._evolved_states:
+            self.assertTrue( len(evolve._evolved_states[record]) == 1, msg = "More than one state array stored for a single partition.")
+            self.assertTrue( evolve._evolved_states[record][0].dtype == np.int8, msg = "Nucleotide states not stored as int8.")
+            self.assertTrue( len(evolve._evolved_states[record][0]) == 200, msg = "State array is the wrong length.")
+        self.assertTrue( evolve._site_rates[0].dtype == np.int8, msg = "Rate categories not stored as int8.")
+
+
+    def test_evolver_array_storage_shuffled_rates(self):
+        '''
+            After shuffling, rate categories still line up with the states: invariant sites never change.
+        '''
+        evolve = Evolver(partitions = self.part, tree = self.tree)
+        evolve(ratefile = False, infofile=False, seqfile=False)
+        invariant = evolve._site_rates[0] == 3
+        states = np.array( [evolve._evolved_states[record][0] for record in evolve._evolved_states] )
+        self.assertTrue( np.all(states[:, invariant] == states[0, invariant]), msg = "Invariant sites changed, or rate categories were not shuffled along with states.")
+        
+        
+    def test_evolver_array_storage_compare_sequences(self):
+        '''
+            Substitution counts are accumulated directly from state arrays.
+        '''
+        evolve = Evolver(partitions = self.part, tree = self.tree)
+        evolve.compare_sequences( np.array([0, 1, 2, 2, 3], dtype = np.int8), np.array([0, 2, 1, 1, 3], dtype = np.int8) )
+        self.assertTrue( evolve.substitution_counts[1][2] == 1 and evolve.substitution_counts[2][1] == 2, msg = "Substitution counts improperly computed from state arrays.")
+        self.assertTrue( np.sum(evolve.substitution_counts) == 3, msg = "Unchanged sites were counted as substitutions.")
+
+
+    def test_evolver_array_storage_root_states(self):
+        '''
+            Root states for all sites are sampled at once, and match sampling each site individually.
+        '''
+        evolve = Evolver(partitions = self.part, tree = self.tree)
+        freqs = np.array([0.1, 0.4, 0.2, 0.3])
+        r = np.append( np.random.default_rng(5).random(500), [0., 0.1, 0.5, 1.] )
+        np.testing.assert_array_equal( evolve._generate_root_states(freqs, r), [ evolve._generate_prob_from_unif(freqs, x) for x in r ], err_msg = "Bulk root sampling differs from sampling each site individually.")
+        for (root_type, state) in [("min", 0), ("max", 1)]:
+            evolve.select_root_type = root_type
+            self.assertTrue( np.all(evolve._generate_root_states(freqs, r.reshape(2, -1)) == state), msg = "Root states improperly chosen for select_root_type " + root_type + ".")
+
+
+class evolver_exponentiation_tests(unittest.TestCase):
+    '''
+        Tests for the choice of matrix exponentiation method.
+    '''
+
+    def setUp(self):
+        self.tree = read_tree( tree = "(((t2:0.36,t1:0.45):0.001,t3:0.77):0.44,(t5:0.77,t4:0.41):0.89);" ) 
+        self.part = Partition(models = Model("GY", {"omega":[0.2, 1.5]}), size = 10)
+
+    def test_evolver_exponentiation_methods_agree(self):
+        '''
+            The eigendecomposition and expm give the same transition matrices.
+        '''
+        eigen = Evolver(partitions = self.part, tree = self.tree)
+        expm  = Evolver(partitions = self.part, tree = self.tree, exponentiation = "expm")
+        for i in range(2):
+            np.testing.assert_array_almost_equal(eigen._exponentiate_matrix(self.part.models[0], i, 0.3), expm._exponentiate_matrix(self.part.models[0], i, 0.3), decimal = DECIMAL, err_msg = "Exponentiation methods do not agree.")
+
+    def test_evolver_exponentiation_precomputed(self):
+        '''
+            Transition matrices for a range of branches are computed together, and match those computed one branch at a time.
+        '''
+        for method in ["eigen", "expm"]:
+            evolve = Evolver(partitions = self.part, tree = self.tree, exponentiation = method)
+            cache = evolve._precompute_transition_matrices(0, len(evolve._tree))
+            self.assertTrue( len(cache) == 2 * 7, msg = "Transition matrices were not precomputed once for every distinct branch length and rate category.") # t3 and t5 share a branch length
+            for (model_id, i, t) in cache:
+                np.testing.assert_array_almost_equal(cache[(model_id, i, t)], evolve._cumulative_rows(evolve._exponentiate_matrix(self.part.models[0], i, t)), decimal = DECIMAL, err_msg = "Precomputed transition matrices differ from individually computed ones.")
+            self.assertTrue( len(evolve._precompute_transition_matrices(1, 3)) == 2 * 2, msg = "Transition matrices were not precomputed for the requested branches only.")
+
+    def test_evolver_exponentiation_bounded_cache(self):
+        '''
+            On a wide tree whose branches all have distinct lengths, transition matrices are computed in chunks of branches as they are reached, so that no more than a chunk's worth are held at once.
+        '''
+        tips = ",".join( "t" + str(i) + ":" + str(0.01 + i / 1e5) for i in range(1000) )
+        for kwargs in [ {}, {"workers": 1}, {"workers": 3}, {"low_memory": True, "seqfile": "bounded_cache_test.fasta"} ]:
+            evolve = Evolver(partitions = Partition(models = Model("nucleotide", alpha = 0.5, num_categories = 2), size = 10), tree = read_tree(tree = "(" + tips + ");"))
+            sizes = []
+            precompute = evolve._precompute_transition_matrices
+            def recording_precompute(start, stop):
+                cache = precompute(start, stop)
+                sizes.append( len(cache) )
+                return cache
+            evolve._precompute_transition_matrices = recording_precompute
+            evolve(**dict({"seqfile": False, "ratefile": False, "infofile": False}, **kwargs))
+            self.assertTrue( len(sizes) > 1 and max(sizes) <= 2 * TRANSITION_CHUNK, msg = "Transition matrices were not computed in bounded chunks.")
+        os.remove("bounded_cache_test.fasta")
+
+    def test_evolver_exponentiation_bad_method(self):
+        '''
+            Unknown exponentiation methods are rejected.
+        '''
+        self.assertRaises(AssertionError, Evolver, partitions = self.part, tree = self.tree, exponentiation = "taylor")
+
+
+class evolver_replicates_tests(unittest.TestCase):
+    '''
+        Tests for simulating batches of replicates with Evolver.simulate_replicates.
+    '''
+
+    def setUp(self):
+        self.tree = read_tree( tree = "(((t2:0.36,t1:0.45):0.001,t3:0.77):0.44,(t5:0.77,t4:0.41):0.89);" ) 
+        self.part = Partition(models = Model("GY", {"omega":[0.2, 1.5]}), size = 50)
+        self.evolve = Evolver(partitions = self.part, tree = self.tree)
+
+    def test_evolver_replicates_number_and_size(self):
+        '''
+            The requested number of replicates is yielded, each with full-length sequences.
+        '''
+        replicates = list(self.evolve.simulate_replicates(4, seed = 1))
+        self.assertTrue(len(replicates) == 4, msg = "Wrong number of replicates simulated.")
+        for rep in replicates:
+            seqs = rep.get_sequences()
+            self.assertTrue(len(seqs) == 5, msg = "Replicate has the wrong number of leaf sequences.")
+            self.assertTrue(len(rep.get_sequences(anc = True)) == 5, msg = "Ancestral sequences saved in replicate without write_anc.")
+            for entry in seqs:
+                self.assertTrue(len(seqs[entry]) == 150, msg = "Replicate sequences have the wrong length.")
+        self.assertTrue(replicates[0].get_sequences() != replicates[1].get_sequences(), msg = "Replicates are identical.")
+
+
+    def test_evolver_replicates_batching(self):
+        '''
+            Replicates do not depend on batching, and each can be reproduced alone from its seed.
+        '''
+        together = list(self.evolve.simulate_replicates(5, seed = 7))
+        batched  = list(self.evolve.simulate_replicates(5, seed = 7, batch_size = 2))
+        for i in range(5):
+            self.assertTrue(together[i].get_sequences() == batched[i].get_sequences(), msg = "Replicates depend on the batch size.")
+        alone = list(self.evolve.simulate_replicates(1, seeds = [together[3].seed], write_anc = True))[0]
+        self.assertTrue(alone.get_sequences() == together[3].get_sequences(), msg = "Replicate was not reproduced from its seed.")
+        self.assertTrue(np.array_equal(alone.site_rates[0], together[3].site_rates[0]), msg = "Replicate rate categories were not reproduced from its seed.")
+        self.assertTrue(len(alone.get_sequences(anc = True)) == 9, msg = "Ancestral sequences not saved in replicate with write_anc.")
+
+
+class evolver_parallel_replicates_tests(unittest.TestCase):
+    '''
+        Tests for simulating replicates over a pool of worker processes.
+    '''
+
+    def test_evolver_parallel_replicates_reproducible(self):
+        '''
+            Replicates are identical whether simulated in this process or over any number of workers.
+        '''
+        tree = read_tree( tree = "(((t2:0.36,t1:0.45):0.001,t3:0.77):0.44,(t5:0.77,t4:0.41):0.89);" ) 
+        evolve = Evolver(partitions = Partition(models = Model("nucleotide", alpha = 0.5), size = 50), tree = tree)
+        serial = [rep.get_sequences() for rep in evolve.simulate_replicates(6, seed = 11)]
+        for workers in [2, 3]:
+            parallel = list(evolve.simulate_replicates(6, seed = 11, workers = workers))
+            self.assertTrue([rep.index for rep in parallel] == list(range(6)), msg = "Parallel replicates were not returned in order.")
+            self.assertTrue([rep.get_sequences() for rep in parallel] == serial, msg = "Parallel replicates depend on the number of workers.")
+
+
+    def test_evolver_parallel_replicates_trees(self):
+        '''
+            Replicates along a stream of trees match replicates simulated along each tree alone, in this process or over workers, and running out of trees is an error.
+        '''
+        m1 = Model("nucleotide", {"kappa":2.}, name = "m1")
+        m2 = Model("nucleotide", {"kappa":8.}, name = "m2")
+        part = Partition(models = [m1, m2], root_model_name = "m1", size = 40)
+        tree = read_tree( tree = "(t1:0.1,t2:0.2);" ) 
+        evolve = Evolver(partitions = part, tree = tree)
+        
+        trees = list( read_trees(file = 'tests/newickFiles/test_trees.tre') )[:2]
+        seeds = np.random.SeedSequence(4).spawn(2)
+        expected = [ list(Evolver(partitions = part, tree = trees[i]).simulate_replicates(1, seeds = [seeds[i]]))[0].get_sequences() for i in range(2) ]
+        for workers in [None, 2]:
+            reps = list( evolve.simulate_replicates(2, seed = 4, trees = iter(trees), workers = workers) )
+            self.assertTrue( [rep.get_sequences() for rep in reps] == expected, msg = "Replicates along a stream of trees differ from replicates along each tree.")
+        self.assertTrue( evolve._tree.names == ["root", "t1", "t2"], msg = "Evolver's own tree was not restored after simulating along a stream of trees.")
+        self.assertRaises( AssertionError, list, evolve.simulate_replicates(3, trees = trees) )
+
+
+class evolver_rng_tests(unittest.TestCase):
+    '''
+        Tests that all sampling is drawn from a single numpy Generator.
+    '''
+
+    def setUp(self):
+        ''' 
+            Tree and partition set-up, with rate heterogeneity so that sites are shuffled.
+        '''
+        self.tree = read_tree( tree = "(((t2:0.36,t1:0.45):0.001,t3:0.77):0.44,(t5:0.77,t4:0.41):0.89);" ) 
+        m = Model("nucleotide", alpha = 0.5, num_categories = 3)
+        self.part = Partition(models = m, size = 100, rng = np.random.default_rng(3))
+
+
+    def test_evolver_rng_seed_reproducible(self):
+        '''
+            Two calls with the same seed give identical sequences and rates.
+        '''
+        evolve = Evolver(partitions = self.part, tree = self.tree)
+        evolve(ratefile = False, infofile = False, seqfile = False, seed = 5)
+        seqs, rates = evolve.get_sequences(anc = True), evolve._site_rates[0]
+        evolve(ratefile = False, infofile = False, seqfile = False, seed = 5)
+        self.assertTrue( seqs == evolve.get_sequences(anc = True), msg = "Seeded simulations were not reproduced.")
+        self.assertTrue( np.array_equal(rates, evolve._site_rates[0]), msg = "Seeded rate categories were not reproduced.")
+        
+        
+    def test_evolver_rng_provided_generator(self):
+        '''
+            A provided Generator is used when no seed is given, and a non-integer seed is rejected.
+        '''
+        seqs = []
+        for i in range(2):
+            evolve = Evolver(partitions = self.part, tree = self.tree, rng = np.random.default_rng(8))
+            evolve(ratefile = False, infofile = False, seqfile = False)
+            seqs.append( evolve.get_sequences() )
+        self.assertTrue( seqs[0] == seqs[1], msg = "Simulations from identically seeded Generators differ.")
+        self.assertRaises( AssertionError, evolve, ratefile = False, infofile = False, seqfile = False, seed = 1.5 )
+
+
+    def test_evolver_rng_flat_tree(self):
+        '''
+            An Evolver given a FlatTree simulates the same sequences as one given the Node tree it was compiled from.
+        '''
+        seqs = []
+        for tree in [self.tree, FlatTree(self.tree)]:
+            evolve = Evolver(partitions = self.part, tree = tree)
+            evolve(ratefile = False, infofile = False, seqfile = False, seed = 5, write_anc = True)
+            seqs.append( evolve.get_sequences(anc = True) )
+        self.assertTrue( seqs[0] == seqs[1], msg = "Simulations along a FlatTree and a Node tree differ.")
+
+
+    def test_evolver_rng_partition_sizes(self):
+        '''
+            Partition rate category sizes are reproducible from a provided Generator.
+        '''
+        m = Model("nucleotide", alpha = 0.5, num_categories = 3)
+        sizes = [ Partition(models = m, size = 100, rng = np.random.default_rng(4)).size for i in range(2) ]
+        self.assertTrue( sizes[0] == sizes[1], msg = "Partition sizes were not reproduced from a seeded Generator.")
+        self.assertTrue( sum(sizes[0]) == 100, msg = "Partition sizes do not sum to the partition length.")
+
+
+class evolver_parallel_subtree_tests(unittest.TestCase):
+    '''
+        Tests for evolving independent subtrees over a pool of threads or processes.
+    '''
+
+    def setUp(self):
+        ''' 
+            Tree and partition set-up, with rate heterogeneity and a branch-specific model flag.
+        '''
+        self.tree = read_tree( tree = "((((t1:0.1,t2:0.2):0.05,(t3:0.3,t4:0.1):0.02):0.1,(t5:0.2,(t6:0.1,t7:0.4):0.2):0.1):0.2,((t8:0.1,t9:0.3):0.1,t10:0.5):0.3);" ) 
+        m = Model("nucleotide", alpha = 0.5, num_categories = 3)
+        self.evolve = Evolver(partitions = Partition(models = m, size = 80, rng = np.random.default_rng(2)), tree = self.tree)
+
+
+    def _run(self, **kwargs):
+        self.evolve.substitution_counts[:] = 0.
+        self.evolve(ratefile = False, infofile = False, seqfile = False, seed = 7, **kwargs)
+        return self.evolve.get_sequences(anc = True), list(self.evolve.get_sequences(anc = True).keys()), self.evolve.substitution_counts.copy()
+
+
+    def test_evolver_parallel_subtree_reproducible(self):
+        '''
+            Sequences, their order, and substitution counts do not depend on the number of workers or the executor.
+        '''
+        serial = self._run(workers = 1)
+        for kwargs in [ {"workers": 3}, {"workers": 8, "executor": "thread"}, {"workers": 2, "executor": "process"} ]:
+            parallel = self._run(**kwargs)
+            self.assertTrue( parallel[0] == serial[0], msg = "Subtree-parallel sequences depend on scheduling.")
+            self.assertTrue( parallel[1] == serial[1], msg = "Subtree-parallel sequences are not in tree order.")
+            np.testing.assert_array_equal( parallel[2], serial[2], err_msg = "Subtree-parallel substitution counts depend on scheduling.")
+
+
+    def test_evolver_parallel_subtree_deep_tree(self):
+        '''
+            On a deep caterpillar tree, subtree-parallel simulations match the serial one, and each subtree left once no subtree holds more than 1/(4*workers) of the tree is submitted as exactly one task.
+        '''
+        tree = "t0:0.01"
+        for i in range(1, 2000):
+            tree = "(" + tree + ",t" + str(i) + ":0.01):0.01"
+        self.evolve = Evolver(partitions = Partition(models = Model("nucleotide"), size = 100), tree = read_tree(tree = tree + ";"))
+        serial = self._run(workers = 1)
+        
+        flat = self.evolve._tree
+        target = len(flat) / (4. * 4)
+        expected_tasks = sorted( i for i in range(1, len(flat)) if flat.subtree_size[i] <= target and flat.subtree_size[ flat.parent[i] ] > target )
+        tasks = []
+        sim_subtree = self.evolve._sim_subtree
+        def counting_sim_subtree(index, root_seed_seq = None):
+            tasks.append(index)
+            return sim_subtree(index, root_seed_seq)
+        self.evolve._sim_subtree = counting_sim_subtree
+        parallel = self._run(workers = 4, executor = "thread")
+        self.assertTrue( parallel[0] == serial[0], msg = "Subtree-parallel sequences differ from serial ones on a deep tree.")
+        self.assertEqual( sorted(tasks), expected_tasks, msg = "Subtree-parallel simulation of a deep tree did not submit one task per frontier subtree.")
+        del self.evolve._sim_subtree
+        
+        parallel = self._run(workers = 2, executor = "process")
+        self.assertTrue( parallel[0] == serial[0], msg = "Subtree-parallel sequences differ from serial ones on a deep tree.")
+
+
+    def test_evolver_parallel_subtree_bad_executor(self):
+        '''
+            Unknown executors and non-integer worker counts are rejected.
+        '''
+        self.assertRaises( AssertionError, self._run, workers = 2, executor = "cluster" )
+        self.assertRaises( AssertionError, self._run, workers = 1.5 )
+
+
+class evolver_low_memory_tests(unittest.TestCase):
+    '''
+        Tests for the low-memory mode, in which sequences are written as they are evolved.
+    '''
+
+    def setUp(self):
+        ''' 
+            Tree and partitions set-up, with rate heterogeneity so that sites are shuffled.
+        '''
+        self.tree = read_tree( tree = "((((t1:0.1,t2:0.2):0.05,(t3:0.3,t4:0.1):0.02):0.1,(t5:0.2,(t6:0.1,t7:0.4):0.2):0.1):0.2,((t8:0.1,t9:0.3):0.1,t10:0.5):0.3);" ) 
+        parts = [ Partition(models = Model("nucleotide", alpha = 0.5, num_categories = 3), size = 60, rng = np.random.default_rng(5)), Partition(models = Model("nucleotide"), size = 20) ]
+        self.evolve = Evolver(partitions = parts, tree = self.tree)
+        self.seqfile = "low_memory_test.fasta"
+        self.ratefile = "low_memory_test_rates.txt"
+        
+
+    def tearDown(self):
+        for f in [self.seqfile, self.seqfile[:-4] + ".npy", self.ratefile]:
+            if os.path.exists(f):
+                os.remove(f)
+
+
+    def _read_fasta(self):
+        aln = AlignIO.read(self.seqfile, "fasta")
+        return [record.id for record in aln], dict( (record.id, str(record.seq)) for record in aln )
+
+
+    def test_evolver_low_memory_matches_standard(self):
+        '''
+            Streamed sequences, their order, and rates are identical to those of a standard simulation with one worker.
+        '''
+        for write_anc in [False, True]:
+            self.evolve(seqfile = False, ratefile = self.ratefile, infofile = False, seed = 3, workers = 1, write_anc = write_anc)
+            expected = self.evolve.get_sequences(anc = write_anc)
+            with open(self.ratefile, 'r') as f:
+                expected_rates = f.read()
+            
+            self.evolve(seqfile = self.seqfile, ratefile = self.ratefile, infofile = False, seed = 3, low_memory = True, write_anc = write_anc)
+            names, seqs = self._read_fasta()
+            self.assertTrue( names == list(expected.keys()), msg = "Low-memory sequences are not written in tree order.")
+            self.assertTrue( seqs == expected, msg = "Low-memory sequences differ from a standard simulation.")
+            with open(self.ratefile, 'r') as f:
+                self.assertTrue( f.read() == expected_rates, msg = "Low-memory rate categories differ from a standard simulation.")
+
+
+    def test_evolver_low_memory_releases_sequences(self):
+        '''
+            No sequence is kept after a low-memory simulation, and workers > 1 is rejected.
+        '''
+        self.evolve(seqfile = self.seqfile, ratefile = False, infofile = False, low_memory = True)
+        self.assertTrue( self.evolve.get_sequences() == {}, msg = "Sequences were kept in low-memory mode.")
+        self.assertRaises( AssertionError, self.evolve, seqfile = False, low_memory = True, workers = 2 )
+
+
+    def test_evolver_low_memory_deep_tree(self):
+        '''
+            A deep caterpillar tree, whose internal nodes are their parent's last child, is simulated in low-memory mode holding only a few sequences at a time, and gives the same sequences as a standard simulation.
+        '''
+        tree = "t0:0.01"
+        for i in range(1, 2000):
+            tree = "(t" + str(i) + ":0.01," + tree + "):0.01"
+        evolve = Evolver(partitions = Partition(models = Model("nucleotide"), size = 100), tree = read_tree(tree = tree + ";"))
+        evolve(seqfile = False, ratefile = False, infofile = False, seed = 7, workers = 1)
+        expected = evolve.get_sequences()
+        
+        live = []
+        evolve_branch = evolve._evolve_branch
+        def counting_evolve_branch(index, rng = None, cache = None):
+            live.append( sum(states is not None for states in evolve._node_states) )
+            return evolve_branch(index, rng, cache)
+        evolve._evolve_branch = counting_evolve_branch
+        evolve(seqfile = self.seqfile, ratefile = False, infofile = False, seed = 7, low_memory = True)
+        self.assertTrue( self._read_fasta()[1] == expected, msg = "Low-memory sequences differ from a standard simulation on a deep tree.")
+        self.assertEqual( len(live), len(evolve._tree) - 1, msg = "Low-memory simulation did not evolve every branch.")
+        self.assertLessEqual( max(live), 3, msg = "Low-memory simulation of a deep tree holds sequences which are no longer needed.")
+
+
+class evolver_native_writer_tests(unittest.TestCase):
+    '''
+        Tests for the native FASTA, relaxed PHYLIP, and NEXUS writers.
+    '''
+
+    def setUp(self):
+        ''' 
+            Tree set-up.
+        '''
+        self.tree = read_tree( tree = "(((t2:0.36,t1:0.45):0.001,t3:0.77):0.44,(t5:0.77,t4:0.41):0.89);" ) 
+        self.seqfile = "native_writer_test.txt"
+        
+        
+    def tearDown(self):
+        if os.path.exists(self.seqfile):
+            os.remove(self.seqfile)
+
+
+    def test_evolver_native_writer_formats(self):
+        '''
+            Nucleotide, amino acid, and codon alignments written natively are read back by Biopython, with ancestors and in order.
+        '''
+        for model in [Model("nucleotide"), Model("WAG"), Model("GY", {"omega": 0.5})]:
+            evolve = Evolver(partitions = Partition(models = model, size = 70), tree = self.tree)
+            for seqfmt in ["fasta", "phylip-relaxed", "nexus"]:
+                evolve(seqfile = self.seqfile, seqfmt = seqfmt, ratefile = False, infofile = False, write_anc = True)
+                aln = AlignIO.read(self.seqfile, seqfmt)
+                self.assertTrue( [record.id for record in aln] == list(evolve.get_sequences(anc = True).keys()), msg = "Native " + seqfmt + " writer changed the order of sequences.")
+                self.assertTrue( dict( (record.id, str(record.seq)) for record in aln ) == evolve.get_sequences(anc = True), msg = "Native " + seqfmt + " writer did not write the simulated sequences.")
+
+    
+    def test_evolver_native_writer_low_memory(self):
+        '''
+            Streamed sequences are written natively in formats which need the number of sequences in their header.
+        '''
+        evolve = Evolver(partitions = Partition(models = Model("nucleotide"), size = 50), tree = self.tree)
+        evolve(seqfile = self.seqfile, seqfmt = "nexus", ratefile = False, infofile = False, seed = 2, low_memory = True)
+        aln = AlignIO.read(self.seqfile, "nexus")
+        evolve(seqfile = False, ratefile = False, infofile = False, seed = 2, workers = 1)
+        self.assertTrue( dict( (record.id, str(record.seq)) for record in aln ) == evolve.get_sequences(), msg = "Streamed NEXUS file does not contain the simulated sequences.")
+
+
+class evolver_npz_tests(unittest.TestCase):
+    '''
+        Tests for saving simulated alignments as binary numpy archives.
+    '''
+
+    def setUp(self):
+        ''' 
+            Tree and partitions set-up.
+        '''
+        self.tree = read_tree( tree = "(((t2:0.36,t1:0.45):0.001,t3:0.77):0.44,(t5:0.77,t4:0.41):0.89);" ) 
+        self.parts = [ Partition(models = Model("nucleotide", alpha = 0.5, num_categories = 3), size = 40), Partition(models = Model("nucleotide"), size = 15) ]
+        self.seqfile = "npz_test.npz"
+        self.ratefile = "npz_test_rates.txt"
+        
+        
+    def tearDown(self):
+        for f in [self.seqfile, self.seqfile[:-4] + ".npy", self.ratefile]:
+            if os.path.exists(f):
+                os.remove(f)
+
+
+    def test_evolver_npz_contents(self):
+        '''
+            The archive holds the simulated alignment, names, code, site rates, and run settings.
+        '''
+        evolve = Evolver(partitions = self.parts, tree = self.tree)
+        for low_memory in [False, True]:
+            evolve(seqfile = self.seqfile, seqfmt = "npz", ratefile = self.ratefile, infofile = False, seed = 4, write_anc = True, low_memory = low_memory)
+            data = np.load(self.seqfile)
+            self.assertTrue( data["alignment"].dtype == np.uint8 and data["alignment"].shape == (9, 55), msg = "Alignment matrix has the wrong type or shape.")
+            if not low_memory:
+                seqs = dict( (name, "".join(data["code"][row])) for (name, row) in zip(data["names"], data["alignment"]) )
+                self.assertTrue( seqs == evolve.get_sequences(anc = True), msg = "Alignment matrix does not hold the simulated sequences.")
+            rates = np.loadtxt(self.ratefile, skiprows = 1, dtype = int)
+            np.testing.assert_array_equal( data["partition"], rates[:,1], err_msg = "Site partitions differ from the ratefile.")
+            np.testing.assert_array_equal( data["rate_category"], rates[:,2], err_msg = "Site rate categories differ from the ratefile.")
+            metadata = json.loads( str(data["metadata"]) )
+            self.assertTrue( metadata["seed"] == 4 and len(metadata["partitions"]) == 2, msg = "Metadata improperly saved.")
+            mapped = np.load("npz_test.npy", mmap_mode = "r")
+            self.assertTrue( isinstance(mapped, np.memmap), msg = "Alignment matrix cannot be memory-mapped.")
+            np.testing.assert_array_equal( mapped, data["alignment"], err_msg = "Memory-mapped alignment differs from the archive.")
+            del mapped
+            data.close()
+
+
+    def test_evolver_npz_numpy_metadata(self):
+        '''
+            Settings given as numpy scalars are saved in the metadata as plain numbers.
+        '''
+        evolve = Evolver(partitions = self.parts, tree = self.tree)
+        evolve(seqfile = self.seqfile, seqfmt = "npz", ratefile = False, infofile = False, seed = np.int64(4), scale_tree = np.float32(2.))
+        with np.load(self.seqfile) as data:
+            metadata = json.loads( str(data["metadata"]) )
+        self.assertTrue( metadata["seed"] == 4 and metadata["scale_tree"] == 2., msg = "Numpy settings improperly saved in the metadata.")
+
+
+    def test_evolver_npz_default_seqfile(self):
+        '''
+            Without a seqfile, the archive is saved with the npz extension.
+        '''
+        self.seqfile = "simulated_alignment.npz"
+        evolve = Evolver(partitions = self.parts, tree = self.tree)
+        evolve(seqfmt = "npz", ratefile = False, infofile = False)
+        self.assertTrue( os.path.exists(self.seqfile) and not os.path.exists("simulated_alignment.fasta.npz"), msg = "Archive not saved to simulated_alignment.npz by default.")
+
+
+class evolver_batched_model_tests(unittest.TestCase):
+    '''
+        Tests for evolving partitions with a batched model, which has one rate matrix per site.
+    '''
+
+    def setUp(self):
+        ''' 
+            Tree and partition set-up.
+        '''
+        self.tree = read_tree( tree = "(((t2:0.36,t1:0.45):0.001,t3:0.77):0.44,(t5:0.77,t4:0.41):0.89);" ) 
+        rng = np.random.default_rng(7)
+        self.model = Model("mutsel", {"fitness":rng.normal(0., 2., size = (25, 61))})
+        self.part = Partition(models = self.model)
+
+
+    def test_evolver_batched_model_partition_size(self):
+        '''
+            Partitions take their size from batched models, and reject other sizes.
+        '''
+        self.assertTrue( self.part.size == [25], msg = "Partition size not taken from batched model.")
+        self.assertRaises(AssertionError, Partition, models = self.model, size = 10)
+        self.assertRaises(AssertionError, Partition, models = [self.model, Model("mutsel", {"fitness":np.zeros(61)}, name = "m2")], root_model_name = self.model.name)
+
+
+    def test_evolver_batched_model_evolution(self):
+        '''
+            Batched models evolve reproducibly with either exponentiation method, and each site follows its own matrix.
+        '''
+        seqs = []
+        for method in ["eigen", "expm"]:
+            evolve = Evolver(partitions = self.part, tree = self.tree, exponentiation = method)
+            evolve(seqfile = None, ratefile = None, infofile = None, seed = 8)
+            seqs.append( evolve.get_sequences() )
+        self.assertTrue( seqs[0] == seqs[1], msg = "Exponentiation methods give different sequences for a batched model.")
+        self.assertTrue( len(seqs[0]["t1"]) == 75, msg = "Sequences from a batched model have the wrong length.")
+        
+        # Sampling a site from a row of its own transition matrix
+        rows = self.model.transition_rows(0.5, np.arange(25) % 61)
+        r = np.random.default_rng(2).random(25)
+        np.testing.assert_array_equal( evolve._sample_from_rows(rows, r), [ evolve._generate_prob_from_unif(rows[i], r[i]) for i in range(25) ], err_msg = "Batched sampling differs from sampling each site individually.")
+
+
+class evolver_uniformization_tests(unittest.TestCase):
+    '''
+        Tests for evolving sites with the uniformization engine.
+    '''
+
+    def setUp(self):
+        ''' 
+            Tree and partition set-up.
+        '''
+        self.tree = read_tree( tree = "(((t2:0.36,t1:0.45):0.001,t3:0.77):0.44,(t5:0.77,t4:0.41):0.89);" ) 
+        self.part = Partition(models = Model("nucleotide", {"kappa":3.5}, alpha = 0.5, num_categories = 2), size = 200, rng = np.random.default_rng(3))
+
+
+    def test_evolver_uniformization_distribution(self):
+        '''
+            Sites evolved from a fixed state follow the row of the transition matrix for that state.
+        '''
+        evolve = Evolver(partitions = self.part, tree = self.tree, engine = "uniformization")
+        model = self.part.models[0]
+        states, events, counts = evolve._uniformize(model, 1, np.zeros(20000, dtype = int), 0.6, np.random.default_rng(11))
+        P = evolve._exponentiate_matrix(model, 1, 0.6)
+        np.testing.assert_allclose( np.bincount(states, minlength = 4) / 20000., P[0], atol = 0.015, err_msg = "Uniformization does not sample from the transition matrix.")
+        self.assertTrue( np.all(events[states != 0] >= 1), msg = "Changed sites have no recorded substitutions.")
+
+
+    def test_evolver_uniformization_event_counts(self):
+        '''
+            Event counts are reproducible, cover every branch, and are consistent with the sequences on either end of each branch.
+        '''
+        evolve = Evolver(partitions = self.part, tree = self.tree, engine = "uniformization")
+        evolve(seqfile = None, ratefile = None, infofile = None, seed = 6)
+        seqs, counts = evolve.get_sequences(anc = True), evolve.get_event_counts()
+        evolve(seqfile = None, ratefile = None, infofile = None, seed = 6)
+        self.assertTrue( seqs == evolve.get_sequences(anc = True), msg = "Seeded uniformization simulations were not reproduced.")
+        self.assertTrue( len(counts) == 8, msg = "Event counts are not recorded for every branch.")
+        
+        nodes = [self.tree]
+        while nodes:
+            node = nodes.pop()
+            for child in node.children:
+                changed = np.array(list(seqs[child.name])) != np.array(list(seqs[node.name]))
+                self.assertTrue( np.all(counts[child.name][changed] >= 1), msg = "Changed sites have no recorded substitutions.")
+                nodes.append(child)
+        
+        # Substitution counts include every substitution along each branch
+        evolve = Evolver(partitions = self.part, tree = self.tree, engine = "uniformization")
+        evolve(seqfile = None, ratefile = None, infofile = None, seed = 6)
+        self.assertTrue( np.sum(evolve.substitution_counts) == np.sum([ np.sum(c) for c in counts.values() ]), msg = "Substitution counts and event counts disagree.")
+        
+
+    def test_evolver_uniformization_bad_engine(self):
+        '''
+            Unknown engines, and batched models with uniformization, are rejected.
+        '''
+        self.assertRaises(AssertionError, Evolver, partitions = self.part, tree = self.tree, engine = "gillespie")
+        batched = Partition(models = Model("mutsel", {"fitness":np.zeros((5, 61))}))
+        self.assertRaises(AssertionError, Evolver, partitions = batched, tree = self.tree, engine = "uniformization")
+
+class evolver_branch_counts_tests(unittest.TestCase):
+    '''
+        Tests for recording substitution counts along each branch.
+    '''
+
+    def setUp(self):
+        ''' 
+            Tree and partition set-up, with rate heterogeneity in one partition.
+        '''
+        self.tree = read_tree( tree = "(((t2:0.36,t1:0.45):0.001,t3:0.77):0.44,(t5:0.77,t4:0.41):0.89);" ) 
+        self.parts = [Partition(models = Model("nucleotide", alpha = 0.5, num_categories = 3), size = 150, rng = np.random.default_rng(3)), Partition(models = Model("nucleotide"), size = 50)]
+
+
+    def test_evolver_branch_counts_match_sequences(self):
+        '''
+            Branch counts are the substitutions between the sequences on either end of each branch, and sum to the total substitution counts.
+        '''
+        evolve = Evolver(partitions = self.parts, tree = self.tree)
+        evolve(seqfile = None, ratefile = None, infofile = None, seed = 4, branch_counts = True)
+        names, counts = evolve.get_branch_counts()
+        self.assertTrue( counts.shape == (8, 4, 4) and self.tree.name not in names, msg = "Branch counts have the wrong shape.")
+        np.testing.assert_array_equal( np.sum(counts, axis = 0), evolve.substitution_counts, err_msg = "Branch counts do not sum to the total substitution counts.")
+        
+        states = evolve._evolved_states
+        nodes = [self.tree]
+        while nodes:
+            node = nodes.pop()
+            for child in node.children:
+                expected = np.sum([ evolve._count_substitutions(states[node.name][p], states[child.name][p]) for p in range(2) ], axis = 0)
+                np.testing.assert_array_equal( counts[names.index(child.name)], expected, err_msg = "Branch counts differ from the substitutions between parent and child.")
+                nodes.append(child)
+        np.testing.assert_array_equal( evolve.get_branch_counts(sparse = True)[1].toarray(), counts.reshape(8, 16), err_msg = "Sparse branch counts differ from dense branch counts.")
+        
+        
+    def test_evolver_branch_counts_workers(self):
+        '''
+            Branch counts are gathered from worker processes, and are only available when requested.
+        '''
+        counts = []
+        for executor in ["thread", "process"]:
+            evolve = Evolver(partitions = self.parts, tree = self.tree, engine = "uniformization")
+            evolve(seqfile = None, ratefile = None, infofile = None, seed = 4, branch_counts = True, workers = 2, executor = executor)
+            counts.append( evolve.get_branch_counts() )
+        self.assertTrue( counts[0][0] == counts[1][0], msg = "Branch order differs between executors.")
+        np.testing.assert_array_equal( counts[0][1], counts[1][1], err_msg = "Branch counts differ between executors.")
+        evolve(seqfile = None, ratefile = None, infofile = None, seed = 4)
+        self.assertRaises(AssertionError, evolve.get_branch_counts)
             
 # def run_evolver_test():
 # 
@@ -0,0 +1,47 @@
+#! /usr/bin/env python
+
+##############################################################################
+##  pyvolve: Python platform for simulating evolutionary sequences.
+##
+##  Written by Stephanie J. Spielman (stephanie.spielman@gmail.com)
+##############################################################################
+
+'''
+    Test that importing pyvolve stays fast, by leaving slow imports until they are needed.
+'''
+
+
+import os
+import sys
+import unittest
+import subprocess
+import pyvolve
+
+LAZY_MODULES = ["Bio", "scipy.linalg", "scipy.stats", "scipy.special", "pyvolve.empirical_matrices"]
+
+
+class import_tests(unittest.TestCase):
+    '''
+        Suite of tests for the import time of pyvolve, which is paid by every process using it.
+    '''
+
+    def setUp(self):
+        '''
+            Import pyvolve in a fresh interpreter, and list the modules it imported.
+        '''
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.pathsep.join( [os.path.dirname(os.path.dirname(pyvolve.__file__)), env.get("PYTHONPATH", "")] )
+        script = "import sys, pyvolve; print(' '.join(sys.modules))"
+        result = subprocess.run([sys.executable, "-c", script], env = env, stdout = subprocess.PIPE, universal_newlines = True, check = True)
+        self.modules = result.stdout.split()
+
+
+    def test_import_lazy_modules(self):
+        '''
+            Biopython, scipy submodules, and the empirical matrices are only imported once a feature needs them.
+        '''
+        for name in LAZY_MODULES:
+            self.assertNotIn(name, self.modules, msg = name + " should not be imported with pyvolve.")
+        self.assertEqual(len(pyvolve.wag_matrix), 20)
+        self.assertIs(pyvolve.empirical_matrices.wag_matrix, pyvolve.wag_matrix)
+
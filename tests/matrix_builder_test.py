@@ -67,6 +67,27 @@ class matrixBuilder_baseClass_tests(unittest.TestCase):
                     self.assertFalse( self.baseObject._is_syn(source, target), msg = ("matrixBuilder._is_syn() mistakenly thinks", source, " -> ", target, " is synonymous.") )
 
 
+    def test_Genetics_codon_pair_tables(self):
+        ''' Test that the codon pair tables in Genetics agree with the string-based codon comparisons, and cannot be modified. '''
+        for source in range(61):
+            self.assertEqual( MOLECULES.codon_indices[ MOLECULES.codons[source] ], source, msg = "Genetics.codon_indices is incorrect." )
+            self.assertEqual( MOLECULES.amino_acids[ MOLECULES.codon_amino_acids[source] ], MOLECULES.codon_dict[ MOLECULES.codons[source] ], msg = "Genetics.codon_amino_acids is incorrect." )
+            for target in range(61):
+                nuc_diff = self.baseObject._get_nucleotide_diff(source, target)
+                self.assertEqual( MOLECULES.codon_n_diff[source, target], len(nuc_diff)/2, msg = "Genetics.codon_n_diff is incorrect." )
+                self.assertEqual( MOLECULES.codon_num_ti[source, target], sum([self.baseObject._is_TI(nuc_diff[i], nuc_diff[i+1]) for i in range(0, len(nuc_diff), 2)]), msg = "Genetics.codon_num_ti is incorrect." )
+                if len(nuc_diff) == 2:
+                    self.assertEqual( MOLECULES.nucleotides[ MOLECULES.codon_source_nuc[source, target] ] + MOLECULES.nucleotides[ MOLECULES.codon_target_nuc[source, target] ], nuc_diff, msg = "Genetics.codon_source_nuc or codon_target_nuc is incorrect." )
+                    position = MOLECULES.codon_diff_position[source, target]
+                    self.assertNotEqual( MOLECULES.codons[source][position], MOLECULES.codons[target][position], msg = "Genetics.codon_diff_position is incorrect." )
+                    self.assertEqual( MOLECULES.codon_ti[source, target], self.baseObject._is_TI(nuc_diff[0], nuc_diff[1]), msg = "Genetics.codon_ti is incorrect." )
+                else:
+                    self.assertEqual( MOLECULES.codon_diff_position[source, target], -1, msg = "Genetics.codon_diff_position should be -1 for codons without a single difference." )
+                    self.assertFalse( MOLECULES.codon_ti[source, target], msg = "Genetics.codon_ti should be False for codons without a single difference." )
+        self.assertRaises(ValueError, MOLECULES.codon_syn.__setitem__, (0, 1), True)
+        self.assertTrue( Genetics().codon_syn is MOLECULES.codon_syn, msg = "Genetics tables are not shared among instances." )
+
+
     def test_matrixBuilder_baseClass_get_nucleotide_diff(self):
         ''' Test that nucleotide differences between codons can be identified properly. '''
         
@@ -481,6 +502,74 @@ class matrixBuilder_MutSel_codon_fitness_tests(unittest.TestCase):
 
 
 
+class matrixBuilder_vectorized_tests(unittest.TestCase):
+    ''' 
+        Set of unittests checking that each child class builds the same matrix with array operations as with _calc_instantaneous_prob for every entry.
+    '''
+    def setUp(self):
+        codonFreqs = np.random.default_rng(1).dirichlet( np.ones(61) )
+        codonFreqs[3] = 0.
+        codonFreqs /= np.sum(codonFreqs)
+        nucFreqs = [0.34, 0.21, 0.27, 0.18]
+        muSym = {'AG':0.1, 'CT':0.125, 'AC': 0.08, 'AT':0.05, 'CG':0.125, 'GT':0.13}
+        muAsym = {'AG':0.125, 'GA':0.1, 'CT':0.125, 'TC':0.125, 'AC': 0.13, 'CA':0.12, 'AT':0.125, 'TA':0.14, 'CG':0.125, 'GC':0.125, 'GT':0.13, 'TG':0.12}
+        self.builders = [ matrix_builder.Nucleotide_Matrix("nucleotide", {'state_freqs': nucFreqs, 'mu': muSym}),
+                          matrix_builder.AminoAcid_Matrix("wag", {'state_freqs': np.repeat(0.05, 20)}),
+                          matrix_builder.MechCodon_Matrix("gy", {'state_freqs': codonFreqs, 'mu': muSym, 'alpha': 1.2, 'beta': 0.4}),
+                          matrix_builder.MechCodon_Matrix("mg", {'state_freqs': codonFreqs, 'nuc_freqs': nucFreqs, 'mu': muSym, 'alpha': 1., 'beta': 2.5}),
+                          matrix_builder.ECM_Matrix("ecmrest", {'state_freqs': codonFreqs, 'alpha': 1., 'beta': 0.5, 'k_ti': 1.5, 'k_tv': 0.8}),
+                          matrix_builder.ECM_Matrix("ecmunrest", {'state_freqs': codonFreqs, 'alpha': 1., 'beta': 0.5, 'k_ti': 1.5, 'k_tv': 0.8}),
+                          matrix_builder.MutSel_Matrix("mutsel", {'state_freqs': codonFreqs, 'mu': muAsym, 'calc_by_freqs': True}),
+                          matrix_builder.MutSel_Matrix("mutsel", {'fitness': np.log(codonFreqs + 0.01), 'mu': muAsym, 'calc_by_freqs': False}),
+                          matrix_builder.MutSel_Matrix("mutsel", {'state_freqs': np.array(nucFreqs), 'mu': muAsym, 'calc_by_freqs': True}) ]
+        
+    
+    def test_matrixBuilder_vectorized_matches_loop(self):
+        for builder in self.builders:
+            vectorized = builder._build_matrix()
+            builder._calc_instantaneous_matrix = lambda parameters: matrix_builder.MatrixBuilder._calc_instantaneous_matrix(builder, parameters)
+            looped = builder._build_matrix()
+            np.testing.assert_array_almost_equal(vectorized, looped, decimal = 14, err_msg = "Vectorized matrix differs from the entrywise matrix for " + type(builder).__name__ + " " + builder.model_type + ".")
+
+
+
+
+class matrixBuilder_scaling_cache_tests(unittest.TestCase):
+    ''' 
+        Set of unittests for the cache of scaling factors computed from scaling matrices.
+    '''
+    def setUp(self):
+        self.mu = {'AG':0.125, 'GA':0.1, 'CT':0.125, 'TC':0.125, 'AC': 0.13, 'CA':0.12, 'AT':0.125, 'TA':0.14, 'CG':0.125, 'GC':0.125, 'GT':0.13, 'TG':0.12}
+        self.cache_size = matrix_builder.SCALING_CACHE_SIZE
+        matrix_builder.MatrixBuilder._scaling_factors.clear()
+    
+    def tearDown(self):
+        matrix_builder.SCALING_CACHE_SIZE = self.cache_size
+    
+    def test_matrixBuilder_scaling_cache_shared(self):
+        ''' Models sharing mutation rates compute their neutral scaling factor once, and it matches the uncached factor. '''
+        fitness = np.random.default_rng(3).normal(size = (5, 61))
+        for f in fitness:
+            builder = matrix_builder.MutSel_Matrix("mutsel", {'fitness': f, 'mu': dict(self.mu), 'calc_by_freqs': False})
+            builder()
+            frequencies, matrix = builder._build_scaling_matrix()
+            self.assertEqual( builder._obtain_scaling_factor(), builder._scaling_factor_from_matrix(frequencies, matrix), msg = "Cached scaling factor differs from the computed one." )
+        self.assertEqual( len(matrix_builder.MatrixBuilder._scaling_factors), 1, msg = "Scaling factor not shared among models with the same mutation rates." )
+        
+        # Changing how the matrix is built, or the mutation rates, gives a new factor
+        matrix_builder.MutSel_Matrix("mutsel", {'state_freqs': np.repeat(1./61, 61), 'mu': dict(self.mu), 'calc_by_freqs': True})()
+        self.mu['AG'] = 0.5
+        matrix_builder.MutSel_Matrix("mutsel", {'fitness': fitness[0], 'mu': self.mu, 'calc_by_freqs': False})()
+        self.assertEqual( len(matrix_builder.MatrixBuilder._scaling_factors), 3, msg = "Distinct scaling parameters improperly share a cached factor." )
+
+    def test_matrixBuilder_scaling_cache_eviction(self):
+        ''' The least recently used factors are evicted. '''
+        matrix_builder.SCALING_CACHE_SIZE = 2
+        for omega in [0.5, 1.5, 0.5, 2.5]:
+            matrix_builder.MechCodon_Matrix("gy", {'state_freqs': np.repeat(1./61, 61), 'mu': dict(self.mu), 'alpha': 1., 'beta': omega, 'hetmodel_mean_dnds': omega})()
+        self.assertEqual( [key[-1][1][1] for key in matrix_builder.MatrixBuilder._scaling_factors], [0.5, 2.5], msg = "Scaling cache did not evict the least recently used factor." )
+
+
 # 
 # 
 # def run_matrix_builder_test():
@@ -15,6 +15,7 @@ import unittest
 import os
 from pyvolve import *
 import numpy as np
+from scipy import linalg
 ZERO    = 1e-8
 DECIMAL = 8
 
@@ -464,6 +465,151 @@ class model_matrix_tests(unittest.TestCase):
 
 
 
+class model_transition_matrix_tests(unittest.TestCase):
+    ''' 
+        Suite of tests to verify that transition matrices computed from the cached eigendecomposition match scipy's expm.
+    ''' 
+
+    def setUp(self):
+        self.times = [0., 0.01, 0.5, 3.]
+
+    def _compare_to_expm(self, model, reversible):
+        for c in range( model.num_classes() ):
+            if model.is_hetcodon_model():
+                Q = model.matrix[c]
+            else:
+                Q = model.matrix * model.rate_factors[c]
+            for t in self.times:
+                np.testing.assert_array_almost_equal(model.transition_matrix(t, c), linalg.expm(Q * t), decimal = DECIMAL, err_msg = "Transition matrix from eigendecomposition does not match expm.")
+        for d in model._decompositions:
+            self.assertTrue(d.reversible is reversible, msg = "Reversibility of matrix improperly detected.")
+
+
+    def test_transition_matrix_nucleotide_gamma(self):
+        '''
+            Reversible nucleotide model, with rate factors scaling time.
+        '''
+        model = Model("nucleotide", {"kappa":3., "state_freqs":[0.1, 0.2, 0.3, 0.4]}, alpha = 0.5)
+        self._compare_to_expm(model, True)
+
+
+    def test_transition_matrix_hetcodon(self):
+        '''
+            Heterogeneous codon model, one decomposition per matrix.
+        '''
+        model = Model("GY", {"omega":[0.2, 1.5]})
+        self._compare_to_expm(model, True)
+        self.assertTrue(len(model._decompositions) == 2, msg = "Heterogeneous codon model should have one decomposition per matrix.")
+    
+    
+    def test_transition_matrix_nonreversible(self):
+        '''
+            MG models with codon frequencies are not reversible, so the general decomposition is used.
+        '''
+        model = Model("MG", {"omega":0.5})
+        self._compare_to_expm(model, False)
+
+      
+    def test_transition_matrix_array_of_times(self):
+        '''
+            An array of times gives a stacked array of transition matrices.
+        '''
+        model = Model("WAG")
+        P = model.transition_matrix(np.array(self.times))
+        self.assertTrue(P.shape == (4, 20, 20), msg = "Array of transition matrices has the wrong shape.")
+        for i in range(len(self.times)):
+            np.testing.assert_array_almost_equal(P[i], model.transition_matrix(self.times[i]), decimal = DECIMAL, err_msg = "Stacked transition matrices do not match individual ones.")
+
+
+    def test_transition_matrix_nucleotide_closed_form(self):
+        '''
+            Nucleotide models of the TN93 family use closed-form transition matrices, for single or many branch lengths, and other nucleotide models are decomposed.
+        '''
+        tn93 = Model("nucleotide", {"mu":{"AG":2., "CT":4., "AC":1., "AT":1., "CG":1., "GT":1.}, "state_freqs":[0.4, 0.1, 0.2, 0.3]})
+        self._compare_to_expm(tn93, True)
+        self.assertTrue(isinstance(tn93._decompositions[0], NucleotideTransitions), msg = "TN93 model does not use closed-form transition matrices.")
+        P = tn93.transition_matrix(np.array(self.times))
+        for i in range(len(self.times)):
+            np.testing.assert_array_almost_equal(P[i], linalg.expm(tn93.matrix * self.times[i]), decimal = DECIMAL, err_msg = "Stacked closed-form transition matrices do not match expm.")
+        gtr = Model("nucleotide", {"mu":{"AG":2., "CT":4., "AC":1., "AT":1.5, "CG":1., "GT":1.}})
+        self._compare_to_expm(gtr, True)
+        self.assertTrue(isinstance(gtr._decompositions[0], MatrixDecomposition), msg = "GTR model should not use closed-form transition matrices.")
+
+
+    def test_matrix_decomposition_defective(self):
+        '''
+            Defective matrices fall back to expm.
+        '''
+        Q = np.array([[-1., 1., 0.], [0., -1., 1.], [0., 0., 0.]])
+        d = MatrixDecomposition(Q)
+        self.assertTrue(d.defective, msg = "Defective matrix was not detected.")
+        np.testing.assert_array_almost_equal(d.exponentiate(0.7), linalg.expm(Q * 0.7), decimal = DECIMAL, err_msg = "Defective matrix improperly exponentiated.")
+
+
+
+
+
+
+class model_batched_mutsel_tests(unittest.TestCase):
+    ''' 
+        Suite of tests for batched mutation-selection models, with one row of fitness values or state frequencies per site.
+    ''' 
+
+    def setUp(self):
+        rng = np.random.default_rng(13)
+        self.fitness = rng.normal(0., 2., size = (6, 61))
+        self.freqs = rng.dirichlet(np.ones(61), size = 4)
+        self.mu = {"AC":1.5, "AG":2.5, "AT":0.5, "CG":0.8, "CT":3., "GT":1.2}
+
+        
+    def test_batched_mutsel_fitness(self):
+        '''
+            Stacked matrices and state frequencies match those of one Model per site.
+        '''
+        model = Model("mutsel", {"fitness":self.fitness.copy(), "mu":dict(self.mu)})
+        self.assertTrue(model.is_batched_model(), msg = "Model built from a 2D fitness array is not batched.")
+        self.assertTrue(model.matrix.shape == (6, 61, 61) and model.num_sites() == 6, msg = "Batched model has the wrong shape.")
+        for i in range(6):
+            single = Model("mutsel", {"fitness":self.fitness[i].copy(), "mu":dict(self.mu)})
+            np.testing.assert_array_almost_equal(model.matrix[i], single.matrix, decimal = DECIMAL, err_msg = "Batched matrix does not match a single-site matrix.")
+            np.testing.assert_array_almost_equal(model.params["state_freqs"][i], single.params["state_freqs"], decimal = DECIMAL, err_msg = "Batched state frequencies do not match single-site state frequencies.")
+
+
+    def test_batched_mutsel_freqs_aafitness(self):
+        '''
+            Batched models may also be built from state frequencies or amino-acid fitness values.
+        '''
+        model = Model("mutsel", {"state_freqs":self.freqs})
+        for i in range(4):
+            np.testing.assert_array_almost_equal(model.matrix[i], Model("mutsel", {"state_freqs":self.freqs[i]}).matrix, decimal = DECIMAL, err_msg = "Batched matrix from frequencies does not match a single-site matrix.")
+        aa_fitness = self.fitness[:, :20]
+        model = Model("mutsel", {"fitness":aa_fitness})
+        np.testing.assert_array_almost_equal(model.matrix[3], Model("mutsel", {"fitness":aa_fitness[3]}).matrix, decimal = DECIMAL, err_msg = "Batched matrix from amino-acid fitness does not match a single-site matrix.")
+
+
+    def test_batched_mutsel_transitions(self):
+        '''
+            Stacked transition matrices and rows match expm.
+        '''
+        model = Model("mutsel", {"fitness":self.fitness.copy(), "mu":dict(self.mu)})
+        P = np.array([linalg.expm(Q * 0.4) for Q in model.matrix])
+        np.testing.assert_array_almost_equal(model.transition_matrix(0.4), P, decimal = DECIMAL, err_msg = "Batched transition matrices do not match expm.")
+        states = np.array([[0, 5, 60, 12, 3, 3], [1, 1, 1, 1, 1, 1]])
+        np.testing.assert_array_almost_equal(model.transition_rows(0.4, states), P[np.arange(6), states], decimal = DECIMAL, err_msg = "Batched transition rows do not match expm.")
+        self.assertTrue(model._decompositions[0].reversible, msg = "Batched mutation-selection matrices should be reversible.")
+
+
+    def test_batched_mutsel_no_rate_het(self):
+        '''
+            Batched models do not support rate heterogeneity.
+        '''
+        self.assertRaises(AssertionError, Model, "mutsel", {"fitness":self.fitness.copy()}, alpha = 0.5)
+
+
+
+
+
+
 class model_hetcodonmodel_tests(unittest.TestCase):
     ''' 
         Suite of tests for Model with user-specified *codon* heterogeneity.
@@ -267,3 +267,50 @@ class newick_tests(unittest.TestCase):
         
         
         
+
+
+    def test_newick_read_tree_deep(self):
+        ''' 
+            Test parsing a caterpillar tree deeper than the recursion limit, with a propagating model flag near the root.
+        '''
+        depth = 5000
+        tstring = "(" * depth + "t0:0.1,t1:0.1):0.3" + "".join( [",t" + str(i) + ":0.2):0.3" for i in range(2, depth)] ) + "#m1#,t" + str(depth) + ":0.4);"
+        t = read_tree(tree = tstring, scale_tree = 2.)
+        
+        node = t
+        for i in range(depth - 1):
+            self.assertTrue( len(node.children) == 2, msg = "Couldn't parse a deep tree properly.")
+            node = node.children[0]
+            self.assertTrue( node.model_flag == "m1", msg = "Model flag not propagated through a deep tree.")
+        self.assertTrue( node.name == "internalNode1" and node.branch_length == 0.6 and node.children[1].name == "t1", msg = "Couldn't parse the innermost subtree of a deep tree properly.")
+        self.assertTrue( t.name == "root" and t.children[1].branch_length == 0.8 and t.children[1].model_flag is None, msg = "Couldn't parse the root of a deep tree properly.")
+
+
+    def test_newick_flat_tree(self):
+        ''' 
+            Test compiling a tree with node names and model flags into a FlatTree.
+        '''
+        flat = FlatTree( read_tree(tree = self.string_nodenames_propflags) )
+        self.assertTrue( flat.names == ["root", "t4", "robert", "t3", "bobbybubby", "t2", "bobby", "t5", "t1"], msg = "FlatTree nodes are not in preorder.")
+        self.assertTrue( list(flat.parent) == [-1, 0, 0, 2, 2, 4, 4, 6, 6] and list(flat.child_index) == [0, 0, 1, 0, 1, 0, 1, 0, 1], msg = "FlatTree parents improperly assigned.")
+        self.assertTrue( list(flat.subtree_size) == [9, 1, 7, 1, 5, 1, 3, 1, 1] and flat.children(2) == [3, 4], msg = "FlatTree subtrees improperly assigned.")
+        self.assertTrue( list(flat.leaf) == [False, True, False, True, False, True, False, True, True], msg = "FlatTree leaves improperly assigned.")
+        self.assertTrue( np.isnan(flat.branch_length[0]) and list(flat.branch_length[1:3]) == [0.785, 0.207], msg = "FlatTree branch lengths improperly assigned.")
+        self.assertTrue( [flat.flags[f] for f in flat.model_flag] == [None, None, None, None, "m2", "m2", "m1", "m1", "m1"], msg = "FlatTree model flags improperly assigned.")
+
+
+    def test_newick_read_trees(self):
+        ''' 
+            Test streaming several trees, with and without model flags and spread over lines, from a file, in this process and in worker processes.
+        '''
+        tstrings = [self.string_noflags, self.string_propflags_underscore, self.string_nodenames_nopropflags, "(t4:0.5,(t3:0.25,(t2:0.1,(t5:0.612,t1:0.660#m1):0.762#m2#):0.921):0.207):0.1;", self.string_labeledroot]
+        expected = [ FlatTree(read_tree(tree = tstring, scale_tree = 2.)) for tstring in tstrings ]
+        for (flat, workers) in [(False, None), (True, 2)]:
+            trees = list( read_trees(file = 'tests/newickFiles/test_trees.tre', scale_tree = 2., flat = flat, workers = workers, chunk_size = 2) )
+            self.assertTrue( len(trees) == len(expected), msg = "Couldn't read all trees from file.")
+            for (tree, true_tree) in zip(trees, expected):
+                if not flat:
+                    tree = FlatTree(tree)
+                self.assertTrue( tree.names == true_tree.names and list(tree.parent) == list(true_tree.parent), msg = "Couldn't stream tree topology from file properly.")
+                np.testing.assert_array_equal( tree.branch_length, true_tree.branch_length, err_msg = "Couldn't stream branch lengths from file properly.")
+                self.assertTrue( [tree.flags[f] for f in tree.model_flag] == [true_tree.flags[f] for f in true_tree.model_flag], msg = "Couldn't stream model flags from file properly.")
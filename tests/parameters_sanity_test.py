@@ -39,6 +39,11 @@ class ParametersSanity_sanity_freqs(unittest.TestCase):
         pm = Nucleotide_Sanity("nucleotide", params, size = 4)
         self.assertRaises(AssertionError, lambda: pm._sanity_state_freqs())
         
+    def test_sanity_state_freqs_incorrect_sum_above_one(self):    
+        params = {"state_freqs": [0.3, 0.3, 0.3, 0.3]}
+        pm = Nucleotide_Sanity("nucleotide", params, size = 4)
+        self.assertRaises(AssertionError, lambda: pm._sanity_state_freqs())
+        
     def test_sanity_state_freqs_ecm(self):
         ecmrest_freqs = [0.03000113, 0.02017108, 0.02634411, 0.02300609, 0.01552806, 0.02020108, 0.01214205, 0.01342405, 0.01037204, 0.01167905, 0.00819503, 0.01014204, 0.01355105, 0.02344109, 0.02010208, 0.0255761 , 0.01607606, 0.01170305, 0.02021108, 0.01109704, 0.01064204, 0.01010004, 0.01184305, 0.01000704, 0.00480002, 0.01414806, 0.00783703, 0.00831103, 0.00760003, 0.01738607, 0.02883912, 0.01446706, 0.03322313, 0.0245321 , 0.03187813, 0.02819811, 0.01590806, 0.02830711, 0.01885308, 0.01900508, 0.01579606, 0.02298209, 0.01019104, 0.01685207, 0.01090104, 0.01893808, 0.02274709, 0.01904708, 0.01578206, 0.01596506, 0.00975004, 0.01113104, 0.00895604, 0.01188005, 0.00702903, 0.01188005, 0.00602502, 0.01638707, 0.02138309, 0.01542506, 0.02210309] 
         params = {}    
@@ -177,6 +182,16 @@ class ParametersSanity_MutSel(unittest.TestCase):
         self.assertTrue(pm.params["calc_by_freqs"], msg = "MutSel model didnt set calc_by_freqs as True when codon frequencies provided.")
 
 
+    def test_sanity_MutSel_batched_frequencies_incorrect_sum(self):
+        batched_freqs = [[0.25, 0.25, 0.25, 0.25], [0.4, 0.3, 0.2, 0.3], [0.1, 0.2, 0.3, 0.2]]
+        for bad_row in [1, 2]:
+            pm = MutSel_Sanity("mutsel", {"state_freqs": [batched_freqs[0], batched_freqs[bad_row]]})
+            self.assertRaises(AssertionError, pm._sanity_state_freqs_fitness)
+        pm = MutSel_Sanity("mutsel", {"state_freqs": [batched_freqs[0], batched_freqs[0]]})
+        pm._sanity_state_freqs_fitness()
+        self.assertTrue(pm.params["calc_by_freqs"], msg = "MutSel model didnt accept batched nucleotide frequencies which sum to 1.")
+
+
     def test_sanity_MutSel_nuc_fitness(self):
         nuc_fitness = [0.2, 0.4, 1.6, 1.5]
         pm = MutSel_Sanity("mutsel", {"fitness": nuc_fitness})
@@ -87,6 +87,11 @@ class state_freqs_RandomFrequencies_Tests(unittest.TestCase):
         np.testing.assert_almost_equal(np.sum(freqs), 1., decimal = self.dec, err_msg = "RandomFrequencies do not sum to 1 for  nuc, type=nuc.")
         self.assertEqual(len(freqs), correct_len, msg= "RandomFrequencies has incorrect size for  nuc, type=nuc.")
 
+    def test_RandomFrequencies_rng_reproducible(self):
+        freqs1 = RandomFrequencies( 'nucleotide', rng = np.random.default_rng(11) ).compute_frequencies()
+        freqs2 = RandomFrequencies( 'nucleotide', rng = np.random.default_rng(11) ).compute_frequencies()
+        np.testing.assert_array_equal(freqs1, freqs2, err_msg = "RandomFrequencies not reproduced from a seeded Generator.")
+
  
  
  
@@ -333,6 +338,45 @@ class state_freqs_ReadFrequencies_Tests(unittest.TestCase):
         freqs = self.rFreqs.compute_frequencies( type='codon')
         np.testing.assert_array_almost_equal(correct, freqs, decimal = self.dec, err_msg = "ReadFrequencies not calculated properly for  amino, type=codon, with columns.")
 
+    def test_ReadFrequencies_calculate_freqs_wrapped_lines(self):
+        ''' Sequences wrapped over several lines, with gap codons, give the same frequencies as the unwrapped alignment. '''
+        for columns in [None, [1,2,3]]:
+            correct = ReadFrequencies( 'codon', columns = columns, file = 'tests/freqFiles/testFreq_codon_aln.fasta').compute_frequencies()
+            freqs = ReadFrequencies( 'codon', columns = columns, file = 'tests/freqFiles/testFreq_codon_wrapped.fasta').compute_frequencies()
+            np.testing.assert_array_almost_equal(correct, freqs, decimal = self.dec, err_msg = "ReadFrequencies not calculated properly for wrapped sequence lines.")
+
+    def test_ReadFrequencies_stream_states_blocks(self):
+        ''' Streamed states do not depend on the size of the blocks in which the file is read. '''
+        from pyvolve.state_freqs import _stream_states
+        correct = [np.array([5, 14, 60, 60, 45, 46, 61]), np.array([20, 14, 26, 26, 45, 45, 61]), np.array([21, 60, 14, 46, 46, 46, 61])]
+        for block_size in [1, 4, 1048576]:
+            states = [[], [], []]
+            for record, position, chunk in _stream_states('tests/freqFiles/testFreq_codon_wrapped.fasta', 'fasta', 'codon', block_size = block_size):
+                self.assertEqual(position, len(states[record]))
+                states[record].extend(chunk)
+            for record in range(3):
+                np.testing.assert_array_equal(correct[record], states[record])
+
+    def test_ReadFrequencies_compute_site_frequencies(self):
+        ''' Each row of the site frequencies matches the frequencies of its single column. '''
+        for by, file, ncol, types in [('codon', 'tests/freqFiles/testFreq_codon_aln.fasta', 6, ['codon', 'amino_acid', 'nucleotide']), ('amino_acid', 'tests/freqFiles/testFreq_amino_aln.fasta', 18, ['amino_acid', 'codon'])]:
+            for type in types:
+                site_freqs = ReadFrequencies( by, file = file).compute_site_frequencies( type = type )
+                self.assertEqual(site_freqs.shape, (ncol, len(ReadFrequencies( by, file = file).compute_frequencies( type = type ))))
+                for col in range(ncol):
+                    correct = ReadFrequencies( by, columns = [col + 1], file = file).compute_frequencies( type = type )
+                    np.testing.assert_array_almost_equal(correct, site_freqs[col], decimal = self.dec, err_msg = "Site frequencies not calculated properly for by=" + by + ", type=" + type + ".")
+
+    def test_ReadFrequencies_compute_site_frequencies_batched_model(self):
+        ''' Site frequencies for selected columns, with pseudocounts, build a batched mutation-selection model. '''
+        site_freqs = ReadFrequencies( 'codon', columns = [3,1], file = 'tests/freqFiles/testFreq_codon_wrapped.fasta').compute_site_frequencies( pseudocount = 1. )
+        correct = np.ones(61)
+        correct[[60, 26, 14]] += 1. # TTT, CGG, ATG in column 3
+        np.testing.assert_array_almost_equal(correct / 64., site_freqs[0], decimal = self.dec, err_msg = "Site frequencies not calculated properly with pseudocounts.")
+        model = Model("mutsel", {"state_freqs": site_freqs})
+        self.assertTrue(model.is_batched_model())
+        self.assertEqual(model.num_sites(), 2)
+
 #     
 # def run_state_freqs_test():
 # 